@@ -0,0 +1,181 @@
+"""
+Record and replay of the Fugue API traffic of a run.
+
+To reproduce a slow export or onboarding run offline, record it once with
+fugue_client.enable_recording(path) (fugue_cli.py --record FILE): every
+request and its response are appended to a gzip compressed NDJSON archive,
+together with the time the response took. The archive can then be replayed
+with fugue_client.enable_replay(path) (fugue_cli.py --replay FILE) without
+network access or credentials: each request is answered with the recorded
+response, after the recorded latency (scaled by speed, or right away with
+speed 0), so the scripts can be profiled on real data shapes.
+
+Credentials are never part of the archive: they are sent as basic auth and
+request headers are not recorded. Values of fields that look like secrets
+(see REDACTED_FIELDS) are replaced in recorded request and response bodies
+and query parameters. Responses are stored decoded, so replayed responses
+are not compressed.
+
+Requests are matched on method, API path, query parameters (except the
+time based VOLATILE_PARAMS) and a hash of the request body. Requests made
+several times are answered with their recorded responses in order, the last
+one being repeated.
+"""
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+# Fields whose values are replaced by REDACTED in recorded bodies and params
+REDACTED_FIELDS = re.compile(r'secret|password|token|private_key|access_key|credential', re.IGNORECASE)
+REDACTED = 'REDACTED'
+
+# Response headers kept in the archive
+RECORDED_HEADERS = ('Content-Type',)
+
+# Query parameters that depend on when a run happens (scans are listed from
+# a time relative to now) and are left out when matching requests
+VOLATILE_PARAMS = ('range_from', 'range_to')
+
+
+class ReplayMissError(Exception):
+    """
+    Raised when a replayed run makes a request that was not recorded.
+    """
+
+
+def redact(value):
+    """
+    Returns a copy of a JSON value with the values of secret looking fields
+    replaced.
+    """
+    if isinstance(value, dict):
+        return dict((k, REDACTED if REDACTED_FIELDS.search(k) else redact(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [redact(v) for v in value]
+    return value
+
+
+def redact_text(text):
+    """
+    Redacts a JSON document given as text. Text that is not JSON, or has no
+    field that could be secret, is returned as is.
+    """
+    if not REDACTED_FIELDS.search(text):
+        return text
+    try:
+        return json.dumps(redact(json.loads(text)))
+    except ValueError:
+        return text
+
+
+def body_hash(body):
+    if body is None:
+        return None
+    if not isinstance(body, bytes):
+        body = json.dumps(body, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(body).hexdigest()
+
+
+def request_key(method, path, params, body):
+    """
+    Returns the key a request is matched on.
+    """
+    params = dict((name, value) for name, value in (params or {}).items() if name not in VOLATILE_PARAMS)
+    return json.dumps([method.upper(), path, params, body_hash(body)], sort_keys=True, default=str)
+
+
+class Recorder(object):
+    """
+    Appends every request made through record() to a gzip compressed NDJSON
+    archive.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wt')
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.count = 0
+
+    def record(self, method, path, params, body, send):
+        """
+        Sends the request with send(), reading the whole response so its
+        latency includes the body, and records it. Returns the response,
+        whose content can still be iterated.
+        """
+        sent = time.time()
+        resp = send()
+        content = resp.content
+        latency = time.time() - sent
+        text = content.decode(resp.encoding or 'utf-8', 'replace')
+        entry = {
+            'key': request_key(method, path, params, body),
+            'method': method.upper(),
+            'path': path,
+            'params': redact(params or {}),
+            'request': redact(body) if isinstance(body, (dict, list)) else None,
+            'status': resp.status_code,
+            'headers': dict((name, resp.headers[name]) for name in RECORDED_HEADERS if name in resp.headers),
+            'encoding': resp.encoding,
+            'body': redact_text(text),
+            'sent_at': round(sent - self.start, 6),
+            'latency': round(latency, 6),
+        }
+        line = json.dumps(entry, separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+            self.count += 1
+        return resp
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Replayer(object):
+    """
+    Answers requests with the responses recorded in an archive, after their
+    recorded latency multiplied by speed (0 for no delay).
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.used = {}
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                entry = json.loads(line)
+                self.entries.setdefault(entry['key'], []).append(entry)
+        self.count = sum(len(entries) for entries in self.entries.values())
+
+    def response(self, method, path, params, body, url):
+        """
+        Returns a requests.Response built from the next recorded response
+        for the request.
+        """
+        key = request_key(method, path, params, body)
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                raise ReplayMissError('No recorded response for %s %s %s' % (method.upper(), path, json.dumps(params or {}, sort_keys=True)))
+            index = self.used.get(key, 0)
+            self.used[key] = index + 1
+        entry = entries[min(index, len(entries) - 1)]
+        if self.speed:
+            time.sleep(entry['latency'] * self.speed)
+        resp = requests.Response()
+        resp.status_code = entry['status']
+        resp.headers = CaseInsensitiveDict(entry['headers'])
+        resp.encoding = entry['encoding']
+        resp.url = url
+        resp._content = entry['body'].encode(entry['encoding'] or 'utf-8')
+        resp._content_consumed = True
+        return resp
@@ -0,0 +1,144 @@
+"""
+AWS and AWS GovCloud environment definitions shared by the onboarding scripts.
+
+env_creation_AWS_accounts.py, env_creation_AWS_govcloud_accounts.py,
+env_creation_AWS_org.py and env_creation_AWS_multi_org.py all turn a map of
+account names and ids into one environment per account and region (or one
+per account for coalesced regions). AwsEnvDefs holds the settings of one
+provider and builds the targets, bodies and pre-encoded payloads from them,
+so the scripts only differ in how they find their accounts. The role ARN
+partition ("aws" or "aws-us-gov") and the region used to look up the
+resource types of "*" follow from the provider and can be overridden.
+"""
+import env_payloads
+import role_preflight
+
+
+# Region whose resource types are used for environments that scan all regions
+DEFAULT_REGIONS = {
+    'aws': 'us-east-1',
+    'aws_govcloud': 'us-gov-east-1',
+}
+
+
+def create_aws_env_def(env_name, provider, region, accountid, resource_types, compliance_families, rolename, interval=0, partition=None):
+    """
+    Returns the body of an environment. region can also be a list of regions
+    that are coalesced into a single environment.
+    """
+    partition = partition or role_preflight.ARN_PARTITIONS[provider]
+    return {
+        "name": env_name,
+        "provider": provider,
+        "provider_options": {
+            provider: {
+                "regions": list(region) if isinstance(region, (list, tuple)) else [region],
+                "role_arn": "arn:" + partition + ":iam::" + accountid + ":role/" + rolename
+            }
+        },
+        "compliance_families": compliance_families,
+        "survey_resource_types": resource_types,
+        "remediate_resource_types": [],
+        "scan_schedule_enabled": interval != 0,
+        "scan_interval": int(interval)
+    }
+
+
+def region_label(region):
+    return ", ".join(region) if isinstance(region, tuple) else region
+
+
+def validated_accounts(accounts, provider, rolename, checkers, profile=None, external_id=None, endpoint_url=None):
+    """
+    Returns the accounts whose role can be assumed with the credentials of
+    profile. checkers holds one role checker per profile, so roles are only
+    checked once per run.
+    """
+    if profile not in checkers:
+        checkers[profile] = role_preflight.RoleChecker(profile, external_id, endpoint_url)
+    return checkers[profile].filter(accounts, provider, rolename)
+
+
+class AwsEnvDefs(object):
+    """
+    Builds the environments of one AWS provider. lookup is called with a
+    region and returns its resource types. coalesce is called with an
+    account id and returns whether its regions are coalesced into a single
+    environment.
+    """
+
+    def __init__(self, provider, regions, rolename, interval, compliance_families, lookup,
+                 coalesce=None, partition=None, default_region=None):
+        self.provider = provider.lower()
+        self.regions = regions
+        self.rolename = rolename
+        self.interval = interval
+        self.compliance_families = compliance_families
+        self.lookup = lookup
+        self.coalesce = coalesce or (lambda acct_id: False)
+        self.partition = partition or role_preflight.ARN_PARTITIONS[self.provider]
+        self.default_region = default_region or DEFAULT_REGIONS[self.provider]
+
+    def env_targets(self, name, acct_id):
+        """
+        Returns the (environment name, region) pairs to create for an account. When regions are coalesced
+        a single environment covers all of them and region is a tuple of the regions.
+        """
+        if self.coalesce(acct_id) and len(self.regions) > 1 and "*" not in self.regions:
+            group = tuple(region.lower() for region in self.regions)
+            return [(name + " - " + acct_id + " - " + str(len(group)) + " Regions", group)]
+        targets = []
+        for region in self.regions:
+            if region == "*":
+                targets.append((name + " - " + acct_id + " - " + "All Regions", "*"))
+            else:
+                targets.append((name + " - " + acct_id + " - " + region, region.lower()))
+        return targets
+
+    def resource_types_for(self, region):
+        """
+        Returns the resource types for a region, or the union of the resource types of coalesced regions
+        """
+        if region == "*":
+            return self.lookup(self.default_region)
+        if not isinstance(region, tuple):
+            return self.lookup(region)
+        union = []
+        for coalesced_region in region:
+            for resource_type in self.lookup(coalesced_region):
+                if resource_type not in union:
+                    union.append(resource_type)
+        return union
+
+    def env_def(self, env_name, region, acct_id, survey_resource_types):
+        return create_aws_env_def(env_name, self.provider, region, acct_id, survey_resource_types,
+                                  self.compliance_families, self.rolename, self.interval, self.partition)
+
+    def compile_payloads(self, gzip_payloads=False):
+        """
+        Returns a payload compiler that encodes the environment body once per region, retrieving the
+        resource types once per region, and only splices in the environment name and account id
+        """
+        def build_template(region, env_name, acct_id):
+            return self.env_def(env_name, region, acct_id, self.resource_types_for(region))
+        return env_payloads.PayloadCompiler(build_template, gzip_payloads)
+
+    def encoded_env_defs(self, accounts, compiler):
+        """
+        Generator that yields the pre-encoded environment body for every account and region
+        """
+        for name, acct_id in accounts.items():
+            for env_name, region in self.env_targets(name, acct_id):
+                yield compiler.render(region, env_name, acct_id)
+
+    def desired_env_defs(self, accounts):
+        """
+        Generator that yields the environment definition for every account and region,
+        retrieving the resource types once per region
+        """
+        resource_types_by_region = {}
+        for name, acct_id in accounts.items():
+            for env_name, region in self.env_targets(name, acct_id):
+                if region not in resource_types_by_region:
+                    resource_types_by_region[region] = self.resource_types_for(region)
+                yield self.env_def(env_name, region, acct_id, resource_types_by_region[region])
@@ -0,0 +1,130 @@
+"""
+Discovers the Azure subscriptions visible to a set of service principals so
+the Azure env_creation_* scripts don't need a hand-maintained subscriptions
+map.
+
+Each service principal signs in with the client credentials flow and lists
+the subscriptions of its home tenant and, optionally, of every other tenant it
+has been granted access to. All (service principal, tenant) pairs are
+enumerated concurrently and the results are merged into an index keyed by
+subscription ID, so a subscription visible to several principals is only
+onboarded once.
+
+https://learn.microsoft.com/en-us/rest/api/resources/subscriptions/list
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+# Azure AD and Azure Resource Manager endpoints. Point these at a local stand-in
+# to exercise discovery without Azure.
+login_url = "https://login.microsoftonline.com"
+arm_url = "https://management.azure.com"
+arm_api_version = "2020-01-01"
+
+
+def get_arm_token(tenant_id, application_id, client_secret):
+    """
+    Returns an Azure Resource Manager access token for the service principal
+    in the given tenant.
+    """
+    url = '%s/%s/oauth2/v2.0/token' % (login_url, tenant_id)
+    data = {
+        'grant_type': 'client_credentials',
+        'client_id': application_id,
+        'client_secret': client_secret,
+        'scope': arm_url + '/.default',
+    }
+    resp = requests.post(url, data=data)
+    resp.raise_for_status()
+    return resp.json()['access_token']
+
+
+def arm_list(path, token):
+    """
+    Generator that yields every item of a paginated ARM list operation,
+    following nextLink until the last page.
+    """
+    url = '%s/%s' % (arm_url, path.strip('/'))
+    params = {'api-version': arm_api_version}
+    headers = {'Authorization': 'Bearer ' + token}
+    while url:
+        resp = requests.get(url, params=params, headers=headers)
+        resp.raise_for_status()
+        page = resp.json()
+        for item in page.get('value', []):
+            yield item
+        url = page.get('nextLink')
+        # nextLink already carries the api-version and skip token
+        params = None
+
+
+def list_tenants(tenant_id, application_id, client_secret):
+    """
+    Returns the IDs of the tenants the service principal has access to.
+    """
+    token = get_arm_token(tenant_id, application_id, client_secret)
+    return [tenant['tenantId'] for tenant in arm_list('tenants', token)]
+
+
+def list_subscriptions(tenant_id, application_id, client_secret):
+    """
+    Returns the enabled subscriptions the service principal can see in the
+    given tenant.
+    """
+    token = get_arm_token(tenant_id, application_id, client_secret)
+    return [sub for sub in arm_list('subscriptions', token)
+            if sub.get('state', 'Enabled') == 'Enabled']
+
+
+def discover_subscriptions(service_principals, all_tenants=False, workers=8):
+    """
+    Enumerates the subscriptions visible to every service principal
+    concurrently. service_principals is a list of dicts with 'name',
+    'tenant_id', 'application_id', 'client_secret' and 'resource_groups'.
+
+    Returns a dict mapping subscription ID to a dict with the subscription
+    display name, its tenant and the service principal used to reach it. When
+    several principals see the same subscription, the first principal in
+    service_principals wins.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        tenants = []
+        for principal in service_principals:
+            if all_tenants:
+                tenants.append(pool.submit(list_tenants, principal['tenant_id'],
+                                           principal['application_id'], principal['client_secret']))
+            else:
+                tenants.append(None)
+
+        listings = []
+        for principal, future in zip(service_principals, tenants):
+            tenant_ids = [principal['tenant_id']]
+            if future is not None:
+                try:
+                    tenant_ids += [t for t in future.result() if t != principal['tenant_id']]
+                except requests.RequestException as error:
+                    # The home tenant is still listed, its subscription listing reports the error if the credentials are bad
+                    print('Tenant discovery failed for ' + principal['name'] + ': ' + str(error))
+            for tenant_id in tenant_ids:
+                listings.append((principal, tenant_id, pool.submit(
+                    list_subscriptions, tenant_id, principal['application_id'], principal['client_secret'])))
+
+        index = {}
+        for principal, tenant_id, future in listings:
+            try:
+                subscriptions = future.result()
+            except requests.RequestException as error:
+                print('Subscription discovery failed for ' + principal['name'] + ' in tenant ' + tenant_id + ': ' + str(error))
+                continue
+            for sub in subscriptions:
+                sub_id = sub['subscriptionId']
+                if sub_id in index:
+                    continue
+                index[sub_id] = {
+                    'display_name': sub.get('displayName', sub_id),
+                    'tenant_id': sub.get('tenantId', tenant_id),
+                    'principal': principal,
+                }
+    return index
@@ -2,7 +2,12 @@
 
 import json
 import os
-import requests
+import sys
+import fugue_client
+import aws_env_defs
+import progress
+import reconcile_environments
+import inventory_ingest
 
 # Common parameters that can be configured as needed 
 
@@ -20,6 +25,24 @@ import requests
 # compliance_families: List of complaince families needed https://docs.fugue.co/api.html#api-compliance-format
 # accounts: map of AWS GovCloud Account Name and Account numbers that needed to be loaded into Fugue. Environments are created with the
 # names in the format "Name - id - region" 
+# reconcile: Default = False. If set to True, existing environments are compared with the accounts and regions below and only the
+# difference is applied: missing environments are created and environments with changed settings (e.g. resource types or
+# compliance families) are updated in place instead of being recreated.
+# delete_orphans: Default = False. Only used with reconcile. If set to True, existing AWS GovCloud environments that are not in the
+# accounts and regions below are deleted.
+# inventory_file: Default = None. Path to a CSV, NDJSON or YAML inventory with "name" and "account_id" columns to use instead of
+# the accounts map. Rows are streamed and validated one at a time and created in chunks, so very large inventories are
+# processed in constant memory.
+# inventory_chunk_size: Number of inventory rows created per chunk.
+# workers: Number of environments created concurrently for an inventory file.
+# gzip_payloads: Default = False. If set to True, environment bodies are gzip compressed before they are sent.
+# coalesce_regions: Default = False. If set to True and several regions are listed, each account gets a single environment
+# that scans all of them (named "Name - id - N Regions") instead of one environment per region.
+# preflight_roles: Default = False. If set to True, the role of every account is checked with STS AssumeRole before any
+# environment is created (concurrently and cached, see role_preflight.py) and accounts whose role cannot be assumed are skipped.
+# preflight_profile: Default = None (default AWS credentials). AWS GovCloud profile whose credentials are used to assume the roles.
+# preflight_external_id: Default = None. External ID passed to AssumeRole if the trust policy of the roles requires one.
+# sts_endpoint_url: Default = None. STS endpoint used for the checks, e.g. a regional endpoint or a local STS stand-in.
 
 provider = "aws_govcloud"
 regions = ["*"]
@@ -27,46 +50,49 @@ rolename = "FugueRiskManager"
 interval = "86400"
 resource_types = ["All"] 
 compliance_families = ["FBP","CIS"]
+reconcile = False
+delete_orphans = False
+inventory_file = None
+inventory_chunk_size = 500
+workers = 8
+gzip_payloads = False
+coalesce_regions = False
+preflight_roles = False
+preflight_profile = None
+preflight_external_id = None
+sts_endpoint_url = None
 accounts = {
     "gov-account-name": "01234",
     "gov-account-name": "56789"
 }
 
-# Fugue API base URL
-api_url = "https://api.riskmanager.fugue.co"
-api_ver = 'v0'
+# Role checkers shared by all the preflight checks of a run, by profile, see validated_accounts()
+role_checkers = {}
 
-# Client ID and secret used to authenticate with Fugue. Follow the guide here
+# The Fugue API URL and credentials are handled by fugue_client.py. Client ID and secret are read from the
+# FUGUE_API_ID and FUGUE_API_SECRET environment variables when the first request is made, follow the guide here
 # to create an API client: https://docs.fugue.co/api.html#getting-started
-# You can set these values via environment variables or replace the os.getenv
-# calls below with the string values themselves.
-client_id = os.getenv('FUGUE_API_ID')
-client_secret = os.getenv('FUGUE_API_SECRET')
-
-if not client_id or not client_secret:
-    print('Please follow the user guide at https://docs.fugue.co/api.html#api-user-guide to set \'FUGUE_API_ID\' and \'FUGUE_API_SECRET\'')
-    exit(1)
-
-
-# Authentication
-# https://docs.fugue.co/api.html#auth-n
-auth = (client_id, client_secret)
 
 def get(path, params=None):
     """
     Executes an authenticated GET request to the Fugue API with the provided
     API path and query parameters.
     """
-    url = '%s/%s/%s' % (api_url, api_ver, path.strip('/'))
-    return requests.get(url, params=params, auth=auth).json()
+    return fugue_client.get(path, params=params)
 
 def create_env(path, json=None):
     """
     Executes an authenticated POST request to the Fugue API with the provided
     API path and json to create an environment.
     """
-    url = '%s/%s/%s' % (api_url, api_ver, path.strip('/'))
-    return requests.post(url, auth=auth, json=json)
+    return fugue_client.post(path, json=json)
+
+def create_env_encoded(path, payload):
+    """
+    Executes an authenticated POST request to the Fugue API with a pre-encoded
+    environment body from compile_payloads().
+    """
+    return fugue_client.post_encoded(path, payload.body, payload.content_encoding)
 
 def get_resource_types(resource_types, region, provider):
     """
@@ -77,34 +103,55 @@ def get_resource_types(resource_types, region, provider):
         params = {
         'beta_resources': "false"
         }
-        survey_resource_types = get('metadata/' + provider + '/resource_types', params=params)['resource_types']
+        survey_resource_types = list(fugue_client.get_items('metadata/' + provider + '/resource_types', params=params, key='resource_types'))
     else: 
         survey_resource_types = resource_types
 
     return survey_resource_types
 
+def env_defs():
+    """
+    Returns the environment definitions for the parameters above, see aws_env_defs.py
+    """
+    return aws_env_defs.AwsEnvDefs(provider, regions, rolename, interval, compliance_families,
+                                   lambda region: get_resource_types(resource_types, region, provider.lower()),
+                                   coalesce=lambda acct_id: coalesce_regions)
+
 def create_aws_env_def(env_name, provider, region, accountid, resource_types, compliance_families, rolename, interval=0):
-    if interval != 0:
-        scan_schedule_enabled = True
-    else: 
-        scan_schedule_enabled =  False     
-    
-    body = {
-        "name": env_name,
-        "provider": provider,
-        "provider_options": {
-            provider: {
-            "regions": [region],
-            "role_arn": "arn:aws-us-gov:iam::" + accountid + ":role/" + rolename
-            }
-        },
-        "compliance_families": compliance_families,
-        "survey_resource_types": resource_types,
-        "remediate_resource_types": [],
-        "scan_schedule_enabled": bool(scan_schedule_enabled),
-        "scan_interval": int(interval)
-        }
-    return body
+    return aws_env_defs.create_aws_env_def(env_name, provider, region, accountid, resource_types, compliance_families, rolename, interval)
+
+def env_targets(name, acct_id):
+    return env_defs().env_targets(name, acct_id)
+
+def region_label(region):
+    return aws_env_defs.region_label(region)
+
+def resource_types_for(region):
+    return env_defs().resource_types_for(region)
+
+def compile_payloads():
+    return env_defs().compile_payloads(gzip_payloads)
+
+def encoded_env_defs(accounts, compiler):
+    return env_defs().encoded_env_defs(accounts, compiler)
+
+def desired_env_defs(accounts):
+    return env_defs().desired_env_defs(accounts)
+
+def load_inventory():
+    """
+    Returns the accounts in inventory_file, read lazily and validated row by row
+    """
+    return inventory_ingest.Inventory(inventory_file, ["name", "account_id"], lambda row: str(row["account_id"]).strip(), inventory_ingest.validate_aws_account)
+
+def validated_accounts(accounts_to_check):
+    """
+    Returns the accounts whose role can be assumed if preflight_roles is set, otherwise all of them
+    """
+    if not preflight_roles:
+        return accounts_to_check
+    return aws_env_defs.validated_accounts(accounts_to_check, provider.lower(), rolename, role_checkers,
+                                           preflight_profile, preflight_external_id, sts_endpoint_url)
 
 def main():
     """
@@ -113,40 +160,47 @@ def main():
     """
     if provider.lower() == "azure" or provider.lower() == "aws":
         print ("This script is only for AWS GovCloud environment creation")
+    elif reconcile:
+        # Only create, update (and optionally delete) the environments that differ from the accounts above
+        targets = load_inventory() if inventory_file else accounts
+        reconcile_environments.reconcile(provider.lower(), desired_env_defs(targets), allow_deletes=delete_orphans)
+    elif inventory_file:
+        # Stream the accounts from the inventory file straight into creation, one chunk at a time
+        compiler = compile_payloads()
+        inventory_ingest.create_from_inventory(load_inventory(), lambda chunk: encoded_env_defs(validated_accounts(chunk), compiler), None, None, inventory_chunk_size, workers)
     else:
+        # Check the roles of the accounts before any environment is created
+        valid_accounts = validated_accounts(accounts)
+
+        compiler = compile_payloads()
+        reporter = progress.Progress('onboard', total=len(accounts), unit='accounts')
         for name, acct_id in accounts.items():
+            if name not in valid_accounts:
+                reporter.add('role_check_failed')
+                reporter.add()
+                continue
             if provider.lower() == "azure" or provider.lower() == "aws":
                 print ("This script is only for AWS GovCloud environment creation")
                 break
                     
-            for region in regions: 
-                # Set environment name
-                if region == "*": 
-                    env_name = name + " - " + acct_id + " - " + "All Regions"
-                else:
-                    env_name = name + " - " + acct_id + " - " + region
-                print("Starting on creation for environment " + env_name + " and id: " + acct_id +  " and region: " + region)
+            for env_name, region in env_targets(name, acct_id):
+                progress.log("Starting on creation for environment " + env_name + " and id: " + acct_id +  " and region: " + region_label(region))
                     
-                # Get resource types from Fugue API based on provider and region
-                if region != "*":
-                    survey_resource_types = get_resource_types(resource_types, region.lower(), provider.lower())
-                else:
-                    survey_resource_types = get_resource_types(resource_types, "us-gov-east-1", provider.lower())    
-                print("Resource types created for environment " + env_name + " and id: " + acct_id +  " and region: " + region)
-              
-                # Create JSON body  
-                env_def = create_aws_env_def(env_name, provider.lower(), region.lower(), acct_id, survey_resource_types, compliance_families, rolename, interval)
-                print ("JSON body created for environment " + env_name + " and region: " + region)
-                print ("Creating environment for " + env_name + " and id: " + acct_id +  " and region: " + region)
-               
-                #Create environment
-                resp = create_env('environments', env_def)
+                # Render the JSON body from the template compiled for this region
+                payload = compiler.render(region, env_name, acct_id)
+                progress.log("Creating environment for " + env_name + " and id: " + acct_id +  " and region: " + region_label(region))
+
+                # Create environment
+                resp = create_env_encoded('environments', payload)
                     
                 if resp.status_code != 201:
-                    print('Environment creation failed for Account: ' + acct_id + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text) + "\n") 
+                    reporter.error('Environment creation failed for Account: ' + acct_id + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text) + "\n")
                 else:
                     env_id = resp.json()['id'] 
-                    print ('Environment created for Account: ' + acct_id + ' with environment name: ' + resp.json()['name'] + ' and environment id: ' + resp.json()['id'] + "\n") 
+                    progress.log('Environment created for Account: ' + acct_id + ' with environment name: ' + resp.json()['name'] + ' and environment id: ' + resp.json()['id'] + "\n")
+                    reporter.add('created')
+            reporter.add()
+        reporter.finish()
 
 if __name__ == '__main__':
     main()            
\ No newline at end of file
@@ -0,0 +1,196 @@
+# This script is for Python v.3.6 and above
+# The script requires Requests module installed (pip install requests) as well as boto3 (pip install boto3)
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import aws_env_defs
+import fugue_client
+import progress
+import reconcile_environments
+import env_creation_AWS_org
+import env_creation_AWS_govcloud_accounts
+
+# Onboards the accounts of several AWS Organizations, commercial and GovCloud, in a single parallel run.
+# Accounts are discovered from every profile at the same time (using the OU walk, filters and cache settings of
+# env_creation_AWS_org.py), checked against a single catalog of existing Fugue environments and created by one
+# shared pool of workers.
+
+# Common parameters that can be configured as needed
+
+# aws_sources: list of AWS Organizations to onboard. Each entry has the AWS profile used to read the org and the Fugue provider
+    # ("aws" or "aws_govcloud") its accounts are onboarded as. GovCloud profiles must point at a GovCloud region.
+# regions: Regions for the environments of each provider. "*" indicates all supported regions by Fugue.
+# interval: scan interval in seconds. Default is 24hrs
+# rolename: Name of the IAM Role created in the accounts. This assumes the roles have already been created with the
+    # required permission for each of the accounts already exist in the target AWS accounts with the correct policy attached
+# resource_types: List of resources for the given environment. The default value is ALL and that will invoke another Fugue API call
+    # to retrieve the supported list of resources from the API directly.
+# compliance_families: List of complaince families needed per provider https://docs.fugue.co/api.html#api-compliance-format
+# allow_dups: Default = False. Flag to allow duplicate environment creation in Fugue.
+    # If set to False, the existing environments of every provider are retrieved once and only accounts not in Fugue will be created.
+# workers: Number of environments created concurrently across all sources.
+# gzip_payloads: Default = False. If set to True, environment bodies are gzip compressed before they are sent.
+# coalesce_regions: Default = False. If set to True and several regions are listed for a provider, each account gets a single
+    # environment that scans all of them (named "Name - id - N Regions") instead of one environment per region.
+# coalesce_regions_by_ou: Default = {}. Per OU override of coalesce_regions, keyed by OU id or name. The setting of the deepest
+    # OU an account is nested under wins.
+# preflight_roles: Default = False. If set to True, the role of every new account is checked with STS AssumeRole before any
+    # environment is created for it (concurrently and cached, see role_preflight.py) and accounts whose role cannot be assumed
+    # are skipped. The checks use the credentials of the "preflight_profile" of a source if it has one, otherwise the default
+    # AWS credentials.
+# preflight_external_id: Default = None. External ID passed to AssumeRole if the trust policy of the roles requires one.
+# sts_endpoint_url: Default = None. STS endpoint used for the checks, e.g. a local STS stand-in.
+
+aws_sources = [
+    {"profile": "fugueorg", "provider": "aws"},
+    {"profile": "fuguegovorg", "provider": "aws_govcloud"},
+]
+regions = {
+    "aws": ["*"],
+    "aws_govcloud": ["*"],
+}
+rolename = "FugueRiskManager"
+interval = "86400"
+resource_types = ["All"]
+compliance_families = {
+    "aws": ["FBP", "CIS-AWS_v1.3.0"],
+    "aws_govcloud": ["FBP"],
+}
+allow_dups = False
+workers = 16
+gzip_payloads = False
+coalesce_regions = False
+coalesce_regions_by_ou = {}
+preflight_roles = False
+preflight_external_id = None
+sts_endpoint_url = None
+
+# Per provider modules that know how to retrieve the resource type list
+provider_modules = {
+    "aws": env_creation_AWS_org,
+    "aws_govcloud": env_creation_AWS_govcloud_accounts,
+}
+
+# Environment bodies are encoded once per provider and region, see compile_payloads()
+compilers = {}
+
+def get_existing_accounts(provider):
+    """
+    Returns the set of account IDs that already have an environment for provider in Fugue
+    """
+    existing = set()
+    for env in fugue_client.list_environments(provider):
+        existing.add(reconcile_environments.account_from_role_arn(env['provider_options'][provider]['role_arn']))
+    return existing
+
+def env_defs(provider):
+    """
+    Returns the environment definitions of provider for the parameters above, see aws_env_defs.py
+    """
+    module = provider_modules[provider]
+    return aws_env_defs.AwsEnvDefs(provider, regions[provider], rolename, interval, compliance_families[provider],
+                                   lambda region: module.get_resource_types(resource_types, region, provider),
+                                   coalesce=lambda acct_id: env_creation_AWS_org.coalesce_for(acct_id, coalesce_regions, coalesce_regions_by_ou))
+
+def resource_types_for(provider, region):
+    return env_defs(provider).resource_types_for(region)
+
+def compile_payloads(provider):
+    return env_defs(provider).compile_payloads(gzip_payloads)
+
+def env_targets(provider, name, acct_id):
+    return env_defs(provider).env_targets(name, acct_id)
+
+def validated_accounts(source, accounts, checkers):
+    """
+    Returns the accounts of a source whose role can be assumed if preflight_roles is set, otherwise all of
+    them. checkers holds one role checker per preflight profile.
+    """
+    if not preflight_roles:
+        return accounts
+    return aws_env_defs.validated_accounts(accounts, source["provider"], rolename, checkers,
+                                           source.get("preflight_profile"), preflight_external_id, sts_endpoint_url)
+
+def create_environment(provider, env_name, acct_id, region):
+    """
+    Creates the environment for one account and region (or coalesced regions). Returns a tuple of
+    (success, message).
+    """
+    payload = compilers[provider].render(region, env_name, acct_id)
+    resp = fugue_client.post_encoded('environments', payload.body, payload.content_encoding)
+    if resp.status_code != 201:
+        return (False, 'Environment creation failed for Account: ' + acct_id + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text) + "\n")
+    return (True, 'Environment created for Account: ' + acct_id + ' with environment name: ' + resp.json()['name'] + ' and environment id: ' + resp.json()['id'] + "\n")
+
+def main():
+    """
+    Discover the accounts of every AWS Organization in aws_sources concurrently and create an environment for each
+    account and region using one shared pool of workers
+    https://docs.fugue.co/api.html#example-create
+    """
+    providers = sorted(set(source["provider"] for source in aws_sources))
+    for provider in providers:
+        compilers[provider] = compile_payloads(provider)
+
+    with ThreadPoolExecutor(max_workers=len(aws_sources) + len(providers)) as discovery_pool, \
+            ThreadPoolExecutor(max_workers=workers) as creation_pool:
+        # Catalog of (provider, account id) already in Fugue or already queued for creation
+        catalog = set()
+        if allow_dups == False:
+            print ("Duplicate environments are not allowed. Retrieving list of environments and account numbers" + "\n")
+            existing = dict((provider, discovery_pool.submit(get_existing_accounts, provider)) for provider in providers)
+            for provider in providers:
+                accounts_in_fugue = existing[provider].result()
+                print ("Existing " + provider + " account list retrieved (" + str(len(accounts_in_fugue)) + ")" + "\n")
+                catalog.update((provider, acct_id) for acct_id in accounts_in_fugue)
+
+        discoveries = {}
+        for source in aws_sources:
+            future = discovery_pool.submit(env_creation_AWS_org.get_accounts_from_org, source["profile"])
+            discoveries[future] = source
+
+        reporter = progress.Progress('onboard')
+
+        def report_creation(future):
+            if future.exception() is None:
+                ok, message = future.result()
+                if ok:
+                    progress.log(message)
+                else:
+                    reporter.error(message)
+            # Failed creations are done too, so the done count reaches the total
+            reporter.add()
+
+        creations = []
+        checkers = {}
+        while discoveries:
+            done, _ = wait(discoveries, return_when=FIRST_COMPLETED)
+            for future in done:
+                source = discoveries.pop(future)
+                provider = source["provider"]
+                accounts = future.result()
+                print ("Discovered " + str(len(accounts)) + " active accounts with profile " + source["profile"] + "\n")
+                valid_accounts = validated_accounts(source, dict((name, acct_id) for name, acct_id in accounts.items() if (provider, acct_id) not in catalog), checkers)
+                for name, acct_id in accounts.items():
+                    if (provider, acct_id) in catalog:
+                        progress.log("Found Acct id in existing environment list. Skipping environment creation for: " + name + ": " + acct_id)
+                        reporter.add('skipped')
+                        continue
+                    if name not in valid_accounts:
+                        reporter.add('role_check_failed')
+                        continue
+                    if allow_dups == False:
+                        catalog.add((provider, acct_id))
+                    targets = env_targets(provider, name, acct_id)
+                    reporter.add_total(len(targets))
+                    for env_name, region in targets:
+                        creation = creation_pool.submit(create_environment, provider, env_name, acct_id, region)
+                        creation.add_done_callback(report_creation)
+                        creations.append(creation)
+
+        # Raise the first error that kept an environment from being created
+        for creation in creations:
+            creation.result()
+        reporter.finish()
+
+if __name__ == '__main__':
+    main()
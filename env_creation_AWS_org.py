@@ -1,10 +1,18 @@
 # This script is for Python v.3.6 and above 
 # The script requires Requests module installed (pip install requests) as well as boto3 (pip install boto3)
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import json
 import os
-import requests
+import sys
+import threading
+import time
+import fugue_client
 import boto3
+from botocore.config import Config
+import aws_env_defs
+import progress
+import reconcile_environments
 
 # Common parameters that can be configured as needed 
 
@@ -22,8 +30,30 @@ import boto3
 # compliance_families: List of complaince families needed https://docs.fugue.co/api.html#api-compliance-format
 # allow_dups: Default = False. Flag to allow duplicate environment creation in Fugue. 
     # If set to False, a list of existing environment will be retrieved from Fugue and only accounts not in Fugue will be created.  
+# reconcile: Default = False. If set to True, existing environments are compared with the active accounts in the org and only
+    # the difference is applied: missing environments are created and environments with changed settings (e.g. resource types or
+    # compliance families) are updated in place instead of being recreated.
+# delete_orphans: Default = False. Only used with reconcile. If set to True, existing AWS environments for accounts and regions
+    # that are not in the org (or no longer active) are deleted. Ignored when ou_include or ou_exclude is set, since the
+    # environments of accounts outside the selected OUs cannot be told apart from orphans (see orphan_cleanup.py).
 
 # aws_profile_name: the profile name for AWS Org that allows the script to extract the list of active AWS accounts 
+# ou_include: Default = [] (whole org). List of OU ids or names, e.g. ["ou-ab12-34cd56ef", "Production"]. Only accounts in these OUs
+    # and the OUs nested under them are onboarded.
+# ou_exclude: Default = []. List of OU ids or names that are skipped along with every OU nested under them.
+# discovery_workers: Number of OUs listed concurrently while walking the org tree.
+# org_cache_file / org_cache_ttl: Discovered accounts are cached in org_cache_file for org_cache_ttl seconds so repeat runs
+    # don't walk the org again. Set org_cache_ttl to 0 to disable the cache.
+# gzip_payloads: Default = False. If set to True, environment bodies are gzip compressed before they are sent.
+# coalesce_regions: Default = False. If set to True and several regions are listed, each account gets a single environment
+    # that scans all of them (named "Name - id - N Regions") instead of one environment per region.
+# coalesce_regions_by_ou: Default = {}. Per OU override of coalesce_regions, keyed by OU id or name, e.g.
+    # {"Sandbox": True, "ou-ab12-34cd56ef": False}. The setting of the deepest OU an account is nested under wins.
+# preflight_roles: Default = False. If set to True, the role of every new account is checked with STS AssumeRole before any
+    # environment is created (concurrently and cached, see role_preflight.py) and accounts whose role cannot be assumed are skipped.
+# preflight_profile: Default = None (default AWS credentials). AWS profile whose credentials are used to assume the roles.
+# preflight_external_id: Default = None. External ID passed to AssumeRole if the trust policy of the roles requires one.
+# sts_endpoint_url: Default = None. STS endpoint used for the checks, e.g. a regional endpoint or a local STS stand-in.
 
 provider = "aws"
 regions = ["*"]
@@ -32,53 +62,164 @@ interval = "86400"
 resource_types = ["All"] 
 compliance_families = ["FBP","CIS-AWS_v1.3.0"]
 allow_dups = False
+reconcile = False
+delete_orphans = False
 aws_profile_name = "fugueorg"
+ou_include = []
+ou_exclude = []
+discovery_workers = 8
+org_cache_file = ".aws_org_accounts_cache.json"
+org_cache_ttl = 3600
+gzip_payloads = False
+coalesce_regions = False
+coalesce_regions_by_ou = {}
+preflight_roles = False
+preflight_profile = None
+preflight_external_id = None
+sts_endpoint_url = None
 
-# Fugue API base URL
-api_url = "https://api.riskmanager.fugue.co"
-api_ver = 'v0'
+org_cache_lock = threading.Lock()
 
-# Client ID and secret used to authenticate with Fugue. Follow the guide here
-# to create an API client: https://docs.fugue.co/api.html#getting-started
-# You can set these values via environment variables or replace the os.getenv
-# calls below with the string values themselves.
-client_id = os.getenv('FUGUE_API_ID')
-client_secret = os.getenv('FUGUE_API_SECRET')
+# OU path (ids and names, from the root down) of every discovered account, filled by get_accounts_from_org()
+account_ou_paths = {}
 
-if not client_id or not client_secret:
-    print('Please follow the user guide at https://docs.fugue.co/api.html#api-user-guide to set \'FUGUE_API_ID\' and \'FUGUE_API_SECRET\'')
-    exit(1)
+# Role checkers shared by all the preflight checks of a run, by profile, see validated_accounts()
+role_checkers = {}
 
+# The Fugue API URL and credentials are handled by fugue_client.py. Client ID and secret are read from the
+# FUGUE_API_ID and FUGUE_API_SECRET environment variables when the first request is made, follow the guide here
+# to create an API client: https://docs.fugue.co/api.html#getting-started
 
-# Authentication
-# https://docs.fugue.co/api.html#auth-n
-auth = (client_id, client_secret)
+def list_children(org_client, parent_id, include_accounts):
+    """
+    Lists the OUs directly under parent_id and, if include_accounts is set, the
+    accounts directly under it. Returns a tuple of (ous, accounts).
+    """
+    ous = []
+    for page in org_client.get_paginator("list_organizational_units_for_parent").paginate(ParentId=parent_id):
+        ous += page["OrganizationalUnits"]
+    accounts = []
+    if include_accounts:
+        for page in org_client.get_paginator("list_accounts_for_parent").paginate(ParentId=parent_id):
+            accounts += page["Accounts"]
+    return ous, accounts
 
-def get_accounts_from_org(profile):
-    session = boto3.Session(profile_name=profile)
-    org_client = session.client("organizations")
+def discover_accounts(org_client, include=None, exclude=None, workers=8):
+    """
+    Walks the OU tree from the organization root, listing the children of
+    every OU concurrently. OUs in include/exclude can be given by id or name;
+    excluded OUs are skipped along with everything under them. When include is
+    set, only accounts in the included OUs (and the OUs under them) are listed.
+    Returns the list of accounts found, each with an "OuPath" list of the ids
+    and names of the OUs it is nested under.
+    """
+    include = set(include or [])
+    exclude = set(exclude or [])
     accounts_in_org = []
-    accounts_list = {}
-    response = org_client.list_accounts()
+    roots = org_client.list_roots()["Roots"]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Each pending future maps to whether the OU it lists is inside an included subtree and the OU path down to it
+        pending = {}
+        for root in roots:
+            included = not include or root["Id"] in include or root.get("Name") in include
+            pending[pool.submit(list_children, org_client, root["Id"], included)] = (included, [root["Id"]])
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                parent_included, path = pending.pop(future)
+                ous, accounts = future.result()
+                for account in accounts:
+                    account["OuPath"] = path
+                accounts_in_org += accounts
+                for ou in ous:
+                    if ou["Id"] in exclude or ou["Name"] in exclude:
+                        continue
+                    included = parent_included or ou["Id"] in include or ou["Name"] in include
+                    pending[pool.submit(list_children, org_client, ou["Id"], included)] = (included, path + [ou["Id"], ou["Name"]])
+
+    return accounts_in_org
+
+def load_cached_accounts(cache_key):
+    """
+    Returns the accounts and their OU paths cached for cache_key if they are
+    younger than org_cache_ttl seconds, otherwise None.
+    """
+    if not org_cache_ttl or not os.path.exists(org_cache_file):
+        return None
+    try:
+        with open(org_cache_file) as f:
+            entry = json.load(f).get(cache_key)
+    except ValueError:
+        return None
+    # Entries written before OU paths were cached are refreshed
+    if entry and "account_ous" in entry and time.time() - entry["fetched_at"] < org_cache_ttl:
+        return entry["accounts"], entry["account_ous"]
+    return None
 
-    while response:
-        accounts_in_org += response["Accounts"]
-        response = org_client.list_accounts(NextToken=response['NextToken']) if 'NextToken' in response else None
-    for account in accounts_in_org:
+def save_cached_accounts(cache_key, accounts_list, account_ous):
+    if not org_cache_ttl:
+        return
+    # Several orgs can be discovered at once (see env_creation_AWS_multi_org.py) so serialize updates to the file
+    with org_cache_lock:
+        cache = {}
+        if os.path.exists(org_cache_file):
+            try:
+                with open(org_cache_file) as f:
+                    cache = json.load(f)
+            except ValueError:
+                cache = {}
+        cache[cache_key] = {"fetched_at": time.time(), "accounts": accounts_list, "account_ous": account_ous}
+        with open(org_cache_file, "w") as f:
+            json.dump(cache, f)
+
+def get_accounts_from_org(profile, org_client=None):
+    """
+    Returns a map of active account names and ids in the AWS Organization,
+    limited to ou_include/ou_exclude and cached for org_cache_ttl seconds
+    """
+    cache_key = "|".join([profile or "", ",".join(sorted(ou_include)), ",".join(sorted(ou_exclude))])
+    cached = load_cached_accounts(cache_key)
+    if cached is not None:
+        accounts_list, account_ous = cached
+        print ("Using cached AWS Organizations accounts (" + str(len(accounts_list)) + ") from " + org_cache_file + "\n")
+        account_ou_paths.update(account_ous)
+        return accounts_list
+
+    if org_client is None:
+        session = boto3.Session(profile_name=profile)
+        org_client = session.client("organizations", config=Config(retries={"max_attempts": 10, "mode": "standard"}))
+    accounts_list = {}
+    account_ous = {}
+    for account in discover_accounts(org_client, ou_include, ou_exclude, discovery_workers):
         name = account["Name"]
         id = account["Id"]
         if account["Status"] == "ACTIVE":
             accounts_list[name] = id
-            
+            account_ous[id] = account["OuPath"]
+
+    save_cached_accounts(cache_key, accounts_list, account_ous)
+    account_ou_paths.update(account_ous)
     return accounts_list
 
+def coalesce_for(acct_id, default=None, by_ou=None):
+    """
+    Returns whether the regions of an account are coalesced into a single environment: the
+    setting of the deepest OU in by_ou the account is nested under, or default
+    """
+    setting = coalesce_regions if default is None else default
+    by_ou = coalesce_regions_by_ou if by_ou is None else by_ou
+    for ou in account_ou_paths.get(acct_id, []):
+        if ou in by_ou:
+            setting = by_ou[ou]
+    return setting
+
 def get(path, params=None):
     """
     Executes an authenticated GET request to the Fugue API with the provided
     API path and query parameters.
     """
-    url = '%s/%s/%s' % (api_url, api_ver, path.strip('/'))
-    return requests.get(url, params=params, auth=auth).json()
+    return fugue_client.get(path, params=params)
 
 def get_account_list(provider):
     """
@@ -113,8 +254,14 @@ def create_env(path, json=None):
     Executes an authenticated POST request to the Fugue API with the provided
     API path and json to create an environment.
     """
-    url = '%s/%s/%s' % (api_url, api_ver, path.strip('/'))
-    return requests.post(url, auth=auth, json=json)
+    return fugue_client.post(path, json=json)
+
+def create_env_encoded(path, payload):
+    """
+    Executes an authenticated POST request to the Fugue API with a pre-encoded
+    environment body from compile_payloads().
+    """
+    return fugue_client.post_encoded(path, payload.body, payload.content_encoding)
 
 def get_resource_types(resource_types, region, provider):
     """
@@ -126,86 +273,107 @@ def get_resource_types(resource_types, region, provider):
         'region': region,
         'beta_resources': "true"
     }
-        survey_resource_types = get('metadata/' + provider + '/resource_types', params=params)['resource_types']
+        survey_resource_types = list(fugue_client.get_items('metadata/' + provider + '/resource_types', params=params, key='resource_types'))
     else: 
         survey_resource_types = resource_types
 
     return survey_resource_types    
 
+def env_defs():
+    """
+    Returns the environment definitions for the parameters above, see aws_env_defs.py
+    """
+    return aws_env_defs.AwsEnvDefs(provider, regions, rolename, interval, compliance_families,
+                                   lambda region: get_resource_types(resource_types, region, provider.lower()),
+                                   coalesce=coalesce_for)
+
 def create_aws_env_def(env_name, provider, region, accountid, resource_types, compliance_families, rolename, interval=0):
-    if interval != 0:
-        scan_schedule_enabled = True
-    else: 
-        scan_schedule_enabled =  False     
-    
-    body = {
-        "name": env_name,
-        "provider": provider,
-        "provider_options": {
-            provider: {
-            "regions": [region],
-            "role_arn": "arn:aws:iam::" + accountid + ":role/" + rolename
-            }
-        },
-        "compliance_families": compliance_families,
-        "survey_resource_types": resource_types,
-        "remediate_resource_types": [],
-        "scan_schedule_enabled": bool(scan_schedule_enabled),
-        "scan_interval": int(interval)
-        }
-    return body
+    return aws_env_defs.create_aws_env_def(env_name, provider, region, accountid, resource_types, compliance_families, rolename, interval)
+
+def env_targets(name, acct_id):
+    return env_defs().env_targets(name, acct_id)
+
+def region_label(region):
+    return aws_env_defs.region_label(region)
+
+def resource_types_for(region):
+    return env_defs().resource_types_for(region)
+
+def compile_payloads():
+    return env_defs().compile_payloads(gzip_payloads)
+
+def encoded_env_defs(accounts, compiler):
+    return env_defs().encoded_env_defs(accounts, compiler)
+
+def desired_env_defs(accounts):
+    return env_defs().desired_env_defs(accounts)
+
+def validated_accounts(accounts_to_check):
+    """
+    Returns the accounts whose role can be assumed if preflight_roles is set, otherwise all of them
+    """
+    if not preflight_roles:
+        return accounts_to_check
+    return aws_env_defs.validated_accounts(accounts_to_check, provider.lower(), rolename, role_checkers,
+                                           preflight_profile, preflight_external_id, sts_endpoint_url)
 
 def main():
-   """
+    """
     Loop through each account and region to create an environment using Fugue API
     https://docs.fugue.co/api.html#example-create
     """
-    
-if provider.lower() == "azure" or provider.lower() == "aws_govcloud":
+    if provider.lower() == "azure" or provider.lower() == "aws_govcloud":
         print ("This script is only for AWS environment creation")
-else:
-    accounts= get_accounts_from_org(aws_profile_name)
-    
-    # If allow_dups = False, get list of AWS envrionments from Fugue and extract the AWS account ID from Role ARN
-    if allow_dups == False:
-        print ("Duplicate environments are not allowed." + "\n" + "Retrieving list of environments and account numbers" + "\n") 
-        existing_account_list = get_account_list(provider)  
-        print ("Existing account list retrieved (" + str(len(existing_account_list)) + ")" + "\n")   
-
-    for name, acct_id in accounts.items():
-        if allow_dups == False and acct_id in existing_account_list:   
-            print ("Found Acct id in existing environment list. Skipping environment creation for: " + name + ": " + acct_id)
-        else:
-            print ("Creating environment for account id: " + acct_id)            
+    elif reconcile:
+        # Only create, update (and optionally delete) the environments that differ from the active accounts in the org
+        accounts = get_accounts_from_org(aws_profile_name)
+        allow_deletes = delete_orphans
+        if delete_orphans and (ou_include or ou_exclude):
+            # Only part of the org was discovered, every environment of an account outside it would look orphaned
+            print ("delete_orphans is ignored when ou_include or ou_exclude is set, no environment will be deleted" + "\n")
+            allow_deletes = False
+        reconcile_environments.reconcile(provider.lower(), desired_env_defs(accounts), allow_deletes=allow_deletes)
+    else:
+        accounts= get_accounts_from_org(aws_profile_name)
+
+        # If allow_dups = False, get list of AWS envrionments from Fugue and extract the AWS account ID from Role ARN
+        if allow_dups == False:
+            print ("Duplicate environments are not allowed." + "\n" + "Retrieving list of environments and account numbers" + "\n") 
+            existing_account_list = get_account_list(provider)  
+            print ("Existing account list retrieved (" + str(len(existing_account_list)) + ")" + "\n")   
+
+        # Check the roles of the accounts to create before any environment is created
+        valid_accounts = validated_accounts(dict((name, acct_id) for name, acct_id in accounts.items() if allow_dups or acct_id not in existing_account_list))
+
+        compiler = compile_payloads()
+        reporter = progress.Progress('onboard', total=len(accounts), unit='accounts')
+        for name, acct_id in accounts.items():
+            if allow_dups == False and acct_id in existing_account_list:   
+                progress.log("Found Acct id in existing environment list. Skipping environment creation for: " + name + ": " + acct_id)
+                reporter.add('skipped')
+            elif name not in valid_accounts:
+                reporter.add('role_check_failed')
+            else:
+                progress.log("Creating environment for account id: " + acct_id)
             
-            for region in regions: 
-                # Set environment name
-                if region == "*": 
-                    env_name = name + " - " + acct_id + " - " + "All Regions"
-                else:
-                    env_name = name + " - " + acct_id + " - " + region
-                print("Starting on creation for environment " + env_name + " and id: " + acct_id +  " and region: " + region)
+                for env_name, region in env_targets(name, acct_id):
+                    progress.log("Starting on creation for environment " + env_name + " and id: " + acct_id +  " and region: " + region_label(region))
                     
-                # Get resource types from Fugue API based on provider and region
-                if region != "*":
-                        survey_resource_types = get_resource_types(resource_types, region.lower(), provider.lower())
-                else:
-                        survey_resource_types = get_resource_types(resource_types, "us-east-1", provider.lower())    
-                print("Resource types created for environment " + env_name + " and id: " + acct_id +  " and region: " + region)
-
-                # Create JSON body  
-                env_def = create_aws_env_def(env_name, provider.lower(), region.lower(), acct_id, survey_resource_types, compliance_families, rolename, interval)
-                print ("JSON body created for environment " + env_name + " and region: " + region)
-                print ("Creating environment for " + env_name + " and id: " + acct_id +  " and region: " + region)
-                
-                # Create environment
-                resp = create_env('environments', env_def)
+                    # Render the JSON body from the template compiled for this region
+                    payload = compiler.render(region, env_name, acct_id)
+                    progress.log("Creating environment for " + env_name + " and id: " + acct_id +  " and region: " + region_label(region))
+
+                    # Create environment
+                    resp = create_env_encoded('environments', payload)
                     
-                if resp.status_code != 201:
-                    print('Environment creation failed for Account: ' + acct_id + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text) + "\n") 
-                else:
-                    env_id =resp.json()['id'] 
-                    print ('Environment created for Account: ' + acct_id + ' with environment name: ' + resp.json()['name'] + ' and environment id: ' + resp.json()['id'] + "\n") 
- 
+                    if resp.status_code != 201:
+                        reporter.error('Environment creation failed for Account: ' + acct_id + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text) + "\n")
+                    else:
+                        env_id =resp.json()['id'] 
+                        progress.log('Environment created for Account: ' + acct_id + ' with environment name: ' + resp.json()['name'] + ' and environment id: ' + resp.json()['id'] + "\n")
+                        reporter.add('created')
+            reporter.add()
+        reporter.finish()
+
 if __name__ == '__main__':
-    main()            
+    main()
\ No newline at end of file
@@ -2,7 +2,12 @@
 
 import json
 import os
-import requests
+import sys
+import fugue_client
+import progress
+import reconcile_environments
+import azure_subscription_discovery
+import inventory_ingest
 import getpass
 
 # Common parameters that can be configured as needed 
@@ -16,55 +21,66 @@ import getpass
 # For selective resource groups, use the format ["example-rg","another-rg"] 
 # Environments are created with the App name. Details on how to create these: https://docs.fugue.co/setupazure.html#step-2a-connect-to-azure
 # allow_dups: Default = False. Flag to allow duplicate environment creation in Fugue. 
-    # If set to False, a list of existing environment will be retrieved from Fugue and only applications not in Fugue will be created.  
+    # If set to False, a list of existing environment will be retrieved from Fugue and only subscriptions not in Fugue will be created.  
+# reconcile: Default = False. If set to True, existing environments are compared with the subscriptions below and only the
+# difference is applied: missing environments are created and environments with changed settings (e.g. compliance families or
+# scan interval) are updated in place instead of being recreated.
+# delete_orphans: Default = False. Only used with reconcile. If set to True, existing Azure environments for subscriptions that are
+# not listed below are deleted.
+# auto_discover: Default = False. If set to True, the subscriptions map is ignored and every enabled subscription visible to the
+# service principals below is onboarded instead. Environments are created with the names in the format "Subscription Name - id".
+# service_principals: map of Azure Application Name, credentials and Resource Groups used for discovery in the format
+# "App Name": ["Tenant Id", "Application ID", [Resource Groups]]. The client secret entered at the prompt is used for all of them.
+# discover_all_tenants: Default = False. If set to True, subscriptions are also discovered in every other tenant the service
+# principals have access to, not only their home tenant.
+# discovery_workers: Number of service principals and tenants enumerated concurrently.
+# inventory_file: Default = None. Path to a CSV, NDJSON or YAML inventory with "name", "tenant_id", "subscription_id",
+# "application_id" and optionally "resource_groups" (";" separated in CSV, default "*") columns to use instead of the
+# subscriptions map. Rows are streamed and validated one at a time and created in chunks, so very large inventories are
+# processed in constant memory.
+# inventory_chunk_size: Number of inventory rows created per chunk.
+# workers: Number of environments created concurrently for an inventory file.
 
 provider = "azure"
 interval = "86400"
 compliance_families = ["CISAZURE"]
 allow_dups = False
+reconcile = False
+delete_orphans = False
 subscriptions = {
     "Prod App": ["tenant id", "subscription id", "app id", ["*"]],
     "Dev App": ["2", "2", "2", ["example-rg","another-rg"]],
     "QA App": ["3", "3", "3", ["example-rg","another-rg"]]
 }
+auto_discover = False
+discover_all_tenants = False
+discovery_workers = 8
+inventory_file = None
+inventory_chunk_size = 500
+workers = 8
+service_principals = {
+    "Prod App": ["tenant id", "app id", ["*"]]
+}
 
 
-# Fugue API base URL
-api_url = "https://api.riskmanager.fugue.co"
-api_ver = 'v0'
-
-# Client ID and secret used to authenticate with Fugue. Follow the guide here
+# The Fugue API URL and credentials are handled by fugue_client.py. Client ID and secret are read from the
+# FUGUE_API_ID and FUGUE_API_SECRET environment variables when the first request is made, follow the guide here
 # to create an API client: https://docs.fugue.co/api.html#getting-started
-# You can set these values via environment variables or replace the os.getenv
-# calls below with the string values themselves.
-client_id = os.getenv('FUGUE_API_ID')
-client_secret = os.getenv('FUGUE_API_SECRET')
-
-if not client_id or not client_secret:
-    print('Please follow the user guide at https://docs.fugue.co/api.html#api-user-guide to set \'FUGUE_API_ID\' and \'FUGUE_API_SECRET\'')
-    exit(1)
-
-
-# Authentication
-# https://docs.fugue.co/api.html#auth-n
-auth = (client_id, client_secret)
 
 def get(path, params=None):
     """
     Executes an authenticated GET request to the Fugue API with the provided
     API path and query parameters.
     """
-    url = '%s/%s/%s' % (api_url, api_ver, path.strip('/'))
-    return requests.get(url, params=params, auth=auth).json()
+    return fugue_client.get(path, params=params)
 
-def get_app_list(provider):
+def get_subscription_list(provider):
     """
-        Get list of Azure environments in Fugue tenant and extract the Applications IDs from the credentials.   
+        Get list of Azure environments in Fugue tenant and extract the Subscription IDs from the credentials.   
     """
     offset = 0
-    max_items = 1
-    app_id_list = []
-    env_id = []
+    max_items = 100
+    subscription_id_list = []
     is_truncated = True
     
     while is_truncated: 
@@ -79,19 +95,41 @@ def get_app_list(provider):
                 sys.exit("Error:" + error) 
         else: 
             for env in env_list['items']:
-                app_id_list.append(env['provider_options']['azure']['application_id'])
+                subscription_id_list.append(env['provider_options']['azure']['subscription_id'])
             offset = env_list['next_offset']
             is_truncated = env_list['is_truncated']
     
-    return app_id_list
+    return subscription_id_list
+
+def get_subscriptions_from_discovery(key):
+    """
+    Returns the subscriptions visible to the service principals, in the same format as the subscriptions map
+    """
+    principals = []
+    for name, provider_options in service_principals.items():
+        principals.append({
+            'name': name,
+            'tenant_id': provider_options[0],
+            'application_id': provider_options[1],
+            'client_secret': key,
+            'resource_groups': provider_options[2],
+        })
+    discovered = azure_subscription_discovery.discover_subscriptions(principals, discover_all_tenants, discovery_workers)
+    print ("TOTAL DISCOVERED SUBSCRIPTIONS: " + str(len(discovered)) + "\n")
+
+    discovered_subscriptions = {}
+    for sub_id, sub in discovered.items():
+        principal = sub['principal']
+        env_name = sub['display_name'] + " - " + sub_id
+        discovered_subscriptions[env_name] = [sub['tenant_id'], sub_id, principal['application_id'], principal['resource_groups']]
+    return discovered_subscriptions
 
 def create_env(path, json=None):
     """
     Executes an authenticated POST request to the Fugue API with the provided
     API path and json to create an environment.
     """
-    url = '%s/%s/%s' % (api_url, api_ver, path.strip('/'))
-    return requests.post(url, auth=auth, json=json)
+    return fugue_client.post(path, json=json)
 
 
 def create_azure_env_def(env_name, provider, credentials, compliance_families, resource_groups, interval=0):
@@ -118,6 +156,23 @@ def create_azure_env_def(env_name, provider, credentials, compliance_families, r
         }
     return body
 
+def desired_env_defs(subscriptions, key):
+    """
+    Generator that yields the environment definition for every subscription using the client secret entered at the prompt
+    """
+    for name, provider_options in subscriptions.items():
+        credentials = provider_options[0:3]
+        credentials.append(key)
+        resource_groups = provider_options[3]
+        yield create_azure_env_def(name, provider.lower(), credentials, compliance_families, resource_groups, interval)
+
+def load_inventory():
+    """
+    Returns the subscriptions in inventory_file, read lazily and validated row by row, in the same format as the subscriptions map
+    """
+    return inventory_ingest.Inventory(inventory_file, ["name", "tenant_id", "subscription_id", "application_id"],
+        lambda row: [row["tenant_id"], row["subscription_id"], row["application_id"], inventory_ingest.as_list(row.get("resource_groups") or "*")])
+
 def main():
     """
     Loop through each account and region to create an environment using Fugue API
@@ -135,37 +190,61 @@ def main():
                 print ("Key entered manually")
             else:
                 exit("Secret was not entered.")   
-        
-        # If allow_dups = False, get list of Azure envrionments from Fugue and extract the application ID from credentials
-        if allow_dups == False:
-           print ("Duplicate environments are not allowed. Retrieving list of environments and application id" + "\n") 
-           existing_app_list = get_app_list(provider)  
-           print ("Existing applications list retrieved (" + str(len(existing_app_list)) + ")" + "\n") 
 
-        for name, provider_options in subscriptions.items():
+        targets = subscriptions
+        if auto_discover:
+            targets = get_subscriptions_from_discovery(key)
+        elif inventory_file:
+            targets = load_inventory()
+
+        if reconcile:
+            # Only create, update (and optionally delete) the environments that differ from the subscriptions above
+            reconcile_environments.reconcile(provider.lower(), desired_env_defs(targets, key), allow_deletes=delete_orphans)
+            return
+
+        # If allow_dups = False, get list of Azure envrionments from Fugue and extract the subscription ID from credentials
+        existing_subscription_list = set()
+        if allow_dups == False:
+           print ("Duplicate environments are not allowed. Retrieving list of environments and subscription id" + "\n") 
+           existing_subscription_list = set(get_subscription_list(provider))
+           print ("Existing subscriptions list retrieved (" + str(len(existing_subscription_list)) + ")" + "\n") 
+
+        if inventory_file and not auto_discover:
+            # Stream the subscriptions from the inventory file straight into creation, one chunk at a time
+            inventory_ingest.create_from_inventory(targets, lambda chunk: desired_env_defs(chunk, key), existing_subscription_list if allow_dups == False else None,
+                lambda provider_options: provider_options[1], inventory_chunk_size, workers)
+            return
+
+        reporter = progress.Progress('onboard', total=len(targets), unit='subscriptions')
+        for name, provider_options in targets.items():
             # Set environment name and credentials
             env_name = name
             credentials = provider_options[0:3]
-            app_id = provider_options[2]
+            subscription_id = provider_options[1]
             credentials.append(key)
             resource_groups = provider_options[3]
 
-            if allow_dups == False and app_id in existing_app_list:   
-                print ("Found application id in existing environment list. Skipping environment creation for - " + name + ": " + app_id + "\n")
+            if allow_dups == False and subscription_id in existing_subscription_list:   
+                progress.log("Found subscription id in existing environment list. Skipping environment creation for - " + name + ": " + subscription_id + "\n")
+                reporter.add('skipped')
             else:
-                print("Starting creation for environment " + env_name)
+                existing_subscription_list.add(subscription_id)
+                progress.log("Starting creation for environment " + env_name)
                 # Create JSON body  
                 env_def = create_azure_env_def(env_name, provider.lower(), credentials, compliance_families, resource_groups, interval)
-                print ("JSON body created for environment " + env_name )
+                progress.log("JSON body created for environment " + env_name )
                     
                 #Create environment
                 resp = create_env('environments', env_def)
                         
                 if resp.status_code != 201:
-                    print('Environment creation failed for App: ' + name + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text) + "\n") 
+                    reporter.error('Environment creation failed for App: ' + name + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text) + "\n")
                 else:
                     env_id = resp.json()['id'] 
-                    print ('Environment created for App: ' + name + ' with environment name: ' + resp.json()['name'] + ' and environment id: ' + resp.json()['id'] + "\n") 
+                    progress.log('Environment created for App: ' + name + ' with environment name: ' + resp.json()['name'] + ' and environment id: ' + resp.json()['id'] + "\n")
+                    reporter.add('created')
+            reporter.add()
+        reporter.finish()
 
 if __name__ == '__main__':
     main()            
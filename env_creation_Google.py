@@ -3,8 +3,14 @@
 
 import json
 import os
-import requests
+import sys
+import queue
+import threading
+import fugue_client
 from google.cloud import resource_manager
+import progress
+import reconcile_environments
+import inventory_ingest
 
 # Common parameters that can be configured as needed 
 
@@ -18,6 +24,18 @@ from google.cloud import resource_manager
     # names in the format "Name - id" 
 # allow_dups: Default = False. Flag to allow duplicate environment creation in Fugue. 
     # If set to False, a list of existing environment will be retrieved from Fugue and only accounts not in Fugue will be created.  
+# reconcile: Default = False. If set to True, existing environments are compared with the active projects in the org and only
+    # the difference is applied: missing environments are created and environments with changed settings (e.g. compliance
+    # families or scan interval) are updated in place instead of being recreated.
+# delete_orphans: Default = False. Only used with reconcile. If set to True, existing Google environments for projects that are
+    # not active in the org are deleted.
+# workers: Number of environments created concurrently. Projects are created as they are discovered instead of after the whole
+    # org has been listed.
+# queue_size: Maximum number of discovered projects waiting for a worker. Discovery pauses while the queue is full, so memory
+    # use stays flat for large orgs.
+# inventory_file: Default = None. Path to a CSV, NDJSON or YAML inventory with "name" and "project_id" columns to onboard instead
+    # of the active projects in the org. Rows are streamed and validated one at a time straight to the creation workers, so very
+    # large inventories are processed in constant memory.
 
 
 provider = "google"
@@ -26,30 +44,19 @@ service_account_email_keyfile = "path to JSON key file"
 interval = "86400"
 compliance_families = ["CIS-Google_v1.1.0"]
 allow_dups = False
+reconcile = False
+delete_orphans = False
+workers = 8
+queue_size = 100
+inventory_file = None
 # projects = {
 #     "Prod Project": "ultra-depot-307716",
 #     "Dev Project": "5678"
 # }
 
-# Fugue API base URL
-api_url = "https://api.riskmanager.fugue.co"
-api_ver = 'v0'
-
-# Client ID and secret used to authenticate with Fugue. Follow the guide here
+# The Fugue API URL and credentials are handled by fugue_client.py. Client ID and secret are read from the
+# FUGUE_API_ID and FUGUE_API_SECRET environment variables when the first request is made, follow the guide here
 # to create an API client: https://docs.fugue.co/api.html#getting-started
-# You can set these values via environment variables or replace the os.getenv
-# calls below with the string values themselves.
-client_id = os.getenv('FUGUE_API_ID')
-client_secret = os.getenv('FUGUE_API_SECRET')
-
-if not client_id or not client_secret:
-    print('Please follow the user guide at https://docs.fugue.co/api.html#api-user-guide to set \'FUGUE_API_ID\' and \'FUGUE_API_SECRET\'')
-    exit(1)
-
-
-# Authentication
-# https://docs.fugue.co/api.html#auth-n
-auth = (client_id, client_secret)
 
 def get_projects_from_org():
     projects_in_org = []
@@ -63,16 +70,45 @@ def get_projects_from_org():
         id = project.project_id
         project_list[name] = id
     print ("TOTAL ACTIVE PROJECTS: " + str(response.num_results))
-    print (project_list)
     return project_list
 
+def stream_projects_from_org(project_queue, org_client=None):
+    """
+    Puts the (name, id) of every active project in the org on project_queue as the
+    listing is paged through. Returns the number of projects found.
+    """
+    env_filter = {'lifecycleState': 'Active'}
+    if org_client is None:
+        org_client = resource_manager.Client.from_service_account_json(service_account_email_keyfile)
+    count = 0
+    for project in org_client.list_projects(env_filter):
+        project_queue.put((project.name, project.project_id))
+        count += 1
+    return count
+
+def load_inventory():
+    """
+    Returns the projects in inventory_file, read lazily and validated row by row
+    """
+    return inventory_ingest.Inventory(inventory_file, ["name", "project_id"], lambda row: str(row["project_id"]).strip())
+
+def stream_projects_from_inventory(project_queue):
+    """
+    Puts the (name, id) of every valid project in inventory_file on project_queue as the file is read.
+    Returns the number of projects found.
+    """
+    count = 0
+    for name, proj_id in load_inventory().items():
+        project_queue.put((name, proj_id))
+        count += 1
+    return count
+
 def get(path, params=None):
     """
     Executes an authenticated GET request to the Fugue API with the provided
     API path and query parameters.
     """
-    url = '%s/%s/%s' % (api_url, api_ver, path.strip('/'))
-    return requests.get(url, params=params, auth=auth).json()
+    return fugue_client.get(path, params=params)
 
 def get_project_list(provider):
     """
@@ -97,7 +133,7 @@ def get_project_list(provider):
         else: 
             for env in env_list['items']:
                 project_id_list.append(env['provider_options']['google']['project_id'])
-                print (env['provider_options']['google']['project_id'])
+                progress.log(env['provider_options']['google']['project_id'])
             offset = env_list['next_offset']
             is_truncated = env_list['is_truncated']
 
@@ -108,8 +144,7 @@ def create_env(path, json=None):
     Executes an authenticated POST request to the Fugue API with the provided
     API path and json to create an environment.
     """
-    url = '%s/%s/%s' % (api_url, api_ver, path.strip('/'))
-    return requests.post(url, auth=auth, json=json)
+    return fugue_client.post(path, json=json)
 
 
 def create_google_env_def(env_name, provider, projectid, compliance_families, service_account_email, interval=0):
@@ -133,6 +168,61 @@ def create_google_env_def(env_name, provider, projectid, compliance_families, se
         }
     return body
 
+def desired_env_defs(projects):
+    """
+    Generator that yields the environment definition for every project
+    """
+    for name, proj_id in projects.items():
+        env_name = name + " - " + proj_id
+        yield create_google_env_def(env_name, provider.lower(), proj_id, compliance_families, service_account_email, interval)
+
+def create_project_env(name, proj_id):
+    """
+    Creates the environment for a single project. Returns a tuple of (success, message).
+    """
+    env_name = name + " - " + proj_id
+    progress.log("Starting on creation for environment " + env_name + " and id: " + proj_id)
+
+    # Create JSON body  
+    env_def = create_google_env_def(env_name, provider.lower(), proj_id, compliance_families, service_account_email, interval)
+
+    #Create environment
+    resp = create_env('environments', env_def)
+
+    if resp.status_code != 201:
+        return (False, 'Environment creation failed for Project: ' + proj_id + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text) + "\n")
+    return (True, 'Environment created for Project: ' + proj_id + ' with environment name: ' + resp.json()['name'] + ' and environment id: ' + resp.json()['id'] + "\n")
+
+def creation_worker(project_queue, catalog, catalog_lock, reporter):
+    """
+    Takes discovered projects off project_queue until it receives None, skipping projects whose
+    id is already in catalog (existing environments and projects already handled by a worker)
+    and counting them on reporter
+    """
+    while True:
+        item = project_queue.get()
+        if item is None:
+            break
+        name, proj_id = item
+        with catalog_lock:
+            duplicate = proj_id in catalog
+            if allow_dups == False:
+                catalog.add(proj_id)
+        if duplicate:
+            progress.log("Found project id in existing environment list. Skipping environment creation for - " + name + ": " + proj_id)
+            reporter.add('skipped')
+        else:
+            try:
+                ok, message = create_project_env(name, proj_id)
+            except Exception as error:
+                ok, message = False, "Environment creation failed for Project: " + proj_id + " with error: " + str(error) + "\n"
+            if ok:
+                progress.log(message)
+                reporter.add('created')
+            else:
+                reporter.error(message)
+        reporter.add()
+
 def main():
     """
     Loop through each account and region to create an environment using Fugue API
@@ -140,36 +230,38 @@ def main():
     """
     if provider.lower() != "google":
         print ("This script is only for Google environment creation")
+    elif reconcile:
+        # Only create, update (and optionally delete) the environments that differ from the active projects in the org
+        projects = load_inventory() if inventory_file else get_projects_from_org()
+        reconcile_environments.reconcile(provider.lower(), desired_env_defs(projects), allow_deletes=delete_orphans)
     else:
         # If allow_dups = False, get list of Google envrionments from Fugue and extract the project ID 
+        existing_project_list = set()
         if allow_dups == False:
            print ("Duplicate environments are not allowed. Retrieving list of environments and project ids" + "\n") 
-           existing_project_list = get_project_list(provider)  
+           existing_project_list = set(get_project_list(provider))
            print ("Existing project list retrieved (" + str(len(existing_project_list)) + ")" + "\n")   
-        
-        projects= get_projects_from_org()
 
-        for name, proj_id in projects.items():
-            if allow_dups == False and proj_id in existing_project_list:   
-                print ("Found project id in existing environment list. Skipping environment creation for - " + name + ": " + proj_id)
+        # Projects are created by the workers while discovery is still paging through the org
+        project_queue = queue.Queue(maxsize=queue_size)
+        catalog_lock = threading.Lock()
+        reporter = progress.Progress('onboard', unit='projects')
+        threads = [threading.Thread(target=creation_worker, args=(project_queue, existing_project_list, catalog_lock, reporter)) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            if inventory_file:
+                total = stream_projects_from_inventory(project_queue)
+                print ("TOTAL INVENTORY PROJECTS: " + str(total))
             else:
-                print ("Creating env for: " + proj_id)
-                env_name = name + " - " + proj_id
-                print("Starting on creation for environment " + env_name + " and id: " + proj_id)
-                        
-                # Create JSON body  
-                env_def = create_google_env_def(env_name, provider.lower(), proj_id, compliance_families, service_account_email, interval)
-                print ("JSON body created for environment " + env_name)
-                print ("Creating environment for " + env_name + " and id: " + proj_id)
-                    
-                #Create environment
-                resp = create_env('environments', env_def)
-                        
-                if resp.status_code != 201:
-                    print('Environment creation failed for Project: ' + proj_id + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text) + "\n") 
-                else:
-                    env_id = resp.json()['id'] 
-                    print ('Environment created for Project: ' + proj_id + ' with environment name: ' + resp.json()['name'] + ' and environment id: ' + resp.json()['id'] + "\n") 
+                total = stream_projects_from_org(project_queue)
+                print ("TOTAL ACTIVE PROJECTS: " + str(total))
+        finally:
+            for thread in threads:
+                project_queue.put(None)
+            for thread in threads:
+                thread.join()
+        reporter.finish()
 
 if __name__ == '__main__':
     main()            
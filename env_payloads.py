@@ -0,0 +1,108 @@
+"""
+Pre-encoded environment payloads for bulk environment creation.
+
+Every environment created for the same provider, region, compliance families
+and schedule shares the same body apart from its name and the account (or
+project, or subscription) it points at. The body can hold hundreds of
+survey_resource_types, so building a fresh dict and letting requests
+serialize it again for every account x region adds up on large runs.
+
+PayloadCompiler builds and JSON encodes the body once per template key
+(usually the region), with markers in place of the name and id, and splits
+the encoded bytes around the markers. Rendering an environment then only
+splices the escaped name and id into the cached byte segments. Bodies can
+optionally be gzip compressed before they are sent; the gzip header carries
+no timestamp, so the same environment always gets the same bytes and
+recorded runs can be replayed (see api_recording.py).
+"""
+import gzip
+import io
+import json
+import re
+import threading
+
+
+NAME_MARK = '@@FUGUE_ENV_NAME@@'
+ID_MARK = '@@FUGUE_ENV_ID@@'
+MARKS = re.compile('(%s|%s)' % (re.escape(NAME_MARK), re.escape(ID_MARK)))
+
+
+class EncodedPayload(object):
+    """
+    A ready to send environment body.
+    """
+
+    def __init__(self, name, body, content_encoding=None):
+        self.name = name
+        self.body = body
+        self.content_encoding = content_encoding
+
+
+def compress(body):
+    """
+    Returns body gzip compressed with a zero modification time. Same as
+    gzip.compress(body, mtime=0), which needs Python 3.8.
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(body)
+    return buf.getvalue()
+
+
+def escape(value):
+    """
+    Returns value escaped for use inside a JSON string, without the quotes.
+    """
+    return json.dumps(value)[1:-1].encode('utf-8')
+
+
+class PayloadCompiler(object):
+    """
+    Caches encoded environment bodies per template key. build_template is
+    called with (key, name, id) the first time a key is seen and must return
+    the environment body dict; it is called with marker strings for name and
+    id, which may be embedded in longer strings such as a role ARN. A
+    compiler can be shared by several worker threads: each key is compiled
+    once, under a lock of its own, so templates of different keys (whose
+    build_template may look up resource types over the network) are
+    compiled in parallel.
+    """
+
+    def __init__(self, build_template, gzip_payloads=False):
+        self.build_template = build_template
+        self.gzip_payloads = gzip_payloads
+        self.templates = {}
+        self.key_locks = {}
+        self.lock = threading.Lock()
+
+    def compile(self, key):
+        body = self.build_template(key, NAME_MARK, ID_MARK)
+        encoded = json.dumps(body, separators=(',', ':'))
+        segments = []
+        for part in MARKS.split(encoded):
+            if part == NAME_MARK:
+                segments.append(NAME_MARK)
+            elif part == ID_MARK:
+                segments.append(ID_MARK)
+            else:
+                segments.append(part.encode('utf-8'))
+        return segments
+
+    def render(self, key, env_name, env_id):
+        """
+        Returns the EncodedPayload for one environment.
+        """
+        segments = self.templates.get(key)
+        if segments is None:
+            with self.lock:
+                key_lock = self.key_locks.setdefault(key, threading.Lock())
+            with key_lock:
+                segments = self.templates.get(key)
+                if segments is None:
+                    segments = self.templates[key] = self.compile(key)
+        name = escape(env_name)
+        ident = escape(env_id)
+        body = b''.join(name if s is NAME_MARK else ident if s is ID_MARK else s for s in segments)
+        if self.gzip_payloads:
+            return EncodedPayload(env_name, compress(body), 'gzip')
+        return EncodedPayload(env_name, body)
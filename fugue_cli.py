@@ -0,0 +1,319 @@
+"""
+Single command line entry point for the scripts in this repository.
+
+    python3 fugue_cli.py onboard aws|aws-org|aws-multi-org|govcloud|azure|azure-cli|google [options]
+        [--export-when-scanned FILE]
+    python3 fugue_cli.py export compliance [--output FILE] [--format csv|ndjson] [--sorted]
+        [--tenants FILE] [--partition-dir DIR [--partition-by environment|account]] [--environment ID ...]
+        [--watch [--watch-interval SECONDS]] [--star-dir DIR]
+    python3 fugue_cli.py schedule scans [--apply] [options]
+    python3 fugue_cli.py cleanup orphans [--apply] [options]
+
+Only the script for the chosen subcommand is imported, so provider SDKs such
+as boto3 or the Google Cloud client are loaded only when they are needed and
+nothing runs at import time. The parameters at the top of each script act as
+defaults; they can be overridden from a JSON (or TOML, if the toml package is
+installed) config file and from flags, so the scripts don't need to be edited
+for each run.
+
+A config file is a mapping of parameter names to values, for example:
+
+    {"regions": ["us-east-1"], "accounts": {"Prod Account": "1234"}}
+
+It may also hold one such mapping per subcommand, e.g. {"aws": {...},
+"google": {...}}, in which case only the section for the subcommand is used.
+"""
+import argparse
+import importlib
+import json
+import sys
+import time
+
+
+# Subcommand name to the module implementing it
+ONBOARD_SCRIPTS = {
+    'aws': 'env_creation_AWS_accounts',
+    'aws-org': 'env_creation_AWS_org',
+    'aws-multi-org': 'env_creation_AWS_multi_org',
+    'govcloud': 'env_creation_AWS_govcloud_accounts',
+    'azure': 'env_creation_AZURE_subscriptions',
+    'azure-cli': 'env_creation_AZURE_subscriptions_cli',
+    'google': 'env_creation_Google',
+}
+
+EXPORT_SCRIPTS = {
+    'compliance': 'get_compliance_into_csv',
+}
+
+SCHEDULE_SCRIPTS = {
+    'scans': 'scan_scheduler',
+}
+
+CLEANUP_SCRIPTS = {
+    'orphans': 'orphan_cleanup',
+}
+
+
+class ConfigError(Exception):
+    """
+    Raised for invalid config files or parameters.
+    """
+
+
+def load_config(path, section):
+    """
+    Reads parameters from a JSON or TOML config file. If the file contains a
+    mapping named after the subcommand, only that mapping is returned.
+    """
+    try:
+        with open(path) as f:
+            if path.endswith('.toml'):
+                import toml
+                config = toml.load(f)
+            else:
+                config = json.load(f)
+    except (IOError, ValueError) as error:
+        raise ConfigError('Could not read config file %s: %s' % (path, error))
+    if not isinstance(config, dict):
+        raise ConfigError('Config file %s must contain a mapping of parameters' % path)
+    if isinstance(config.get(section), dict):
+        return config[section]
+    return config
+
+
+def parse_value(value):
+    """
+    Parses a --set value as JSON so lists, maps, numbers and booleans can be
+    given on the command line, falling back to the raw string.
+    """
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def script_parameters(args):
+    """
+    Collects the script parameters from the config file and --set flags.
+    Flags take precedence over the config file.
+    """
+    params = {}
+    if args.config:
+        params.update(load_config(args.config, args.target))
+    for assignment in args.set or []:
+        name, sep, value = assignment.partition('=')
+        if not sep:
+            raise ConfigError('Expected NAME=VALUE, got: ' + assignment)
+        params[name.strip()] = parse_value(value)
+    return params
+
+
+def onboard_parameters(args):
+    """
+    Collects the onboarding script parameters from the config file and flags.
+    Flags take precedence over the config file.
+    """
+    params = script_parameters(args)
+    if args.regions is not None:
+        params['regions'] = parse_list(args.regions)
+    if args.compliance_families is not None:
+        params['compliance_families'] = parse_list(args.compliance_families)
+    if args.interval is not None:
+        params['interval'] = str(args.interval)
+    for flag in ('allow_dups', 'reconcile', 'delete_orphans'):
+        if getattr(args, flag):
+            params[flag] = True
+    return params
+
+
+def configure(module, params):
+    """
+    Overrides the parameters at the top of a script module. Unknown names are
+    rejected so typos don't silently fall back to the defaults.
+    """
+    for name, value in params.items():
+        if name.startswith('_') or not hasattr(module, name) or callable(getattr(module, name)):
+            raise ConfigError('Unknown parameter for %s: %s' % (module.__name__, name))
+        setattr(module, name, value)
+
+
+def run_onboard(args):
+    params = onboard_parameters(args)
+    module = importlib.import_module(ONBOARD_SCRIPTS[args.target])
+    configure(module, params)
+    started = time.time()
+    module.main()
+    if args.export_when_scanned:
+        import scan_waiter
+        scan_waiter.wait_and_export(started, args.export_when_scanned, args.scan_timeout)
+
+
+def export_conflicts(args):
+    """
+    Returns the export options given together that cannot be combined, or
+    None.
+    """
+    if args.tenants:
+        for option in ('partition_dir', 'star_dir', 'watch', 'environment'):
+            if getattr(args, option):
+                return '--tenants', '--' + option.replace('_', '-')
+    if args.partition_dir and args.output:
+        # Partitioned exports write one file per partition under the directory
+        return '--partition-dir', '--output'
+    if args.watch and args.sorted:
+        # Watch mode appends the records of every poll as they are read
+        return '--watch', '--sorted'
+    if args.star_dir:
+        # The star schema replaces the single file and partitioned outputs and has no watch mode
+        for option in ('partition_dir', 'output', 'watch', 'sorted'):
+            if getattr(args, option):
+                return '--star-dir', '--' + option.replace('_', '-')
+    return None
+
+
+def run_export(args):
+    import fugue_client
+    conflict = export_conflicts(args)
+    if conflict:
+        raise ConfigError('%s cannot be combined with %s' % conflict)
+    module = importlib.import_module(EXPORT_SCRIPTS[args.target])
+    try:
+        module.main(args.output, args.sorted, args.format, args.tenants, args.tenant_rate_limit,
+                    args.partition_dir, args.partition_by, args.environment,
+                    args.watch_interval if args.watch else None, args.star_dir)
+    except fugue_client.TenantError as error:
+        raise ConfigError(str(error))
+
+
+def run_schedule(args):
+    params = script_parameters(args)
+    if args.apply:
+        params['dry_run'] = False
+    module = importlib.import_module(SCHEDULE_SCRIPTS[args.target])
+    configure(module, params)
+    module.main()
+
+
+def run_cleanup(args):
+    params = script_parameters(args)
+    if args.apply:
+        params['dry_run'] = False
+    if args.action:
+        params['action'] = args.action
+    module = importlib.import_module(CLEANUP_SCRIPTS[args.target])
+    configure(module, params)
+    module.main()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Onboard cloud accounts to Fugue and export compliance results.')
+    parser.add_argument('--api-url', help='Fugue API base URL (default: https://api.riskmanager.fugue.co)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Print a line for every environment instead of periodic progress summaries')
+    parser.add_argument('--hedge', action='store_true',
+                        help='Send a duplicate of GET requests slower than the recent p95 and use the first response')
+    parser.add_argument('--hedge-budget', type=float, default=0.05,
+                        help='Maximum fraction of GET requests that may be duplicated (default: 0.05)')
+    parser.add_argument('--record', metavar='FILE',
+                        help='Record the Fugue API requests and responses of the run to FILE (gzip NDJSON, secrets redacted)')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='Answer Fugue API requests from a recording instead of the API; no network or credentials needed')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='Multiplier of the recorded latencies when replaying, 0 to answer right away (default: 1.0)')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    onboard = commands.add_parser('onboard', help='Create Fugue environments for cloud accounts')
+    onboard.add_argument('target', choices=sorted(ONBOARD_SCRIPTS))
+    onboard.add_argument('--config', help='JSON or TOML file with script parameters')
+    onboard.add_argument('--set', action='append', metavar='NAME=VALUE',
+                         help='Override a script parameter; VALUE is parsed as JSON when possible')
+    onboard.add_argument('--regions', help='Comma separated list of regions')
+    onboard.add_argument('--compliance-families', help='Comma separated list of compliance families')
+    onboard.add_argument('--interval', type=int, help='Scan interval in seconds')
+    onboard.add_argument('--allow-dups', action='store_true', help='Create environments even if the account is already in Fugue')
+    onboard.add_argument('--reconcile', action='store_true', help='Only create, update or delete the environments that differ')
+    onboard.add_argument('--delete-orphans', action='store_true', help='With --reconcile, delete environments that are not desired')
+    onboard.add_argument('--export-when-scanned', metavar='FILE',
+                         help='Wait for the first scans of the new environments and export their results to FILE as they finish')
+    onboard.add_argument('--scan-timeout', type=int, default=3600, help='Seconds to wait for the first scans (default: 3600)')
+    onboard.set_defaults(func=run_onboard)
+
+    export = commands.add_parser('export', help='Export results from Fugue')
+    export.add_argument('target', choices=sorted(EXPORT_SCRIPTS))
+    export.add_argument('--output', help='Output file (default: compliance-<timestamp>.<format>)')
+    export.add_argument('--format', choices=['csv', 'ndjson'], default='csv',
+                        help='Output format (default: csv)')
+    export.add_argument('--sorted', action='store_true',
+                        help='Sort the rows by account, family and control, using temporary files for large exports')
+    export.add_argument('--tenants', metavar='FILE',
+                        help='JSON list of tenant credentials to export concurrently into one output with a tenant column')
+    export.add_argument('--tenant-rate-limit', type=float,
+                        help='Maximum requests per second per tenant, for tenants without their own rate_limit')
+    export.add_argument('--partition-dir', metavar='DIR',
+                        help='Write one file per day, provider and environment (or account) under DIR, with a manifest.json')
+    export.add_argument('--partition-by', choices=['environment', 'account'], default='environment',
+                        help='Partition level below day and provider (default: environment)')
+    export.add_argument('--environment', action='append', metavar='ID',
+                        help='Only export this environment; can be repeated. With --partition-dir only its partitions are rewritten')
+    export.add_argument('--star-dir', metavar='DIR',
+                        help='Write dimension tables and a fact table of integer keys under DIR instead of one wide file')
+    export.add_argument('--watch', action='store_true',
+                        help='Keep running and export the results of every new scan as soon as it finishes')
+    export.add_argument('--watch-interval', type=int, default=300,
+                        help='Seconds between two polls for new scans in watch mode (default: 300)')
+    export.set_defaults(func=run_export)
+
+    schedule = commands.add_parser('schedule', help='Stagger the scans of existing environments')
+    schedule.add_argument('target', choices=sorted(SCHEDULE_SCRIPTS))
+    schedule.add_argument('--config', help='JSON or TOML file with script parameters')
+    schedule.add_argument('--set', action='append', metavar='NAME=VALUE',
+                          help='Override a script parameter; VALUE is parsed as JSON when possible')
+    schedule.add_argument('--apply', action='store_true', help='Trigger the scans instead of only printing the plan')
+    schedule.set_defaults(func=run_schedule)
+
+    cleanup = commands.add_parser('cleanup', help='Delete or disable the environments of closed accounts and projects')
+    cleanup.add_argument('target', choices=sorted(CLEANUP_SCRIPTS))
+    cleanup.add_argument('--config', help='JSON or TOML file with script parameters')
+    cleanup.add_argument('--set', action='append', metavar='NAME=VALUE',
+                         help='Override a script parameter; VALUE is parsed as JSON when possible')
+    cleanup.add_argument('--action', choices=['disable', 'delete'], help='Disable the scans of orphaned environments or delete them')
+    cleanup.add_argument('--apply', action='store_true', help='Change the environments instead of only printing them')
+    cleanup.set_defaults(func=run_cleanup)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.verbose:
+        import progress
+        progress.verbose = True
+    if args.api_url or args.hedge or args.record or args.replay:
+        import fugue_client
+    if args.record and args.replay:
+        parser.error('--record and --replay cannot be combined')
+    if args.record:
+        fugue_client.enable_recording(args.record)
+    if args.replay:
+        fugue_client.enable_replay(args.replay, args.replay_speed)
+    if args.api_url:
+        fugue_client.api_url = args.api_url.rstrip('/')
+    if args.hedge:
+        fugue_client.enable_hedging(budget=args.hedge_budget)
+    try:
+        args.func(args)
+    except ConfigError as error:
+        parser.error(str(error))
+    if args.hedge:
+        stats = fugue_client.hedging.stats()
+        print('Hedged %d of %d GET requests, %d answered first by the duplicate' % (
+            stats['hedges'], stats['requests'], stats['hedge_wins']))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
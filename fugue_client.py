@@ -0,0 +1,564 @@
+"""
+Shared helpers for calling the Fugue API from the utility scripts in this
+repository.
+
+The client ID and secret are read from the FUGUE_API_ID and FUGUE_API_SECRET
+environment variables the first time a request is made, so importing this
+module has no side effects.
+
+GET responses are requested brotli or gzip compressed. List responses are
+parsed incrementally from the response stream by get_items(), so the raw
+bytes, the decoded text and the parsed page are never all held in memory at
+once; items are yielded as soon as they have been parsed.
+
+Each thread keeps its own requests.Session, so connections to the API are
+reused from one request to the next instead of being opened for every call.
+
+GET requests can optionally be hedged to cut tail latency, see
+enable_hedging() and request_hedging.py.
+
+The API traffic of a run can be recorded to an archive and replayed later
+without network access, see enable_recording(), enable_replay() and
+api_recording.py.
+
+Requests normally use the credentials from the environment. To work with
+several Fugue tenants at once, wrap the calls for each tenant in
+use_tenant(tenant): the tenant's credentials, API URL and rate limit then
+apply to the requests made by that thread.
+
+https://docs.fugue.co/api.html#api-user-guide
+"""
+from contextlib import closing, contextmanager
+import atexit
+import codecs
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import requests
+
+import api_recording
+import request_hedging
+
+
+# Fugue API base URL
+api_url = "https://api.riskmanager.fugue.co"
+api_ver = 'v0'
+
+_auth = None
+
+# Size of the chunks read from streamed responses
+STREAM_CHUNK_SIZE = 65536
+
+# (connect, read) timeouts of every request in seconds, so a stalled
+# connection raises requests.Timeout instead of hanging the run. The read
+# timeout applies to each read from the socket, not to the whole response.
+REQUEST_TIMEOUT = (10, 120)
+
+
+def accept_encoding():
+    """
+    Returns the Accept-Encoding header value: brotli is preferred when a
+    brotli decoder is installed (urllib3 uses brotli or brotlicffi), gzip
+    otherwise.
+    """
+    for module in ('brotli', 'brotlicffi'):
+        try:
+            __import__(module)
+            return 'br, gzip, deflate'
+        except ImportError:
+            pass
+    return 'gzip, deflate'
+
+
+GET_HEADERS = {'Accept-Encoding': accept_encoding()}
+
+# request_hedging.HedgePolicy used for GET requests, None when hedging is off
+hedging = None
+
+# progress.Progress that counts the list pages read, None when not reporting
+progress = None
+
+# api_recording.Recorder or Replayer of the API traffic, None when off
+recorder = None
+replayer = None
+
+
+class RateLimiter(object):
+    """
+    Token bucket that allows rate requests per second on average, with
+    bursts of up to burst requests.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Tenant(object):
+    """
+    The credentials, API URL and optional rate limit (requests per second)
+    of one Fugue tenant.
+    """
+
+    def __init__(self, name, client_id, client_secret, url=None, rate_limit=None):
+        self.name = name
+        self.auth = (client_id, client_secret)
+        self.url = url
+        self.limiter = RateLimiter(rate_limit) if rate_limit else None
+
+
+class TenantError(Exception):
+    """
+    Raised for an invalid tenants file.
+    """
+
+
+def load_tenants(path, rate_limit=None):
+    """
+    Reads a JSON list of tenants, each with a name, client_id and
+    client_secret, or client_id_env and client_secret_env naming the
+    environment variables that hold them, and optionally api_url and
+    rate_limit. rate_limit is the default for tenants without one.
+    """
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (IOError, ValueError) as error:
+        raise TenantError('Could not read tenants file %s: %s' % (path, error))
+    if not isinstance(entries, list):
+        raise TenantError('Tenants file %s must contain a list of tenants' % path)
+    tenants = []
+    for index, entry in enumerate(entries):
+        name = entry.get('name') or 'tenant-%d' % (index + 1)
+        client_id = entry.get('client_id') or os.getenv(entry.get('client_id_env', ''), '')
+        client_secret = entry.get('client_secret') or os.getenv(entry.get('client_secret_env', ''), '')
+        if not client_id or not client_secret:
+            raise TenantError('Missing client ID or secret for tenant ' + name)
+        tenants.append(Tenant(name, client_id, client_secret, entry.get('api_url'), entry.get('rate_limit', rate_limit)))
+    return tenants
+
+
+_local = threading.local()
+
+# Per thread requests.Session, see session()
+_sessions = threading.local()
+
+
+def current_tenant():
+    return getattr(_local, 'tenant', None)
+
+
+@contextmanager
+def use_tenant(tenant):
+    """
+    Makes the requests of the current thread use tenant inside the with
+    block.
+    """
+    previous = current_tenant()
+    _local.tenant = tenant
+    try:
+        yield tenant
+    finally:
+        _local.tenant = previous
+
+
+def bind(function):
+    """
+    Returns function wrapped to run with the tenant of the calling thread,
+    for handing work to a thread pool.
+    """
+    tenant = current_tenant()
+
+    def bound(*args, **kwargs):
+        with use_tenant(tenant):
+            return function(*args, **kwargs)
+    return bound
+
+
+def throttle():
+    """
+    Waits for the rate limit of the current tenant, if it has one.
+    """
+    tenant = current_tenant()
+    if tenant is not None and tenant.limiter is not None:
+        tenant.limiter.acquire()
+
+
+def session():
+    """
+    Returns the requests.Session of the calling thread, so its connections
+    are kept open and reused. Sessions are not shared between threads.
+    """
+    current = getattr(_sessions, 'session', None)
+    if current is None:
+        current = requests.Session()
+        _sessions.session = current
+    return current
+
+
+def get_auth():
+    """
+    Returns the (client_id, client_secret) pair used to authenticate with
+    Fugue, exiting with a pointer to the user guide if it is not configured.
+    https://docs.fugue.co/api.html#auth-n
+    """
+    global _auth
+    # Replayed runs don't talk to the API and need no credentials
+    if replayer is not None:
+        return None
+    tenant = current_tenant()
+    if tenant is not None:
+        return tenant.auth
+    if _auth is None:
+        client_id = os.getenv('FUGUE_API_ID')
+        client_secret = os.getenv('FUGUE_API_SECRET')
+        if not client_id or not client_secret:
+            print('Please follow the user guide at https://docs.fugue.co/api.html#api-user-guide to set \'FUGUE_API_ID\' and \'FUGUE_API_SECRET\'')
+            sys.exit(1)
+        _auth = (client_id, client_secret)
+    return _auth
+
+
+def url_for(path):
+    tenant = current_tenant()
+    base = tenant.url if tenant is not None and tenant.url else api_url
+    return '%s/%s/%s' % (base.rstrip('/'), api_ver, path.strip('/'))
+
+
+def enable_hedging(**options):
+    """
+    Turns on hedging of GET requests with a request_hedging.HedgePolicy
+    created with the given options, and returns the policy.
+    """
+    global hedging
+    hedging = request_hedging.HedgePolicy(**options)
+    return hedging
+
+
+def hedge_key(path):
+    """
+    Returns the kind of request used to track latencies: the last segment of
+    the path, e.g. 'scans' or 'compliance_by_rules'.
+    """
+    return path.strip('/').split('/')[-1]
+
+
+def enable_recording(path):
+    """
+    Records every request and response to the archive at path until the
+    process exits, and returns the api_recording.Recorder.
+    """
+    global recorder
+    recorder = api_recording.Recorder(path)
+    atexit.register(recorder.close)
+    return recorder
+
+
+def enable_replay(path, speed=1.0):
+    """
+    Answers every request from the archive at path instead of the API, after
+    the recorded latency multiplied by speed (0 to answer right away), and
+    returns the api_recording.Replayer.
+    """
+    global replayer
+    replayer = api_recording.Replayer(path, speed)
+    return replayer
+
+
+def api_path(path):
+    """
+    Returns the path a request is recorded under: the API path, prefixed
+    with the tenant name when a tenant is in use.
+    """
+    tenant = current_tenant()
+    path = path.strip('/')
+    return path if tenant is None else tenant.name + ':' + path
+
+
+def transport(method, path, url, auth, params=None, stream=False, **kwargs):
+    """
+    Sends a request through the session of the calling thread, recording it
+    when recording is on, or answers it from the archive when replaying.
+    path is the recorded path, see api_path().
+    """
+    body = kwargs.get('json', kwargs.get('data'))
+    if replayer is not None:
+        return replayer.response(method, path, params, body, url)
+
+    def request():
+        return session().request(method, url, params=params, auth=auth, stream=stream, timeout=REQUEST_TIMEOUT, **kwargs)
+    if recorder is not None:
+        return recorder.record(method, path, params, body, request)
+    return request()
+
+
+def send(method, path, params=None, **kwargs):
+    """
+    Sends an authenticated request to the API path and returns the response
+    object as is.
+    """
+    return transport(method, api_path(path), url_for(path), get_auth(), params, **kwargs)
+
+
+def send_get(path, params=None, stream=False):
+    """
+    Sends an authenticated GET request, hedged if hedging is enabled, and
+    returns the response object.
+    """
+    # The tenant is thread local, so everything that depends on it is looked up before a hedge can send from another thread
+    auth = get_auth()
+    url = url_for(path)
+    recorded_path = api_path(path)
+    throttle()
+
+    def send_once():
+        return transport('GET', recorded_path, url, auth, params, stream, headers=GET_HEADERS)
+    if hedging is None:
+        return send_once()
+
+    # The duplicate is sent from the hedging pool, with the rate limit of the tenant of this thread
+    def send_backup():
+        throttle()
+        return send_once()
+    return hedging.run(hedge_key(path), send_once, bind(send_backup))
+
+
+def get(path, params=None):
+    """
+    Executes an authenticated GET request to the Fugue API with the provided
+    API path and query parameters.
+    """
+    return send_get(path, params).json()
+
+
+WHITESPACE = re.compile(r'\s*')
+DECODER = json.JSONDecoder()
+
+
+class StreamParser(object):
+    """
+    Reads JSON values one at a time from an iterator of text chunks, keeping
+    only the unparsed remainder of the stream in memory.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=1):
+        """
+        Appends chunks to the buffer, dropping the parsed part, until it
+        holds at least size unparsed characters. Returns False when no chunk
+        was left to read.
+        """
+        parts = [self.buf[self.pos:]]
+        length = len(parts[0])
+        while length < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.eof = True
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        self.buf = ''.join(parts)
+        self.pos = 0
+        return len(parts) > 1
+
+    def peek(self):
+        """
+        Returns the next non whitespace character without consuming it, or
+        '' at the end of the stream.
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self.fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        """
+        Consumes the next character, which must be one of chars, and returns it.
+        """
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of %r in JSON response, got %r' % (chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Parses and returns the next complete JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # Decoding starts over from the beginning of the value, so wait
+            # until the unparsed part has doubled: retrying after every chunk
+            # would be quadratic in the size of large values
+            self.fill(2 * (len(self.buf) - self.pos))
+
+
+def iter_array(chunks, key, fields):
+    """
+    Generator that yields the elements of the key array of the JSON object
+    read from chunks. The other fields of the object are stored in fields.
+    """
+    parser = StreamParser(chunks)
+    parser.expect('{')
+    if parser.peek() == '}':
+        return
+    while True:
+        name = parser.value()
+        parser.expect(':')
+        if name == key and parser.peek() == '[':
+            parser.expect('[')
+            if parser.peek() == ']':
+                parser.expect(']')
+            else:
+                while True:
+                    yield parser.value()
+                    if parser.expect(',]') == ']':
+                        break
+        else:
+            fields[name] = parser.value()
+        if parser.expect(',}') == '}':
+            return
+
+
+def get_items(path, params=None, key='items', fields=None):
+    """
+    Executes an authenticated GET request and yields the elements of the key
+    array of the response as they are parsed from the compressed response
+    stream. The other top level fields of the response, such as is_truncated
+    and next_offset, are stored in fields once the array has been read.
+    """
+    if fields is None:
+        fields = {}
+    resp = send_get(path, params, stream=True)
+    with closing(resp):
+        resp.raise_for_status()
+        decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')()
+        chunks = (decoder.decode(chunk) for chunk in resp.iter_content(STREAM_CHUNK_SIZE))
+        for item in iter_array(chunks, key, fields):
+            yield item
+    if progress is not None:
+        progress.add('pages')
+
+
+def list_items(path, params=None, max_items=None):
+    """
+    Generator that yields the items of every page of a paginated list
+    response, parsing each page incrementally.
+    """
+    offset = 0
+    is_truncated = True
+    while is_truncated:
+        page_params = dict(params or {})
+        page_params['offset'] = offset
+        if max_items:
+            page_params['max_items'] = max_items
+        fields = {}
+        for item in get_items(path, page_params, fields=fields):
+            yield item
+        offset = fields.get('next_offset')
+        is_truncated = fields.get('is_truncated', False)
+
+
+def post(path, json=None, params=None):
+    """
+    Executes an authenticated POST request to the Fugue API with the provided
+    API path, json body and query parameters. The response object is returned
+    as is.
+    """
+    throttle()
+    return send('POST', path, params, json=json)
+
+
+def post_encoded(path, body, content_encoding=None):
+    """
+    Executes an authenticated POST request with an already JSON encoded (and
+    optionally compressed) body, so it is not serialized again.
+    """
+    headers = {'Content-Type': 'application/json'}
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+    throttle()
+    return send('POST', path, data=body, headers=headers)
+
+
+def patch(path, json=None):
+    """
+    Executes an authenticated PATCH request to the Fugue API with the provided
+    API path and json body. The response object is returned as is.
+    """
+    throttle()
+    return send('PATCH', path, json=json)
+
+
+def delete(path):
+    """
+    Executes an authenticated DELETE request to the Fugue API with the
+    provided API path. The response object is returned as is.
+    """
+    throttle()
+    return send('DELETE', path)
+
+
+def list_environments(provider=None, max_items=100):
+    """
+    Generator that yields every environment in the Fugue tenant, optionally
+    restricted to a single provider.
+    https://docs.fugue.co/_static/swagger.html#tag-environments
+    """
+    params = {}
+    if provider:
+        params['q.provider'] = provider
+    return list_items('environments', params, max_items)
+
+
+def list_scans(environment_id=None, status=None, range_from=None, max_items=100):
+    """
+    Generator that yields scans, most recent first, optionally restricted to
+    one environment, a status and scans created since the range_from Unix
+    timestamp. Without environment_id scans of every environment are listed.
+    https://docs.fugue.co/_static/swagger.html#tag-scans
+    """
+    params = {}
+    if environment_id:
+        params['environment_id'] = environment_id
+    if status:
+        params['status'] = status
+    if range_from is not None:
+        params['range_from'] = int(range_from)
+    return list_items('scans', params, max_items)
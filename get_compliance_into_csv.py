@@ -6,9 +6,8 @@ that are used to authenticate with Fugue:
 
 https://docs.fugue.co/api.html#api-user-guide
 
-The client ID and secret may be passed to this script using the following
-environment variables: FUGUE_API_ID and FUGUE_API_SECRET. Alternatively,
-edit the script itself to set the values directly in this script.
+The client ID and secret are passed to this script using the following
+environment variables: FUGUE_API_ID and FUGUE_API_SECRET.
 
 This script should be run using Python 3 however it could be modified for
 Python 2 compatibility if needed.
@@ -17,32 +16,104 @@ One dependency must be installed using pip: the requests library.
  * pip install requests
 
 """
+from concurrent.futures import ThreadPoolExecutor
+import csv as csv_tables
 from datetime import datetime
+import heapq
 import json
 import os
+import queue
+import re
+import sys
+import tempfile
+import threading
+import time
+
 import requests
 
+import fugue_client
+import progress
+
+
+# The Fugue API URL and credentials are handled by fugue_client.py. Client ID
+# and secret are read from the FUGUE_API_ID and FUGUE_API_SECRET environment
+# variables when the first request is made.
 
-# Fugue API base URL
-api_url = "https://api.riskmanager.fugue.co"
-api_ver = 'v0'
+# The latest successful scan of every environment is found in one listing of
+# the scans of all environments from the last SCAN_LOOKBACK_DAYS days, read
+# in pages of SCAN_PAGE_SIZE scans. Once the listing has read as many pages as
+# there are environments left to find, or reached the end of the window, the
+# environments still missing are looked up one by one with LOOKUP_WORKERS
+# concurrent requests, so a few environments without a recent scan don't
+# cost the whole listing.
+SCAN_LOOKBACK_DAYS = 7
+SCAN_PAGE_SIZE = 100
+LOOKUP_WORKERS = 16
 
+# Sorted exports are sorted on disk: records are sorted in runs of
+# SORT_RUN_SIZE records that are spilled to temporary files and merged, at
+# most SORT_MERGE_FAN_IN files at a time, so memory use does not grow with
+# the size of the export.
+SORT_COLUMNS = ['account', 'family', 'control', 'environment_name', 'resource_type', 'resource_id']
+SORT_RUN_SIZE = 100000
+SORT_MERGE_FAN_IN = 64
 
-# Client ID and secret used to authenticate with Fugue. Follow the guide here
-# to create an API client: https://docs.fugue.co/api.html#getting-started
-# You can set these values via environment variables or replace the os.getenv
-# calls below with the string values themselves.
-client_id = os.getenv('FUGUE_API_ID')
-client_secret = os.getenv('FUGUE_API_SECRET')
+# NDJSON output encodes NDJSON_BATCH_SIZE records before writing them out.
+NDJSON_BATCH_SIZE = 1000
 
-if not client_id or not client_secret:
-    print('Please follow the user guide at https://docs.fugue.co/api.html#api-user-guide to set \'FUGUE_API_ID\' and \'FUGUE_API_SECRET\'')
-    exit(1)
+# Multi-tenant exports read every tenant in its own thread and hand records
+# to the writer in batches of TENANT_BATCH_SIZE, with at most
+# TENANT_QUEUE_SIZE batches waiting to be written.
+TENANT_BATCH_SIZE = 500
+TENANT_QUEUE_SIZE = 64
 
+# Partitioned exports write one file per day, provider and environment (or
+# account) under a directory, with PARTITION_WORKERS partitions read and
+# written in parallel, and list the partitions in MANIFEST_NAME.
+PARTITION_WORKERS = 8
+PARTITION_BY = ('environment', 'account')
+MANIFEST_NAME = 'manifest.json'
+
+# Every export records the cost of each environment (pages, records and
+# seconds spent reading its latest scan) in EXPORT_STATS_FILE, next to the
+# output file or inside the output directory (see export_stats_path()).
+# Entries of environments that no longer exist are dropped. The next
+# partitioned export starts with the partitions that took longest, and scans
+# that took at least SPLIT_MIN_PAGES pages of COMPLIANCE_PAGE_SIZE rules last
+# time have those pages requested in parallel by PAGE_WORKERS workers.
+# Single file exports stream the environments one at a time as their scans
+# are found, so only the page split applies to them. Tenant exports don't
+# record stats.
+EXPORT_STATS_FILE = '.export_stats.json'
+COMPLIANCE_PAGE_SIZE = 100
+SPLIT_MIN_PAGES = 4
+PAGE_WORKERS = 8
+
+# Star schema exports (export_star()) write one table per dimension, keyed by
+# integers, and a fact table of those keys, named after STAR_TABLES.
+STAR_TABLES = [
+    ('environments', ['environment_key', 'environment_id', 'environment_name', 'account', 'region']),
+    ('scans', ['scan_key', 'scan_id', 'environment_key', 'day', 'time']),
+    ('controls', ['control_key', 'family', 'control']),
+    ('resource_types', ['resource_type_key', 'resource_type']),
+    ('resources', ['resource_key', 'resource_id', 'resource_type_key']),
+    ('messages', ['message_key', 'message']),
+    ('compliance_facts', ['environment_key', 'scan_key', 'control_key', 'resource_type_key', 'resource_key', 'message_key']),
+]
 
-# Authentication
-# https://docs.fugue.co/api.html#auth-n
-auth = (client_id, client_secret)
+# Watch mode (watch()) polls every WATCH_INTERVAL seconds for the successful
+# scans created since the finish time of the latest scan it exported, minus
+# WATCH_MARGIN seconds for scans that were still running then (scans that
+# take longer than WATCH_MARGIN may be missed), and never further back than
+# WATCH_LOOKBACK seconds. The environment catalog is kept in memory and
+# listed again every WATCH_CATALOG_REFRESH seconds, or when a scan of an
+# unknown environment shows up. A poll that fails is retried after a delay
+# that doubles with every failure, up to WATCH_MAX_BACKOFF seconds.
+WATCH_INTERVAL = 300
+WATCH_MARGIN = 3600
+WATCH_LOOKBACK = 6 * 3600
+WATCH_MAX_BACKOFF = 3600
+WATCH_CATALOG_REFRESH = 3600
 
 
 def get(path, params=None):
@@ -50,8 +121,7 @@ def get(path, params=None):
     Executes an authenticated GET request to the Fugue API with the provided
     API path and query parameters.
     """
-    url = '%s/%s/%s' % (api_url, api_ver, path.strip('/'))
-    return requests.get(url, params=params, auth=auth).json()
+    return fugue_client.get(path, params=params)
 
 
 def list_environments():
@@ -59,7 +129,7 @@ def list_environments():
     Returns all environments present in your Fugue account.
     https://docs.fugue.co/_static/swagger.html#tag-environments
     """
-    return get('environments')['items']
+    return list(fugue_client.list_environments())
 
 
 def list_scans(environment_id, max_items=10, status='SUCCESS'):
@@ -86,20 +156,89 @@ def get_latest_scan(environment_id):
     return None
 
 
-def get_compliance_by_rules(scan_id):
+def get_latest_scans(environment_ids):
+    """
+    Returns a map of environment ID to its most recent successful scan.
+    Recent scans of all environments are listed most recent first, stopping
+    as soon as every environment has been seen, so a few paginated calls
+    replace one call per environment. Environments that were not found in
+    the last SCAN_LOOKBACK_DAYS days, or once the listing has read as many
+    pages as there are environments left, are looked up individually in
+    parallel.
+    """
+    latest = {}
+    pending = set(environment_ids)
+    range_from = time.time() - SCAN_LOOKBACK_DAYS * 86400
+    listed = 0
+    for scan in fugue_client.list_scans(status='SUCCESS', range_from=range_from, max_items=SCAN_PAGE_SIZE):
+        environment_id = scan.get('environment_id')
+        if environment_id in pending:
+            latest[environment_id] = scan
+            pending.discard(environment_id)
+        listed += 1
+        if not pending:
+            break
+        # Reading on costs a page per page left, looking up the rest a request each
+        if listed % SCAN_PAGE_SIZE == 0 and listed // SCAN_PAGE_SIZE >= len(pending):
+            break
+    if pending:
+        remaining = sorted(pending)
+        with ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as pool:
+            for environment_id, scan in zip(remaining, pool.map(fugue_client.bind(get_latest_scan), remaining)):
+                if scan:
+                    latest[environment_id] = scan
+    return latest
+
+
+def fetch_page(path, params):
     """
-    Lists compliance results by rule for a scan.
+    Returns the items and the other top level fields of one page of a
+    paginated list response.
     """
-    items = []
+    fields = {}
+    items = list(fugue_client.get_items(path, params, fields=fields))
+    return items, fields
+
+
+def get_compliance_by_rules(scan_id, expected_pages=0, pool=None, counter=None):
+    """
+    Generator that yields the compliance results by rule for a scan, parsed
+    incrementally from each page of the response. If the scan is expected to
+    have several pages and a pool is given, the first expected_pages pages
+    are requested concurrently on the pool and yielded in order; pages past
+    them are read one after the other. Pages are counted in counter['pages']
+    if a counter is given.
+    """
+    path = 'scans/%s/compliance_by_rules' % scan_id
     offset = 0
+    if pool is not None and expected_pages > 1:
+        futures = [pool.submit(fugue_client.bind(fetch_page), path, {'offset': page * COMPLIANCE_PAGE_SIZE, 'max_items': COMPLIANCE_PAGE_SIZE})
+                   for page in range(expected_pages)]
+        try:
+            for page, future in enumerate(futures):
+                items, fields = future.result()
+                if counter is not None:
+                    counter['pages'] += 1
+                for item in items:
+                    yield item
+                if not fields.get('is_truncated', False):
+                    return
+                offset = fields.get('next_offset')
+                # The requested offsets are only right if every page is full
+                if offset != (page + 1) * COMPLIANCE_PAGE_SIZE:
+                    break
+        finally:
+            for future in futures:
+                future.cancel()
     while True:
-        params = {'offset': offset}
-        response = get('scans/%s/compliance_by_rules' % scan_id, params)
-        items.extend(response['items'])
-        if not response['is_truncated']:
-            break
-        offset = response['next_offset']
-    return items
+        fields = {}
+        for item in fugue_client.get_items(path, {'offset': offset, 'max_items': COMPLIANCE_PAGE_SIZE}, fields=fields):
+            yield item
+        if counter is not None:
+            counter['pages'] += 1
+        if not fields.get('is_truncated', False):
+            return
+        offset = fields.get('next_offset')
 
 
 def format_message(message):
@@ -119,7 +258,7 @@ def records_from_failed_type(family, control, failure):
         control=control,
         resource_type=failure['resource_type'],
         resource_id=None,
-        message=format_message(message),
+        message=message,
     ) for message in failure['messages']]
 
 
@@ -132,7 +271,7 @@ def records_from_failed_resource(family, control, failure):
         control=control,
         resource_type=failure['resource']['resource_type'],
         resource_id=failure['resource']['resource_id'],
-        message=format_message(message),
+        message=message,
     ) for message in failure['messages']]
 
 
@@ -145,7 +284,7 @@ def records_from_unsurveyed_type(family, control, resource_type):
         control=control,
         resource_type=resource_type,
         resource_id=None,
-        message=format_message('Resource type was not scanned'),
+        message='Resource type was not scanned',
     )]
 
 
@@ -247,6 +386,9 @@ COLUMNS = [
     'scan_id',
 ]
 
+# Columns of a multi-tenant export
+TENANT_COLUMNS = ['tenant'] + COLUMNS
+
 
 def value_or_default(value, default='-'):
     if value is not None:
@@ -270,39 +412,808 @@ def csv(values):
 
 def format_value(column_name, value):
     # All columns but the message column should be wrapped with double quotes
-    # to avoid excel autoformatting behavior.
+    # to avoid excel autoformatting behavior. Messages are kept as they are in
+    # the records and only stripped of commas and quotes here.
     value = value_or_default(value)
     if column_name != 'message':
         value = quote_csv_value(value)
+    else:
+        value = format_message(value)
     return ' '.join(value.split())
 
 
-def format(record, fmt='csv'):
+def ordered_record(record, columns=COLUMNS):
+    """
+    Returns the record as a dict with its keys in columns order, so every
+    JSON line has the same key order.
+    """
+    return dict((col, record[col]) for col in columns)
+
+
+def json_encoder():
+    """
+    Returns a function that encodes a value as a compact JSON string, using
+    orjson or simplejson when one of them is installed and the standard
+    library json module otherwise.
+    """
+    try:
+        import orjson
+        return lambda value: orjson.dumps(value).decode('utf-8')
+    except ImportError:
+        pass
+    try:
+        import simplejson
+        return simplejson.JSONEncoder(separators=(',', ':')).encode
+    except ImportError:
+        return json.JSONEncoder(separators=(',', ':')).encode
+
+
+def format(record, fmt='csv', columns=COLUMNS):
     if fmt == 'csv':
-        return csv([format_value(col, record[col]) for col in COLUMNS])
+        return csv([format_value(col, record[col]) for col in columns])
     else:
-        return json.dumps(record)
+        return json.dumps(ordered_record(record, columns))
 
 
-def main():
+def write_ndjson(f, records, batch_size=NDJSON_BATCH_SIZE, columns=COLUMNS):
     """
-    Loop over all Fugue environments in your account and output compliance
-    results from the most recent scan in each. Output is in CSV format.
+    Writes records as newline delimited JSON with a fixed key order. Records
+    are encoded in batches and each batch is written with a single call.
+    """
+    encode = json_encoder()
+    batch = []
+    for record in records:
+        batch.append(encode(ordered_record(record, columns)))
+        if len(batch) >= batch_size:
+            f.write('\n'.join(batch) + '\n')
+            batch = []
+    if batch:
+        f.write('\n'.join(batch) + '\n')
+
+
+def records_from_scan(env, scan, expected_pages=0, pool=None, counter=None):
+    """
+    Generator that yields the compliance records of one scan of an
+    environment.
+    """
+    for rule in get_compliance_by_rules(scan['id'], expected_pages, pool, counter):
+        for record in records_from_rule(rule):
+            yield record_with_metadata(record, env, scan)
+
+
+def records_from_scans(env_scans, reporter=None, stats=None, pool=None):
+    """
+    Generator that yields the compliance records of every (environment, scan)
+    pair as it is produced by env_scans. Pairs without a scan are skipped.
+    Environments and records are counted on reporter if one is given. With
+    stats, the pages, records and seconds of every environment are recorded
+    in it and, with a pool, the pages of environments that had at least
+    SPLIT_MIN_PAGES pages last time are requested in parallel.
+    """
+    for env, scan in env_scans:
+        count = 0
+        if scan:
+            expected_pages = 0
+            if stats is not None and pool is not None:
+                pages = stats.get(env['id'], {}).get('pages', 0)
+                if pages >= SPLIT_MIN_PAGES:
+                    expected_pages = pages
+            counter = {'pages': 0}
+            start = time.time()
+            for record in records_from_scan(env, scan, expected_pages, pool, counter):
+                count += 1
+                yield record
+            if stats is not None:
+                stats[env['id']] = {
+                    'pages': counter['pages'],
+                    'records': count,
+                    'seconds': round(time.time() - start, 3),
+                    'scan_id': scan['id'],
+                }
+            progress.log('Exported %d records of %s from scan %s' % (count, env['name'], scan['id']))
+        if reporter is not None:
+            reporter.add('records', count)
+            reporter.add()
+
+
+def export_stats_path(filename=None, directory=None):
+    """
+    Returns the path of the stats file of an export written to filename, or
+    to the files under directory.
+    """
+    if directory is not None:
+        return os.path.join(directory, EXPORT_STATS_FILE)
+    return os.path.join(os.path.dirname(filename or ''), EXPORT_STATS_FILE)
+
+
+def load_export_stats(filename=EXPORT_STATS_FILE):
+    """
+    Returns the per environment costs recorded by previous exports.
+    """
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_export_stats(stats, filename=EXPORT_STATS_FILE):
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + '.partial', 'w') as f:
+        json.dump(stats, f)
+    os.replace(filename + '.partial', filename)
+
+
+def prune_export_stats(environment_ids, filename=EXPORT_STATS_FILE):
+    """
+    Drops the stats of the environments that are not in environment_ids,
+    the IDs of every environment that still exists.
+    """
+    stats = load_export_stats(filename)
+    existing = set(environment_ids)
+    pruned = dict((env_id, entry) for env_id, entry in stats.items() if env_id in existing)
+    if len(pruned) < len(stats):
+        save_export_stats(pruned, filename)
+
+
+def estimated_seconds(stats, environment_ids):
+    """
+    Returns a map of environment ID to the seconds its export took last
+    time. Environments without a recorded cost are assumed to take the
+    median of the others.
+    """
+    known = sorted(stats[env_id]['seconds'] for env_id in environment_ids if env_id in stats)
+    default = known[len(known) // 2] if known else 0.0
+    return dict((env_id, stats[env_id]['seconds'] if env_id in stats else default) for env_id in environment_ids)
+
+
+def sort_key(record):
+    return tuple(value_or_default(record[col], '') for col in SORT_COLUMNS)
+
+
+def write_run(records):
     """
+    Writes already sorted records to a temporary file, one JSON object per
+    line, and returns the file rewound to the start.
+    """
+    run = tempfile.TemporaryFile('w+')
+    for record in records:
+        run.write(json.dumps(record) + '\n')
+    run.seek(0)
+    return run
+
+
+def read_run(run):
+    for line in run:
+        yield json.loads(line)
+
+
+def merge_runs(runs):
+    return heapq.merge(*[read_run(run) for run in runs], key=sort_key)
+
+
+def external_sort(records, run_size=SORT_RUN_SIZE, fan_in=SORT_MERGE_FAN_IN):
+    """
+    Generator that yields records sorted by SORT_COLUMNS, holding at most
+    run_size records in memory. Sorted runs are spilled to temporary files
+    and merged with a k-way merge, in several passes if there are more than
+    fan_in runs.
+    """
+    runs = []
+    buffer = []
+    try:
+        for record in records:
+            buffer.append(record)
+            if len(buffer) >= run_size:
+                runs.append(write_run(sorted(buffer, key=sort_key)))
+                buffer = []
+        if not runs:
+            for record in sorted(buffer, key=sort_key):
+                yield record
+            return
+        if buffer:
+            runs.append(write_run(sorted(buffer, key=sort_key)))
+            buffer = []
+        while len(runs) > fan_in:
+            merged = []
+            for start in range(0, len(runs), fan_in):
+                group = runs[start:start + fan_in]
+                merged.append(write_run(merge_runs(group)))
+                for run in group:
+                    run.close()
+            runs = merged
+        for record in merge_runs(runs):
+            yield record
+    finally:
+        for run in runs:
+            run.close()
+
+
+def append_records(records, filename, fmt='csv', columns=COLUMNS):
+    """
+    Appends records to filename as CSV or NDJSON, writing the CSV header
+    first if the file is new or empty. Returns the number of records.
+    """
+    count = [0]
+
+    def counted():
+        for record in records:
+            count[0] += 1
+            yield record
+
+    with open(filename, 'a') as f:
+        if fmt == 'ndjson':
+            write_ndjson(f, counted(), columns=columns)
+        else:
+            if f.tell() == 0:
+                print(csv(columns), file=f)
+            for record in counted():
+                print(format(record, columns=columns), file=f)
+    return count[0]
+
+
+def default_filename(fmt='csv'):
     now = datetime.now().strftime('%Y-%m-%d-%H%M%S')
-    filename = 'compliance-%s.csv' % now
+    return 'compliance-%s.%s' % (now, fmt)
+
+
+def write_records(records, filename, sort=False, fmt='csv', columns=COLUMNS):
+    """
+    Writes records to filename as CSV or NDJSON, sorted by account, family
+    and control first if sort is set.
+    """
+    if sort:
+        records = external_sort(records)
     with open(filename, 'w') as f:
-        print(csv(COLUMNS), file=f)
-        for env in list_environments():
-            scan = get_latest_scan(env['id'])
-            if not scan:
+        if fmt == 'ndjson':
+            write_ndjson(f, records, columns=columns)
+        else:
+            print(csv(columns), file=f)
+            for record in records:
+                print(format(record, columns=columns), file=f)
+
+
+def export_scans(env_scans, filename=None, sort=False, fmt='csv', total=None):
+    """
+    Writes the compliance results of every (environment, scan) pair as it is
+    produced by env_scans, so results can be exported while later scans are
+    still running. Pairs without a scan are skipped. With sort, the records
+    are sorted by account, family and control (see external_sort()) and are
+    written once all scans have been read. fmt is 'csv' or 'ndjson'. total
+    is the number of environments expected, used for the progress ETA.
+    """
+    if filename is None:
+        filename = default_filename(fmt)
+    reporter = progress.Progress('export', total=total)
+    fugue_client.progress = reporter
+    stats_file = export_stats_path(filename)
+    stats = load_export_stats(stats_file)
+    try:
+        with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+            write_records(records_from_scans(env_scans, reporter, stats, pool), filename, sort, fmt)
+    finally:
+        fugue_client.progress = None
+        save_export_stats(stats, stats_file)
+    reporter.finish()
+    print('Wrote %s' % filename)
+
+
+def partition_key(env, scan, partition_by='environment'):
+    """
+    Returns the (day, provider, environment id or account) partition of the
+    records of a scan of an environment.
+    """
+    day, _ = date_from_timestamp(scan['finished_at'])
+    if partition_by == 'account':
+        value = account_from_environment(env)
+    else:
+        value = env['id']
+    return (day, env['provider'], value)
+
+
+def partition_path(key, partition_by='environment', fmt='csv'):
+    """
+    Returns the path of a partition relative to the output directory, e.g.
+    day=2021-06-01/provider=aws/environment=<id>/compliance.csv
+    """
+    day, provider, value = key
+    value = re.sub(r'[^A-Za-z0-9_.-]', '_', value)
+    return os.path.join('day=' + day, 'provider=' + provider, partition_by + '=' + value, 'compliance.' + fmt)
+
+
+def write_partition(directory, key, env_scans, partition_by='environment', sort=False, fmt='csv', reporter=None,
+                    stats=None, pool=None):
+    """
+    Writes the records of the (environment, scan) pairs of one partition to
+    a temporary file that replaces the partition once it is complete, and
+    returns the manifest entry of the partition.
+    """
+    path = partition_path(key, partition_by, fmt)
+    filename = os.path.join(directory, path)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    count = [0]
+
+    def counted(records):
+        for record in records:
+            count[0] += 1
+            yield record
+
+    partial = filename + '.partial'
+    try:
+        write_records(counted(records_from_scans(env_scans, reporter, stats, pool)), partial, sort, fmt)
+        os.replace(partial, filename)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    day, provider, value = key
+    return {
+        'path': path.replace(os.sep, '/'),
+        'day': day,
+        'provider': provider,
+        partition_by: value,
+        'environment_ids': [env['id'] for env, scan in env_scans],
+        'scan_ids': [scan['id'] for env, scan in env_scans],
+        'records': count[0],
+        'bytes': os.path.getsize(filename),
+        'format': fmt,
+        'written_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+    }
+
+
+def read_manifest(directory):
+    """
+    Returns the partitions listed in the manifest of directory, by path.
+    """
+    filename = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return dict((entry['path'], entry) for entry in json.load(f)['partitions'])
+
+
+def write_manifest(directory, entries):
+    """
+    Updates the manifest of directory with the given partition entries,
+    keeping the entries of partitions that were not rewritten.
+    """
+    partitions = read_manifest(directory)
+    for entry in entries:
+        partitions[entry['path']] = entry
+    manifest = {
+        'updated_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'partitions': [partitions[path] for path in sorted(partitions)],
+    }
+    filename = os.path.join(directory, MANIFEST_NAME)
+    with open(filename + '.partial', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(filename + '.partial', filename)
+
+
+def schedule_partitions(partitions, stats):
+    """
+    Returns the partition keys ordered longest first by the export time of
+    their environments in the previous run, so the longest partitions don't
+    start last and finish alone (longest processing time first).
+    """
+    seconds = estimated_seconds(stats, [env['id'] for env_scans in partitions.values() for env, scan in env_scans])
+    cost = dict((key, sum(seconds[env['id']] for env, scan in env_scans)) for key, env_scans in partitions.items())
+    order = sorted(partitions, key=lambda key: (-cost[key], key))
+    if order and stats:
+        expected = max(cost[order[0]], sum(cost.values()) / PARTITION_WORKERS)
+        print('Exporting %d partitions longest first, expected to take at least %ds' % (len(order), expected))
+    return order
+
+
+def add_retained_scans(directory, partitions, partition_by='environment', fmt='csv'):
+    """
+    Adds to every partition about to be rewritten the (environment, scan)
+    pairs of the environments the manifest lists in it that are not being
+    exported again, so exporting some of the environments of an account
+    (environment_ids, watch mode) keeps the rows of the others. Their
+    results are read again from the scans recorded in the manifest.
+    Environments that no longer exist are dropped. Returns the number of
+    pairs added.
+    """
+    manifest = read_manifest(directory)
+    retained = []
+    for key, env_scans in partitions.items():
+        entry = manifest.get(partition_path(key, partition_by, fmt).replace(os.sep, '/'))
+        if not entry:
+            continue
+        exported = set(env['id'] for env, scan in env_scans)
+        for env_id, scan_id in zip(entry['environment_ids'], entry['scan_ids']):
+            if env_id not in exported:
+                retained.append((key, env_id, scan_id))
+    if not retained:
+        return 0
+    catalog = dict((env['id'], env) for env in list_environments())
+    retained = [(key, env_id, scan_id) for key, env_id, scan_id in retained if env_id in catalog]
+    paths = ['scans/' + scan_id for key, env_id, scan_id in retained]
+    with ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as pool:
+        for (key, env_id, scan_id), scan in zip(retained, pool.map(fugue_client.bind(get), paths)):
+            partitions[key].append((catalog[env_id], scan))
+    return len(retained)
+
+
+def export_partitioned(env_scans, directory, partition_by='environment', sort=False, fmt='csv', total=None):
+    """
+    Writes the compliance results of every (environment, scan) pair into a
+    directory tree partitioned by scan day, provider and environment (or
+    account with partition_by='account'). Each partition is read and
+    written by its own worker, PARTITION_WORKERS at a time, longest first
+    according to the previous run (see schedule_partitions()), and replaces
+    only its own file, so exporting a few environments again rewrites just
+    their partitions. An account partition keeps the rows of the environments
+    of the account that are not exported again (see add_retained_scans()).
+    The manifest is updated when all partitions are done.
+    """
+    if partition_by not in PARTITION_BY:
+        raise ValueError('partition_by must be one of: ' + ', '.join(PARTITION_BY))
+    partitions = {}
+    skipped = 0
+    for env, scan in env_scans:
+        if scan:
+            partitions.setdefault(partition_key(env, scan, partition_by), []).append((env, scan))
+        else:
+            skipped += 1
+    if partition_by == 'account':
+        retained = add_retained_scans(directory, partitions, partition_by, fmt)
+        if total is not None:
+            total += retained
+    stats_file = export_stats_path(directory=directory)
+    stats = load_export_stats(stats_file)
+    order = schedule_partitions(partitions, stats)
+    reporter = progress.Progress('export', total=total)
+    reporter.add(count=skipped)
+    fugue_client.progress = reporter
+    entries = []
+    try:
+        with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as page_pool:
+
+            def write(key):
+                return write_partition(directory, key, partitions[key], partition_by, sort, fmt, reporter, stats, page_pool)
+
+            with ThreadPoolExecutor(max_workers=PARTITION_WORKERS) as pool:
+                for entry in pool.map(fugue_client.bind(write), order):
+                    entries.append(entry)
+    finally:
+        fugue_client.progress = None
+        write_manifest(directory, entries)
+        save_export_stats(stats, stats_file)
+    reporter.finish()
+    print('Wrote %d partitions to %s' % (len(entries), directory))
+
+
+class ScanWatcher(object):
+    """
+    Keeps the environment catalog and the scans already exported in memory
+    and finds the new successful scans with one cheap listing per poll.
+    """
+
+    def __init__(self, environment_ids=None, since=None):
+        self.environment_ids = environment_ids
+        self.since = time.time() if since is None else since
+        self.catalog = {}
+        self.catalog_updated = 0
+        # Finish time of the last exported scan of every environment
+        self.exported = {}
+        # Finish time of the latest scan of the last poll that was exported,
+        # scans are listed from WATCH_MARGIN seconds before it
+        self.cursor = self.since
+        self.listed = self.since
+
+    def refresh_catalog(self):
+        environments = list_environments()
+        if self.environment_ids:
+            environments = [env for env in environments if env['id'] in self.environment_ids]
+        self.catalog = dict((env['id'], env) for env in environments)
+        self.catalog_updated = time.time()
+        progress.log('Environment catalog refreshed: %d environments' % len(self.catalog))
+
+    def new_scans(self):
+        """
+        Returns (environment, scan) pairs for the latest successful scan of
+        every environment that finished since the last exported poll (or
+        since the watcher started). Call mark_exported() once they are written.
+        """
+        now = time.time()
+        if now - self.catalog_updated > WATCH_CATALOG_REFRESH:
+            self.refresh_catalog()
+        latest = {}
+        self.listed = self.cursor
+        range_from = max(now - WATCH_LOOKBACK, self.cursor - WATCH_MARGIN)
+        for scan in fugue_client.list_scans(status='SUCCESS', range_from=range_from):
+            finished = scan.get('finished_at') or 0
+            self.listed = max(self.listed, finished)
+            # Scans are listed most recent first, so the first one of an environment is its latest
+            if scan.get('environment_id') in latest:
                 continue
-            for rule in get_compliance_by_rules(scan['id']):
-                for record in records_from_rule(rule):
-                    record = record_with_metadata(record, env, scan)
-                    print(format(record), file=f)
-    print('Wrote %s' % f.name)
+            if finished < self.since or finished <= self.exported.get(scan.get('environment_id'), 0):
+                continue
+            latest[scan.get('environment_id')] = scan
+        if any(env_id not in self.catalog for env_id in latest) and not self.environment_ids:
+            self.refresh_catalog()
+        return [(self.catalog[env_id], scan) for env_id, scan in latest.items() if env_id in self.catalog]
+
+    def mark_exported(self, env_scans):
+        """
+        Records that the pairs returned by the last new_scans() were written,
+        so the next poll starts after them.
+        """
+        for env, scan in env_scans:
+            self.exported[env['id']] = scan['finished_at']
+        self.cursor = self.listed
+
+
+def watch(filename=None, fmt='csv', interval=WATCH_INTERVAL, partition_dir=None, partition_by='environment',
+          environment_ids=None, max_polls=None):
+    """
+    Runs until interrupted, exporting the compliance results of every scan
+    that finishes after it started as soon as a poll finds it: appended to
+    filename, or written to their partitions under partition_dir. Polls
+    every interval seconds, listing only the recent successful scans, and
+    reuses the environment catalog and API connections between polls. A
+    poll that fails is reported and retried with backoff, its scans are
+    exported by the next poll that succeeds (records appended to filename
+    before the failure are appended again).
+    """
+    if partition_dir and partition_by not in PARTITION_BY:
+        raise ValueError('partition_by must be one of: ' + ', '.join(PARTITION_BY))
+    if filename is None and partition_dir is None:
+        filename = default_filename(fmt)
+    watcher = ScanWatcher(environment_ids)
+    watcher.refresh_catalog()
+    print('Watching %d environments for new scans every %ds' % (len(watcher.catalog), interval))
+    polls = 0
+    failures = 0
+    try:
+        while max_polls is None or polls < max_polls:
+            if failures:
+                time.sleep(min(interval * 2 ** (failures - 1), WATCH_MAX_BACKOFF))
+            elif polls:
+                time.sleep(interval)
+            polls += 1
+            try:
+                env_scans = watcher.new_scans()
+                if not env_scans:
+                    progress.log('No new scans')
+                elif partition_dir:
+                    export_partitioned(env_scans, partition_dir, partition_by, fmt=fmt, total=len(env_scans))
+                else:
+                    count = append_records(records_from_scans(env_scans), filename, fmt)
+                    print('%s: appended %d records of %d new scans to %s' % (
+                        datetime.now().strftime('%Y-%m-%d %H:%M:%S'), count, len(env_scans), filename))
+                watcher.mark_exported(env_scans)
+                failures = 0
+            except (requests.RequestException, ValueError) as error:
+                failures += 1
+                print('%s: poll failed (%s), retrying in %ds' % (
+                    datetime.now().strftime('%Y-%m-%d %H:%M:%S'), error, min(interval * 2 ** (failures - 1), WATCH_MAX_BACKOFF)))
+    except KeyboardInterrupt:
+        print('Stopped watching after %d polls' % polls)
+
+
+class TableWriter(object):
+    """
+    Writes the rows of one table of a star schema export as CSV, with
+    standard quoting for loading into a warehouse, or as NDJSON.
+    """
+
+    def __init__(self, filename, columns, fmt='csv'):
+        self.columns = columns
+        self.fmt = fmt
+        self.rows = 0
+        self.file = open(filename, 'w', newline='' if fmt == 'csv' else None)
+        if fmt == 'csv':
+            self.writer = csv_tables.writer(self.file)
+            self.writer.writerow(columns)
+        else:
+            self.encode = json_encoder()
+
+    def write(self, values):
+        self.rows += 1
+        if self.fmt == 'csv':
+            self.writer.writerow(['' if value is None else value for value in values])
+        else:
+            self.file.write(self.encode(dict(zip(self.columns, values))) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class Dimension(object):
+    """
+    Gives every distinct value of a dimension an integer key, starting at 1,
+    and writes the value to the dimension table the first time it is seen.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.keys = {}
+
+    def key(self, *values):
+        key = self.keys.get(values)
+        if key is None:
+            key = len(self.keys) + 1
+            self.keys[values] = key
+            self.table.write((key,) + values)
+        return key
+
+
+def write_star(records, tables):
+    """
+    Interns the values of every record into the dimensions and writes one
+    fact row of dimension keys per record. tables maps table names (see
+    STAR_TABLES) to TableWriters.
+    """
+    dimensions = dict((name, Dimension(tables[name])) for name, columns in STAR_TABLES if name != 'compliance_facts')
+    facts = tables['compliance_facts']
+    for record in records:
+        environment = dimensions['environments'].key(
+            record['environment_id'], record['environment_name'], record['account'], record['region'])
+        scan = dimensions['scans'].key(record['scan_id'], environment, record['day'], record['time'])
+        control = dimensions['controls'].key(record['family'], record['control'])
+        resource_type = dimensions['resource_types'].key(record['resource_type'])
+        resource = None
+        if record['resource_id'] is not None:
+            resource = dimensions['resources'].key(record['resource_id'], resource_type)
+        message = dimensions['messages'].key(record['message'])
+        facts.write((environment, scan, control, resource_type, resource, message))
+
+
+def export_star(env_scans, directory, fmt='csv', total=None):
+    """
+    Writes the compliance results of every (environment, scan) pair as a
+    star schema under directory: a table for each of environments, scans,
+    controls, resource types, resources and messages, where every distinct
+    value is written once with an integer key, and a compliance_facts table
+    with one row of those keys per result.
+    """
+    os.makedirs(directory, exist_ok=True)
+    tables = dict((name, TableWriter(os.path.join(directory, name + '.' + fmt), columns, fmt))
+                  for name, columns in STAR_TABLES)
+    reporter = progress.Progress('export', total=total)
+    fugue_client.progress = reporter
+    stats_file = export_stats_path(directory=directory)
+    stats = load_export_stats(stats_file)
+    try:
+        with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+            write_star(records_from_scans(env_scans, reporter, stats, pool), tables)
+    finally:
+        fugue_client.progress = None
+        save_export_stats(stats, stats_file)
+        for table in tables.values():
+            table.close()
+    reporter.finish()
+    for name, columns in STAR_TABLES:
+        print('Wrote %d rows to %s' % (tables[name].rows, os.path.join(directory, name + '.' + fmt)))
 
 
+def tenant_records(tenant, reporter):
+    """
+    Generator that yields the compliance records of the latest scans of
+    every environment in one tenant, tagged with the tenant name.
+    """
+    with fugue_client.use_tenant(tenant):
+        environments = list_environments()
+        reporter.add_total(len(environments))
+        latest = get_latest_scans([env['id'] for env in environments])
+        env_scans = ((env, latest.get(env['id'])) for env in environments)
+        for record in records_from_scans(env_scans, reporter):
+            record['tenant'] = tenant.name
+            yield record
+
+
+def produce_tenant_records(tenant, reporter, batches, failed):
+    """
+    Puts the records of one tenant on the batches queue, followed by None
+    when the tenant is done. The name of the tenant is added to failed if
+    its export fails.
+    """
+    batch = []
+    try:
+        for record in tenant_records(tenant, reporter):
+            batch.append(record)
+            if len(batch) >= TENANT_BATCH_SIZE:
+                batches.put(batch)
+                batch = []
+        batches.put(batch)
+    except Exception as error:
+        failed.append(tenant.name)
+        reporter.error('Export failed for tenant %s: %s' % (tenant.name, error))
+    finally:
+        batches.put(None)
+
+
+def records_from_tenants(tenants, reporter, failed):
+    """
+    Generator that yields the records of all tenants, which are read
+    concurrently, in the order they arrive. The names of the tenants whose
+    export failed are added to failed.
+    """
+    batches = queue.Queue(maxsize=TENANT_QUEUE_SIZE)
+    for tenant in tenants:
+        thread = threading.Thread(target=produce_tenant_records, args=(tenant, reporter, batches, failed))
+        thread.daemon = True
+        thread.start()
+    running = len(tenants)
+    while running:
+        batch = batches.get()
+        if batch is None:
+            running -= 1
+            continue
+        for record in batch:
+            yield record
+
+
+def export_tenants(tenants, filename=None, sort=False, fmt='csv'):
+    """
+    Exports the compliance results of several Fugue tenants concurrently,
+    each with its own credentials and rate limit (see
+    fugue_client.load_tenants()), into one output with a tenant column.
+    The output is written to filename.partial and only renamed to filename
+    when every tenant was exported; if any tenant fails, the run exits with
+    status 1 and the partial output is left for inspection.
+    """
+    if filename is None:
+        filename = default_filename(fmt)
+    reporter = progress.Progress('export')
+    fugue_client.progress = reporter
+    failed = []
+    partial = filename + '.partial'
+    try:
+        write_records(records_from_tenants(tenants, reporter, failed), partial, sort, fmt, TENANT_COLUMNS)
+    finally:
+        fugue_client.progress = None
+    reporter.finish()
+    if failed:
+        print('Export failed for %d of %d tenants (%s), incomplete output left in %s' % (
+            len(failed), len(tenants), ', '.join(sorted(failed)), partial))
+        sys.exit(1)
+    os.replace(partial, filename)
+    print('Wrote %s' % filename)
+
+
+def main(filename=None, sort=False, fmt='csv', tenants_file=None, rate_limit=None,
+         partition_dir=None, partition_by='environment', environment_ids=None, watch_interval=None,
+         star_dir=None):
+    """
+    Loop over all Fugue environments in your account and output compliance
+    results from the most recent scan in each. Output is in CSV format, or
+    NDJSON with fmt='ndjson', and is written to compliance-<timestamp>.<fmt>
+    unless a filename is given. With sort, rows are sorted by account, family
+    and control. With a tenants_file, every tenant in it is exported
+    concurrently, limited to rate_limit requests per second per tenant
+    unless the file sets another limit. With a partition_dir, the output is
+    partitioned by day, provider and partition_by under that directory (see
+    export_partitioned()). environment_ids limits the export to those
+    environments. With a watch_interval, new scans are exported as they
+    finish instead (see watch()). With a star_dir, the output is written as
+    dimension tables and a fact table of integer keys (see export_star()).
+    """
+    if tenants_file:
+        export_tenants(fugue_client.load_tenants(tenants_file, rate_limit), filename, sort, fmt)
+        return
+    if watch_interval:
+        watch(filename, fmt, watch_interval, partition_dir, partition_by, environment_ids)
+        return
+    environments = list_environments()
+    if filename is None and partition_dir is None and star_dir is None:
+        filename = default_filename(fmt)
+    prune_export_stats([env['id'] for env in environments], export_stats_path(filename, star_dir or partition_dir))
+    if environment_ids:
+        environments = [env for env in environments if env['id'] in environment_ids]
+    latest = get_latest_scans([env['id'] for env in environments])
+    env_scans = ((env, latest.get(env['id'])) for env in environments)
+    if star_dir:
+        export_star(env_scans, star_dir, fmt, len(environments))
+    elif partition_dir:
+        export_partitioned(env_scans, partition_dir, partition_by, sort, fmt, len(environments))
+    else:
+        export_scans(env_scans, filename, sort, fmt, len(environments))
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,205 @@
+"""
+Streams account inventories from CSV, NDJSON or YAML files into the
+env_creation_* scripts instead of the hardcoded accounts, subscriptions and
+projects maps.
+
+Rows are read, validated and handed to creation one at a time (or one chunk
+at a time), so a 50k row export from a CMDB is processed in constant memory
+and creation starts as soon as the first rows are read. Invalid rows are
+reported with their line (or document) number and skipped.
+
+Supported formats, chosen by file extension:
+
+ * .csv: a header row with the column names. List values such as Azure
+   resource groups are separated with ';'.
+ * .ndjson / .jsonl: one JSON object per line.
+ * .yaml / .yml: a stream of YAML documents separated by '---', each either
+   a single row mapping or a list of row mappings. Requires PyYAML.
+
+Every row needs a 'name' column plus the id columns of its provider, for
+example 'account_id' for AWS or 'project_id' for Google.
+"""
+import csv
+import json
+import re
+
+import progress
+import reconcile_environments
+
+
+class InventoryError(Exception):
+    """
+    Raised when an inventory file cannot be read.
+    """
+
+
+def csv_rows(path):
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def ndjson_rows(path):
+    with open(path) as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield line_num, json.loads(line)
+            except ValueError as error:
+                yield line_num, InventoryError(str(error))
+
+
+def yaml_rows(path):
+    try:
+        import yaml
+    except ImportError:
+        raise InventoryError('Reading YAML inventories requires PyYAML (pip install pyyaml)')
+    with open(path) as f:
+        for doc_num, doc in enumerate(yaml.safe_load_all(f), 1):
+            if isinstance(doc, list):
+                for row in doc:
+                    yield doc_num, row
+            elif doc is not None:
+                yield doc_num, doc
+
+
+def read_rows(path):
+    """
+    Generator that yields (line number, row) for every row in an inventory
+    file. The row is an InventoryError if the line could not be parsed.
+    """
+    lower = path.lower()
+    if lower.endswith('.csv'):
+        return csv_rows(path)
+    if lower.endswith('.ndjson') or lower.endswith('.jsonl'):
+        return ndjson_rows(path)
+    if lower.endswith('.yaml') or lower.endswith('.yml'):
+        return yaml_rows(path)
+    raise InventoryError('Unsupported inventory format: ' + path + ' (use .csv, .ndjson, .jsonl, .yaml or .yml)')
+
+
+def as_list(value):
+    """
+    Returns list values as is and splits CSV style 'a;b' strings.
+    """
+    if isinstance(value, list):
+        return value
+    return [item.strip() for item in str(value).split(';') if item.strip()]
+
+
+def validate_aws_account(row):
+    # Numbers are rejected rather than converted: YAML and JSON drop the
+    # leading zeros of an unquoted id, and YAML reads some of them as octal
+    account_id = row['account_id']
+    if not isinstance(account_id, str):
+        return 'account_id must be a string of 12 digits, quote it so leading zeros are kept'
+    if not re.match(r'^\d{12}$', account_id.strip()):
+        return 'account_id must be 12 digits'
+    return None
+
+
+class Inventory(object):
+    """
+    A lazily read inventory file that can be used in place of the accounts,
+    subscriptions and projects maps: items() yields (name, value) pairs where
+    value is built from each valid row by to_value.
+    """
+
+    def __init__(self, path, required_fields, to_value, validate=None):
+        self.path = path
+        self.required_fields = required_fields
+        self.to_value = to_value
+        self.validate = validate
+        self.valid = 0
+        self.invalid = 0
+
+    def check(self, row):
+        """
+        Returns the reason a row is invalid, or None if it can be used.
+        """
+        if isinstance(row, InventoryError):
+            return str(row)
+        if not isinstance(row, dict):
+            return 'expected a mapping of column names to values'
+        missing = [field for field in self.required_fields
+                   if row.get(field) is None or str(row.get(field)).strip() == '']
+        if missing:
+            return 'missing ' + ', '.join(missing)
+        if self.validate:
+            return self.validate(row)
+        return None
+
+    def count(self):
+        """
+        Returns the number of rows in the file, valid or not, or None for
+        YAML inventories, which would have to be parsed twice to count them.
+        """
+        lower = self.path.lower()
+        if lower.endswith('.yaml') or lower.endswith('.yml'):
+            return None
+        return sum(1 for row in read_rows(self.path))
+
+    def items(self):
+        for line_num, row in read_rows(self.path):
+            error = self.check(row)
+            if error:
+                self.invalid += 1
+                print('Skipping invalid inventory row ' + str(line_num) + ' in ' + self.path + ': ' + error)
+                continue
+            self.valid += 1
+            yield str(row['name']).strip(), self.to_value(row)
+
+    def chunks(self, chunk_size):
+        """
+        Generator that yields the items as dicts of at most chunk_size entries.
+        A chunk ends early at a name it already holds, so rows with the same
+        name are not lost.
+        """
+        chunk = {}
+        for name, value in self.items():
+            if name in chunk:
+                yield chunk
+                chunk = {}
+            chunk[name] = value
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = {}
+        if chunk:
+            yield chunk
+
+
+def create_from_inventory(inventory, build_env_defs, existing_ids, id_of, chunk_size=500, workers=8):
+    """
+    Creates environments for an inventory one chunk at a time. build_env_defs
+    turns a chunk (a dict like the scripts' accounts map) into environment
+    definitions. Items whose id_of(value) is in existing_ids are skipped, and
+    ids are added to existing_ids as they are queued so duplicate rows are
+    only created once; pass None to allow duplicates. Returns the number of
+    failed creations. Progress is counted in inventory rows, out of the
+    number of rows in the file when it can be counted up front, and the
+    environments are counted separately.
+    """
+    failures = 0
+    reporter = progress.Progress('inventory', total=inventory.count(), unit='rows')
+    rows = 0
+    for chunk in inventory.chunks(chunk_size):
+        if existing_ids is not None:
+            for name, value in list(chunk.items()):
+                item_id = id_of(value)
+                if item_id in existing_ids:
+                    progress.log("Found id in existing environment list. Skipping environment creation for - " + name + ": " + item_id)
+                    reporter.add('skipped')
+                    del chunk[name]
+                else:
+                    existing_ids.add(item_id)
+        env_defs = list(build_env_defs(chunk))
+        failures += reconcile_environments.apply_in_batches(reconcile_environments.create_environment, env_defs, workers, chunk_size, reporter, 'environments')
+        # Invalid rows were skipped while the chunk was read and are done too
+        reporter.add(count=inventory.valid + inventory.invalid - rows)
+        rows = inventory.valid + inventory.invalid
+    reporter.finish()
+    print ("Inventory processed: " + str(inventory.valid) + " valid rows, " + str(inventory.invalid) + " invalid rows, " + str(failures) + " failed creations")
+    return failures
@@ -0,0 +1,159 @@
+# This script is for Python v.3.6 and above and requires the Requests module (pip install requests)
+# AWS sources require boto3 (pip install boto3) and Google sources google-cloud-resource-manager==0.30.3
+
+import fugue_client
+import reconcile_environments
+
+# Deletes or disables the Fugue environments of accounts and projects that no longer exist.
+# When an AWS account is closed or suspended (its status in AWS Organizations is no longer ACTIVE) or a Google project
+# leaves the Active lifecycle state, its environments stay in Fugue and keep being scanned and exported. This script
+# discovers the accounts and projects with their status, joins the existing environments against them on their account
+# or project id (each inventory is a hash map, so every environment is looked up once) and deletes or disables the
+# environments of accounts and projects that are no longer active, with a rate limited pool of workers.
+
+# Common parameters that can be configured as needed
+
+# aws_sources: list of AWS Organizations whose environments are checked. Each entry has the AWS profile used to read the
+    # org and the Fugue provider ("aws" or "aws_govcloud") of its environments. The whole org is listed, without the OU
+    # filters and cache of env_creation_AWS_org.py, so accounts outside an onboarded OU are not taken for closed accounts.
+# google_keyfile: Default = None. Path to the JSON key file of a Google service account that can list the projects of the
+    # org. If set, Google environments are checked as well.
+# action: "disable" (default) turns off the scheduled scans of orphaned environments, "delete" deletes them.
+# delete_missing_accounts: Default = False. If set to True, environments of accounts and projects that are not listed at all
+    # (for example accounts that left the organization, or projects the service account cannot see) are treated as orphans
+    # too. By default only accounts and projects listed with a status other than ACTIVE are.
+# max_orphan_fraction: Safety limit. If more than this fraction of the environments of a provider look orphaned (for example
+    # because the wrong profile was used), nothing is changed for that provider.
+# rate_limit: Maximum number of delete or disable requests sent per second.
+# workers: Number of requests sent concurrently.
+# dry_run: Default = True. If set to True, the orphaned environments are printed and nothing is changed.
+
+aws_sources = [
+    {"profile": "fugueorg", "provider": "aws"},
+]
+google_keyfile = None
+action = "disable"
+delete_missing_accounts = False
+max_orphan_fraction = 0.2
+rate_limit = 5
+workers = 8
+dry_run = True
+
+# The Fugue API URL and credentials are handled by fugue_client.py. Client ID and secret are read from the
+# FUGUE_API_ID and FUGUE_API_SECRET environment variables when the first request is made, follow the guide here
+# to create an API client: https://docs.fugue.co/api.html#getting-started
+
+def get_aws_account_statuses(profile):
+    """
+    Returns a map of the ids of the accounts in the AWS Organization of profile to their status (ACTIVE, SUSPENDED...)
+    """
+    import boto3
+    from botocore.config import Config
+    import env_creation_AWS_org
+    session = boto3.Session(profile_name=profile)
+    org_client = session.client("organizations", config=Config(retries={"max_attempts": 10, "mode": "standard"}))
+    accounts = env_creation_AWS_org.discover_accounts(org_client, workers=env_creation_AWS_org.discovery_workers)
+    return dict((account["Id"], account["Status"]) for account in accounts)
+
+def get_google_project_statuses(keyfile):
+    """
+    Returns a map of the ids of the projects the Google service account can see to their lifecycle state
+    (ACTIVE, DELETE_REQUESTED...)
+    """
+    from google.cloud import resource_manager
+    org_client = resource_manager.Client.from_service_account_json(keyfile)
+    return dict((project.project_id, project.status) for project in org_client.list_projects())
+
+def count_active(statuses):
+    return len([status for status in statuses.values() if status == "ACTIVE"])
+
+def get_inventory():
+    """
+    Returns a map of Fugue provider to a map of account or project ids to their status
+    """
+    inventory = {}
+    for source in aws_sources:
+        accounts = get_aws_account_statuses(source["profile"])
+        print ("Found " + str(len(accounts)) + " accounts (" + str(count_active(accounts)) + " active) with profile " + source["profile"])
+        inventory.setdefault(source["provider"], {}).update(accounts)
+    if google_keyfile:
+        projects = get_google_project_statuses(google_keyfile)
+        print ("Found " + str(len(projects)) + " Google projects (" + str(count_active(projects)) + " active)")
+        inventory["google"] = projects
+    return inventory
+
+def owner_id(env):
+    """
+    Returns the AWS account id or Google project id an environment scans
+    """
+    return reconcile_environments.environment_key(env)[1]
+
+def find_orphans(environments, inventory, delete_missing_accounts=False):
+    """
+    Returns a map of provider to the environments whose account or project is listed in the inventory with a
+    status other than ACTIVE, or is not listed at all if delete_missing_accounts is set. Providers without an
+    inventory are not checked.
+    """
+    orphans = {}
+    for env in environments:
+        statuses = inventory.get(env["provider"])
+        if statuses is None:
+            continue
+        status = statuses.get(owner_id(env))
+        if (status is None and delete_missing_accounts) or (status is not None and status != "ACTIVE"):
+            orphans.setdefault(env["provider"], []).append(env)
+    return orphans
+
+def disable_environment(env):
+    resp = fugue_client.patch('environments/' + env['id'], {'scan_schedule_enabled': False})
+    if resp.status_code != 200:
+        return (False, 'Disabling scans failed for ' + env['name'] + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text))
+    return (True, 'Scans disabled for ' + env['name'] + ' and environment id: ' + env['id'])
+
+def rate_limited(function, limiter):
+    def limited(env):
+        limiter.acquire()
+        return function(env)
+    limited.__name__ = function.__name__
+    return limited
+
+def main():
+    """
+    Find the environments of closed accounts and inactive projects and delete or disable them
+    """
+    if action not in ("disable", "delete"):
+        print ("action must be \"disable\" or \"delete\"")
+        return
+    inventory = get_inventory()
+    print ("Retrieving existing environments from Fugue" + "\n")
+    environments = []
+    for provider in sorted(inventory):
+        environments += fugue_client.list_environments(provider)
+    orphans = find_orphans(environments, inventory, delete_missing_accounts)
+
+    targets = []
+    for provider in sorted(inventory):
+        found = orphans.get(provider, [])
+        # The safety limit is checked against every environment of the provider, disabled or not
+        total = len([env for env in environments if env["provider"] == provider])
+        print (provider + ": " + str(len(found)) + " of " + str(total) + " environments have no active account or project")
+        if total and len(found) > max_orphan_fraction * total:
+            print ("    More than " + str(int(max_orphan_fraction * 100)) + "% of the " + provider + " environments look orphaned, skipping " + provider + ". Check the inventory source or raise max_orphan_fraction.")
+            continue
+        if action == "disable":
+            # Environments whose scans are already disabled don't need to be changed again
+            found = [env for env in found if env.get('scan_schedule_enabled')]
+        targets += found
+
+    if dry_run:
+        for env in targets:
+            print ("Would " + action + ": " + env["name"] + " (" + env["id"] + ")")
+        print ("\n" + "Dry run, nothing was changed. Set dry_run = False to " + action + " " + str(len(targets)) + " environments.")
+        return
+    function = reconcile_environments.delete_environment if action == "delete" else disable_environment
+    limiter = fugue_client.RateLimiter(rate_limit)
+    failures = reconcile_environments.apply_in_batches(rate_limited(function, limiter), targets, workers, 50)
+    print (str(len(targets) - failures) + " environments " + ("deleted" if action == "delete" else "disabled") + ", " + str(failures) + " failed")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Progress, throughput and ETA reporting for long runs.
+
+Instead of a line for every environment, long running loops count what they
+do on a Progress reporter, which prints one summary line at most every
+interval seconds, for example:
+
+    [export] 1200/10000 environments (12.0%) | 4.1 environments/s | 2310 records/s | 9.8 pages/s | 2 errors | ETA 0:35:46
+
+Besides the items done, any named counter (records, pages, created, ...) can
+be added and is shown with its rate. Per-item messages go through log(),
+which only prints when verbose output is enabled, while errors are always
+printed.
+"""
+import datetime
+import threading
+import time
+
+
+# Set to True to print a line for every environment, account or record
+verbose = False
+
+
+def log(message):
+    """
+    Prints a per-item message when verbose output is enabled.
+    """
+    if verbose:
+        print(message)
+
+
+class Progress(object):
+    """
+    Thread safe counters for a run with throttled progress output.
+    """
+
+    def __init__(self, label, total=None, unit='environments', interval=5.0):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_report = self.start
+        self.done = 0
+        self.errors = 0
+        self.counters = {}
+
+    def add(self, counter=None, count=1):
+        """
+        Adds count to a named counter, or to the items done when no counter
+        is given, and reports if the last report is older than interval.
+        """
+        with self.lock:
+            if counter is None:
+                self.done += count
+            else:
+                self.counters[counter] = self.counters.get(counter, 0) + count
+        self.report()
+
+    def add_total(self, count):
+        """
+        Adds count to the total, for runs that discover their work as they go.
+        """
+        with self.lock:
+            self.total = (self.total or 0) + count
+
+    def error(self, message=None):
+        """
+        Counts an error, printing its message if one is given.
+        """
+        if message:
+            print(message)
+        with self.lock:
+            self.errors += 1
+        self.report()
+
+    def rate(self, count, elapsed):
+        return count / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            parts = []
+            if self.total:
+                parts.append('%d/%d %s (%.1f%%)' % (self.done, self.total, self.unit, 100.0 * self.done / self.total))
+            else:
+                parts.append('%d %s' % (self.done, self.unit))
+            done_rate = self.rate(self.done, elapsed)
+            parts.append('%.1f %s/s' % (done_rate, self.unit))
+            for counter in sorted(self.counters):
+                parts.append('%d %s (%.1f/s)' % (self.counters[counter], counter, self.rate(self.counters[counter], elapsed)))
+            parts.append('%d errors' % self.errors)
+            if self.total and done_rate > 0:
+                remaining = max(0, self.total - self.done) / done_rate
+                parts.append('ETA %s' % datetime.timedelta(seconds=int(remaining)))
+        return '[%s] %s' % (self.label, ' | '.join(parts))
+
+    def report(self, force=False):
+        """
+        Prints the summary line if force is set or interval seconds have
+        passed since the last one.
+        """
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_report < self.interval:
+                return
+            self.last_report = now
+        print(self.summary())
+
+    def finish(self):
+        """
+        Prints the final summary line with the total elapsed time.
+        """
+        print(self.summary() + ' | done in %s' % datetime.timedelta(seconds=int(time.time() - self.start)))
@@ -0,0 +1,242 @@
+"""
+Reconciles the environments that should exist in Fugue with the environments
+that already do.
+
+The env_creation_* scripts build the desired set of environment definitions
+(the same bodies they would POST) and hand them to reconcile(). Existing
+environments are listed once and indexed by an identity key, the desired set
+is diffed against that index in a single pass, and only the delta is applied:
+
+ * environments that do not exist yet are created
+ * environments whose settings differ (for example survey_resource_types or
+   compliance_families) are updated in place instead of being recreated
+ * optionally, environments that are no longer desired are deleted
+
+Changes are applied in batches with a small pool of worker threads.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+
+import env_payloads
+import fugue_client
+import progress
+
+
+# Environment settings that are compared between the desired and existing
+# environments. Anything not listed here is left untouched by an update.
+COMPARED_FIELDS = [
+    'name',
+    'compliance_families',
+    'survey_resource_types',
+    'remediate_resource_types',
+    'scan_schedule_enabled',
+    'scan_interval',
+]
+
+# Fields whose order is not significant and are compared as sorted lists.
+UNORDERED_FIELDS = [
+    'compliance_families',
+    'survey_resource_types',
+    'remediate_resource_types',
+]
+
+
+def account_from_role_arn(role_arn):
+    """
+    Returns the AWS account ID portion of the given IAM role ARN.
+    """
+    parts = role_arn.split(':')
+    if len(parts) == 6:
+        return parts[4]
+    return '-'
+
+
+def environment_key(env):
+    """
+    Returns the identity of an environment: the provider plus the account,
+    region(s), subscription or project it scans. Two environments with the
+    same key scan the same thing.
+    """
+    provider = env['provider']
+    opts = env['provider_options'][provider]
+    if provider in ('aws', 'aws_govcloud'):
+        if 'regions' in opts:
+            regions = ','.join(sorted(opts['regions']))
+        else:
+            regions = opts.get('region', '')
+        return (provider, account_from_role_arn(opts['role_arn']), regions)
+    elif provider == 'azure':
+        return (provider, opts['subscription_id'])
+    elif provider == 'google':
+        return (provider, opts['project_id'])
+    return (provider, env.get('name'))
+
+
+def comparable_settings(env):
+    """
+    Returns the subset of an environment's settings that reconcile compares,
+    normalized so that equivalent environments compare equal.
+    """
+    settings = {}
+    for field in COMPARED_FIELDS:
+        if field not in env:
+            continue
+        value = env[field]
+        if field in UNORDERED_FIELDS and value is not None:
+            value = sorted(value)
+        settings[field] = value
+    return settings
+
+
+def fingerprint(settings):
+    """
+    Returns a short stable hash of the given comparable settings.
+    """
+    encoded = json.dumps(settings, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def diff_environments(desired, existing):
+    """
+    Compares the desired environment definitions with the existing Fugue
+    environments and returns a plan dict with 'create', 'update', 'delete'
+    and 'unchanged' lists.
+
+    Existing environments are indexed by environment_key() so the desired set
+    is walked exactly once. Each 'update' entry is a tuple of
+    (environment id, changed settings). Duplicate existing environments for
+    the same key are reported for deletion after the first one.
+    """
+    index = {}
+    duplicates = []
+    for env in existing:
+        key = environment_key(env)
+        if key in index:
+            duplicates.append(env)
+        else:
+            index[key] = env
+
+    plan = {'create': [], 'update': [], 'delete': [], 'unchanged': []}
+    seen = set()
+    for env_def in desired:
+        key = environment_key(env_def)
+        if key in seen:
+            continue
+        seen.add(key)
+        current = index.pop(key, None)
+        if current is None:
+            plan['create'].append(env_def)
+            continue
+        wanted = comparable_settings(env_def)
+        actual = comparable_settings(current)
+        if fingerprint(wanted) == fingerprint(actual):
+            plan['unchanged'].append(current)
+            continue
+        changes = dict((field, env_def[field]) for field, value in wanted.items()
+                       if actual.get(field) != value)
+        plan['update'].append((current['id'], changes))
+
+    plan['delete'] = list(index.values()) + duplicates
+    return plan
+
+
+def batches(items, batch_size):
+    """
+    Splits a list into consecutive lists of at most batch_size items.
+    """
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def create_environment(env_def):
+    if isinstance(env_def, env_payloads.EncodedPayload):
+        name = env_def.name
+        resp = fugue_client.post_encoded('environments', env_def.body, env_def.content_encoding)
+    else:
+        name = env_def['name']
+        resp = fugue_client.post('environments', env_def)
+    if resp.status_code != 201:
+        return (False, 'Environment creation failed for ' + name + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text))
+    return (True, 'Environment created with environment name: ' + resp.json()['name'] + ' and environment id: ' + resp.json()['id'])
+
+
+def update_environment(update):
+    env_id, changes = update
+    resp = fugue_client.patch('environments/' + env_id, changes)
+    if resp.status_code != 200:
+        return (False, 'Environment update failed for environment id: ' + env_id + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text))
+    return (True, 'Environment updated for environment id: ' + env_id + ' (' + ', '.join(sorted(changes)) + ')')
+
+
+def delete_environment(env):
+    resp = fugue_client.delete('environments/' + env['id'])
+    if resp.status_code not in (200, 202, 204):
+        return (False, 'Environment deletion failed for ' + env['name'] + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text))
+    return (True, 'Environment deleted: ' + env['name'] + ' and environment id: ' + env['id'])
+
+
+def apply_in_batches(action, items, workers=8, batch_size=50, reporter=None, counter=None):
+    """
+    Runs action over items in batches of batch_size using a pool of worker
+    threads. Returns the number of items that failed. Progress is counted on
+    reporter, or on a reporter of its own if none is given, as items done or
+    on the named counter if one is given; the message of every item is only
+    printed in verbose mode, failures always are.
+    """
+    own_reporter = reporter is None
+    if own_reporter:
+        reporter = progress.Progress(action.__name__, total=len(items))
+    failures = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in batches(items, batch_size):
+            for ok, message in pool.map(action, batch):
+                if ok:
+                    progress.log(message)
+                    reporter.add(counter)
+                else:
+                    failures += 1
+                    reporter.error(message)
+                    # Failed items are done too, so the ETA covers the whole run
+                    reporter.add(counter)
+    if own_reporter and items:
+        reporter.finish()
+    return failures
+
+
+def apply_plan(plan, allow_deletes=False, workers=8, batch_size=50, dry_run=False):
+    """
+    Applies a plan returned by diff_environments(). Deletes are only applied
+    when allow_deletes is True. With dry_run the plan is printed but nothing
+    is changed. Returns the number of failed operations.
+    """
+    print('Reconcile plan: %d to create, %d to update, %d unchanged, %d not desired' % (
+        len(plan['create']), len(plan['update']), len(plan['unchanged']), len(plan['delete'])))
+    if dry_run:
+        for env_def in plan['create']:
+            print('Would create: ' + env_def['name'])
+        for env_id, changes in plan['update']:
+            print('Would update: ' + env_id + ' (' + ', '.join(sorted(changes)) + ')')
+        if allow_deletes:
+            for env in plan['delete']:
+                print('Would delete: ' + env['name'] + ' (' + env['id'] + ')')
+        return 0
+
+    failures = apply_in_batches(create_environment, plan['create'], workers, batch_size)
+    failures += apply_in_batches(update_environment, plan['update'], workers, batch_size)
+    if allow_deletes:
+        failures += apply_in_batches(delete_environment, plan['delete'], workers, batch_size)
+    elif plan['delete']:
+        print('Skipping deletion of %d environments not in the desired set (deletes are disabled)' % len(plan['delete']))
+    return failures
+
+
+def reconcile(provider, desired, allow_deletes=False, workers=8, batch_size=50, dry_run=False):
+    """
+    Lists the existing environments for provider, diffs them with the desired
+    environment definitions and applies the delta.
+    """
+    print('Retrieving existing ' + provider + ' environments from Fugue' + '\n')
+    existing = list(fugue_client.list_environments(provider))
+    plan = diff_environments(desired, existing)
+    return apply_plan(plan, allow_deletes, workers, batch_size, dry_run)
@@ -0,0 +1,176 @@
+"""
+Hedged requests for the read-only calls to the Fugue API.
+
+A handful of slow responses at the tail decide when a run over thousands of
+environments finishes. With hedging enabled (fugue_client.enable_hedging()),
+a GET request that has not answered within an adaptive deadline is sent a
+second time. The original request is sent from the calling thread, so its
+latency never includes time spent waiting for a worker, and only the
+duplicates are sent from a pool of workers. When the original returns, the
+duplicate's response is used instead if it arrived first; if the original
+fails, the duplicate's response is waited for. The unused response is
+closed.
+
+The deadline is a percentile (p95 by default) of the recent latencies of the
+same kind of request, so only requests that are slow compared to their peers
+are duplicated. Until enough latencies have been seen, initial_delay is used.
+The extra load is capped by a global budget: at most budget duplicates per
+request sent, plus a small burst allowance.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+
+class LatencyTracker(object):
+    """
+    Keeps the latencies of the last window requests of each kind.
+    """
+
+    def __init__(self, window=500):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, key, latency):
+        with self.lock:
+            if key not in self.samples:
+                self.samples[key] = collections.deque(maxlen=self.window)
+            self.samples[key].append(latency)
+
+    def percentile(self, key, percentile, min_samples):
+        """
+        Returns the given percentile of the latencies for key, or None if
+        fewer than min_samples latencies have been recorded.
+        """
+        with self.lock:
+            samples = sorted(self.samples.get(key, ()))
+        if len(samples) < min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100.0))
+        return samples[index]
+
+
+class Timer(object):
+    """
+    Runs short functions after a delay, all on one background thread.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def call_later(self, delay, function):
+        with self.condition:
+            heapq.heappush(self.heap, (time.time() + delay, next(self.order), function))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+                _, _, function = heapq.heappop(self.heap)
+            function()
+
+
+def close_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+class HedgePolicy(object):
+    """
+    Sends a duplicate of a request that is slower than the percentile
+    deadline for its kind, within a global budget of duplicates.
+    """
+
+    def __init__(self, percentile=95, initial_delay=1.0, min_delay=0.05, budget=0.05, burst=10,
+                 workers=32, window=500, min_samples=20):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.budget = budget
+        self.burst = burst
+        self.min_samples = min_samples
+        self.latencies = LatencyTracker(window)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.timer = Timer()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def deadline(self, key):
+        latency = self.latencies.percentile(key, self.percentile, self.min_samples)
+        if latency is None:
+            return self.initial_delay
+        return max(latency, self.min_delay)
+
+    def try_hedge(self):
+        """
+        Takes one duplicate from the budget. Returns False when it is used up.
+        """
+        with self.lock:
+            if self.hedges >= self.budget * self.requests + self.burst:
+                return False
+            self.hedges += 1
+            return True
+
+    def run(self, key, send, send_backup=None):
+        """
+        Returns the response of send(), called in the calling thread. If it
+        has not returned within the deadline for key, send_backup() (send()
+        if not given) is called from the pool, and its response is returned
+        instead if it arrives first or if send() fails.
+        """
+        with self.lock:
+            self.requests += 1
+        attempt = {'done': False, 'backup': None}
+        attempt_lock = threading.Lock()
+
+        def hedge():
+            with attempt_lock:
+                if not attempt['done'] and self.try_hedge():
+                    attempt['backup'] = self.pool.submit(send_backup or send)
+        self.timer.call_later(self.deadline(key), hedge)
+
+        start = time.time()
+        try:
+            resp = send()
+        except Exception:
+            with attempt_lock:
+                attempt['done'] = True
+            if attempt['backup'] is None:
+                raise
+            # A failed attempt only wins if the other one fails too
+            resp = attempt['backup'].result()
+            with self.lock:
+                self.hedge_wins += 1
+            return resp
+        self.latencies.record(key, time.time() - start)
+        with attempt_lock:
+            attempt['done'] = True
+        backup = attempt['backup']
+        if backup is None:
+            return resp
+        if backup.done() and backup.exception() is None:
+            resp.close()
+            with self.lock:
+                self.hedge_wins += 1
+            return backup.result()
+        backup.add_done_callback(close_response)
+        return resp
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'hedges': self.hedges, 'hedge_wins': self.hedge_wins}
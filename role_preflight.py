@@ -0,0 +1,171 @@
+"""
+Pre-flight check that the Fugue IAM role can be assumed in every account.
+
+The onboarding scripts build the role ARN of each account from rolename and
+create the environment without checking it. An account without the role, or
+with a trust policy that does not allow it to be assumed, ends up with an
+environment whose scans fail. With preflight_roles enabled, the AWS scripts
+first call STS AssumeRole for the role of every target account, with a
+bounded pool of concurrent checks, and only accounts whose role could be
+assumed go on to creation.
+
+Roles that could be assumed are cached in PREFLIGHT_CACHE_FILE for
+PREFLIGHT_CACHE_TTL seconds, so repeat runs only check new accounts.
+Accounts whose role was denied, or whose check failed with throttling or
+connection errors, are reported and skipped, and checked again on the next
+run, so an account is picked up as soon as its role is fixed. The STS endpoint can be changed
+with endpoint_url, for a regional endpoint or a local STS stand-in.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+import time
+
+import progress
+
+
+# Number of AssumeRole calls made concurrently
+PREFLIGHT_WORKERS = 16
+
+# Cache of the roles that could be assumed, by profile and role ARN. Set
+# PREFLIGHT_CACHE_TTL to 0 to disable the cache.
+PREFLIGHT_CACHE_FILE = '.role_preflight_cache.json'
+PREFLIGHT_CACHE_TTL = 86400
+
+# Session name of the AssumeRole calls, shown in the CloudTrail logs of the
+# target accounts
+SESSION_NAME = 'fugue-onboarding-preflight'
+
+# Error codes that mean the role does not exist or does not trust the caller
+DENIED_CODES = ('AccessDenied', 'AccessDeniedException', 'InvalidClientTokenId')
+
+ARN_PARTITIONS = {
+    'aws': 'aws',
+    'aws_govcloud': 'aws-us-gov',
+}
+
+cache_lock = threading.Lock()
+
+
+def role_arn(provider, acct_id, rolename):
+    """
+    Returns the ARN of the role Fugue assumes in an account, as it is put in
+    the environment definition.
+    """
+    return 'arn:' + ARN_PARTITIONS[provider] + ':iam::' + acct_id + ':role/' + rolename
+
+
+class RoleChecker(object):
+    """
+    Checks with STS AssumeRole that roles can be assumed with the credentials
+    of an AWS profile.
+    """
+
+    def __init__(self, profile=None, external_id=None, endpoint_url=None, region_name=None,
+                 workers=PREFLIGHT_WORKERS, sts_client=None):
+        self.profile = profile
+        self.external_id = external_id
+        self.endpoint_url = endpoint_url
+        self.region_name = region_name
+        self.workers = workers
+        self.sts = sts_client
+        self.lock = threading.Lock()
+        self.cache = load_cache()
+        self.checked = {}
+
+    def client(self):
+        # boto3 clients can be shared between threads but sessions can't, so
+        # one client is created up front and used by every check
+        with self.lock:
+            if self.sts is None:
+                import boto3
+                from botocore.config import Config
+                session = boto3.Session(profile_name=self.profile)
+                self.sts = session.client('sts', endpoint_url=self.endpoint_url, region_name=self.region_name,
+                                          config=Config(retries={'max_attempts': 5, 'mode': 'standard'}))
+            return self.sts
+
+    def cache_key(self, arn):
+        return (self.profile or '') + '|' + arn
+
+    def assume(self, arn):
+        """
+        Returns a tuple of (result, reason) for one role, where result is
+        'ok', 'denied' or 'error'.
+        """
+        from botocore.exceptions import BotoCoreError, ClientError
+        params = {'RoleArn': arn, 'RoleSessionName': SESSION_NAME, 'DurationSeconds': 900}
+        if self.external_id:
+            params['ExternalId'] = self.external_id
+        try:
+            self.client().assume_role(**params)
+        except ClientError as error:
+            code = error.response.get('Error', {}).get('Code', '')
+            message = error.response.get('Error', {}).get('Message', '')
+            if code in DENIED_CODES:
+                return ('denied', code + ': ' + message)
+            return ('error', code + ': ' + message)
+        except BotoCoreError as error:
+            return ('error', str(error))
+        return ('ok', '')
+
+    def check(self, arn):
+        """
+        Returns a tuple of (result, reason) for one role, from the cache if
+        it could be assumed less than PREFLIGHT_CACHE_TTL seconds ago.
+        """
+        key = self.cache_key(arn)
+        entry = self.cache.get(key)
+        if entry and time.time() - entry['checked_at'] < PREFLIGHT_CACHE_TTL:
+            return (entry['result'], entry['reason'])
+        result, reason = self.assume(arn)
+        if result == 'ok':
+            with self.lock:
+                self.checked[key] = {'result': result, 'reason': reason, 'checked_at': time.time()}
+        return (result, reason)
+
+    def filter(self, accounts, provider, rolename):
+        """
+        Returns the accounts (a map of account names and ids) whose role can
+        be assumed, checking PREFLIGHT_WORKERS roles at a time. Every other
+        account is reported with the reason it was skipped.
+        """
+        names = list(accounts)
+        arns = [role_arn(provider, accounts[name], rolename) for name in names]
+        reporter = progress.Progress('preflight', total=len(names), unit='roles')
+        valid = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for name, arn, (result, reason) in zip(names, arns, pool.map(self.check, arns)):
+                if result == 'ok':
+                    valid[name] = accounts[name]
+                    reporter.add('valid')
+                elif result == 'denied':
+                    reporter.error('Skipping ' + name + ': ' + accounts[name] + ', role ' + arn + ' cannot be assumed (' + reason + '), it is checked again on the next run')
+                else:
+                    reporter.error('Skipping ' + name + ': ' + accounts[name] + ', role check for ' + arn + ' failed (' + reason + '), it is checked again on the next run')
+                reporter.add()
+        save_cache(self.checked)
+        reporter.finish()
+        return valid
+
+
+def load_cache():
+    if not PREFLIGHT_CACHE_TTL or not os.path.exists(PREFLIGHT_CACHE_FILE):
+        return {}
+    try:
+        with open(PREFLIGHT_CACHE_FILE) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_cache(entries):
+    if not PREFLIGHT_CACHE_TTL or not entries:
+        return
+    # Several checkers can run at once (see env_creation_AWS_multi_org.py) so serialize updates to the file
+    with cache_lock:
+        cache = load_cache()
+        cache.update(entries)
+        with open(PREFLIGHT_CACHE_FILE, 'w') as f:
+            json.dump(cache, f)
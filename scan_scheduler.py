@@ -0,0 +1,164 @@
+# This script is for Python v.3.6 and above and requires the Requests module (pip install requests)
+
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import math
+import sys
+import time
+import fugue_client
+
+# Spreads the scans of the Fugue environments evenly over their scan interval.
+# Environments onboarded in bulk are created within minutes of each other with the same scan_interval, so their scans
+# keep running at the same time. Fugue schedules the next scan of an environment scan_interval after its last one, so
+# this script plans a start offset for every environment, balancing the expected cost of the scans in each wave using
+# the durations of their past scans, and then triggers the scans one wave at a time. From then on the scheduled scans
+# keep the staggered offsets.
+
+# Common parameters that can be configured as needed
+
+# provider: Default = None (all providers). Only schedule the environments of this provider, e.g. "aws".
+# spread_seconds: Default = None. Window the scans are spread over. None uses the shortest scan_interval of the environments.
+# wave_seconds: Time between two waves of scans. The window is split in spread_seconds / wave_seconds waves.
+# max_scans_per_wave: Concurrency cap. At most this many scans are triggered in one wave. If the environments don't fit in the
+    # waves of the window at this cap, the cap is raised (with a warning) so the schedule still fits in the scan interval.
+# history_days: Number of days of past successful scans used to estimate the cost (duration) of each environment's scan.
+    # Environments without a past scan are assumed to cost the median duration.
+# workers: Number of scan requests sent concurrently within a wave.
+# dry_run: Default = True. If set to True, the plan is printed and no scans are triggered.
+
+provider = None
+spread_seconds = None
+wave_seconds = 300
+max_scans_per_wave = 50
+history_days = 7
+workers = 8
+dry_run = True
+
+# The Fugue API URL and credentials are handled by fugue_client.py. Client ID and secret are read from the
+# FUGUE_API_ID and FUGUE_API_SECRET environment variables when the first request is made, follow the guide here
+# to create an API client: https://docs.fugue.co/api.html#getting-started
+
+def get_scheduled_environments():
+    """
+    Returns the environments that have scheduled scans enabled
+    """
+    return [env for env in fugue_client.list_environments(provider) if env.get('scan_schedule_enabled')]
+
+def get_scan_costs(env_ids):
+    """
+    Returns a map of environment id to the average duration in seconds of its successful scans in the last
+    history_days, listing the scans of all environments in a few paginated calls
+    """
+    durations = {}
+    range_from = time.time() - history_days * 86400
+    for scan in fugue_client.list_scans(status='SUCCESS', range_from=range_from):
+        env_id = scan.get('environment_id')
+        if env_id in env_ids and scan.get('finished_at') is not None and scan.get('created_at') is not None:
+            durations.setdefault(env_id, []).append(scan['finished_at'] - scan['created_at'])
+    return dict((env_id, float(sum(values)) / len(values)) for env_id, values in durations.items())
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def plan_waves(environments, costs, window, wave_seconds, max_per_wave):
+    """
+    Assigns every environment to a wave so the total expected scan cost of the waves is as even as possible.
+    The most expensive scans are placed first, each in the wave with the least cost so far that still has room.
+    Returns a list of waves, each a list of (environment, cost). If the environments don't fit in the waves of the
+    window at max_per_wave, the cap is raised so the last wave still starts within the window.
+    """
+    wave_count = max(1, int(window // wave_seconds))
+    needed = int(math.ceil(len(environments) / float(wave_count)))
+    if needed > max_per_wave:
+        print ("Warning: " + str(len(environments)) + " environments don't fit in " + str(wave_count) + " waves of " + str(max_per_wave) + " scans within " + str(int(window)) + "s, raising the cap to " + str(needed) + " scans per wave. Lower wave_seconds or raise spread_seconds to keep the cap.")
+        max_per_wave = needed
+    default_cost = median(list(costs.values()))
+    by_cost = sorted(environments, key=lambda env: costs.get(env['id'], default_cost), reverse=True)
+    waves = [[] for _ in range(wave_count)]
+    # Waves with the same cost are filled in an order that spaces them evenly over the window, so a few
+    # environments in many waves don't all end up in the first waves
+    used = min(len(environments), wave_count) or 1
+    order = [int(k * wave_count / float(used)) for k in range(used)]
+    spaced = set(order)
+    order += [index for index in range(wave_count) if index not in spaced]
+    # Heap of (total cost, scan count, fill order, wave index) for the waves that can take another environment
+    loads = [(0.0, 0, rank, index) for rank, index in enumerate(order)]
+    heapq.heapify(loads)
+    for env in by_cost:
+        cost = costs.get(env['id'], default_cost)
+        load, count, rank, index = heapq.heappop(loads)
+        waves[index].append((env, cost))
+        if count + 1 < max_per_wave:
+            heapq.heappush(loads, (load + cost, count + 1, rank, index))
+    return waves
+
+def trigger_scan(env):
+    """
+    Starts a scan of the environment. Returns a tuple of (success, message).
+    https://docs.fugue.co/_static/swagger.html#tag-scans
+    """
+    resp = fugue_client.post('scans', params={'environment_id': env['id']})
+    if resp.status_code not in (200, 201):
+        return (False, 'Scan request failed for ' + env['name'] + ' with response code: {}'.format(resp.status_code) + ' and reason: {}'.format(resp.text))
+    return (True, 'Scan started for ' + env['name'] + ' with scan id: ' + resp.json()['id'])
+
+def apply_waves(waves, wave_seconds):
+    """
+    Triggers the scans of each wave wave_seconds after the previous wave, using workers concurrent requests.
+    Returns the number of scans that could not be started.
+    """
+    start = time.time()
+    started = 0
+    failures = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for index, wave in enumerate(waves):
+            if not wave:
+                continue
+            delay = start + index * wave_seconds - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            print ("Starting wave " + str(index + 1) + " of " + str(len(waves)) + " with " + str(len(wave)) + " scans")
+            for ok, message in pool.map(trigger_scan, [env for env, cost in wave]):
+                print (message)
+                if ok:
+                    started += 1
+                else:
+                    failures += 1
+    print ("\n" + str(started) + " scans started, " + str(failures) + " failed")
+    return failures
+
+def main():
+    """
+    Plan a staggered scan schedule for the environments and apply it in waves
+    """
+    environments = get_scheduled_environments()
+    if not environments:
+        print ("No environments with scheduled scans found")
+        return
+    print ("Retrieving scan history of " + str(len(environments)) + " environments" + "\n")
+    costs = get_scan_costs(set(env['id'] for env in environments))
+    window = spread_seconds or min(int(env['scan_interval']) for env in environments)
+    waves = plan_waves(environments, costs, window, wave_seconds, max_scans_per_wave)
+    print ("Scan schedule: " + str(len(environments)) + " environments in " + str(len(waves)) + " waves " + str(wave_seconds) + " seconds apart" + "\n")
+    for index, wave in enumerate(waves):
+        if not wave:
+            continue
+        expected = sum(cost for env, cost in wave)
+        print ("Wave " + str(index + 1) + " at +" + str(index * wave_seconds) + "s: " + str(len(wave)) + " scans, expected scan time " + str(int(expected)) + "s")
+        if dry_run:
+            for env, cost in wave:
+                print ("    " + env['name'] + " (" + env['id'] + ")")
+    if dry_run:
+        print ("\n" + "Dry run, no scans were triggered. Set dry_run = False to apply the schedule.")
+        return
+    if apply_waves(waves, wave_seconds):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
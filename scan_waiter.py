@@ -0,0 +1,114 @@
+"""
+Waits for the first scans of newly created environments to finish.
+
+After a bulk onboarding run thousands of new environments are scanned for the
+first time. Instead of one poll loop per environment, the waiter tracks all of
+them at once: every poll lists the scans created since the run started, for
+all environments in a few paginated calls, and updates the status of every
+tracked environment from that single listing. Polls back off exponentially
+with jitter while nothing finishes and speed up again when scans complete.
+
+Environments are released as soon as their scan finishes, so a downstream
+export can start on the first results while the remaining scans are still
+running. wait_and_export() chains the two for the fugue_cli.py onboard
+--export-when-scanned option.
+"""
+import random
+import time
+
+import fugue_client
+import get_compliance_into_csv
+
+
+# Scan statuses after which a scan will not change anymore
+FINISHED_STATUSES = ('SUCCESS', 'ERROR', 'CANCELED')
+
+# since is taken from the local clock but compared with the created_at times
+# of the Fugue API, so environments and scans are looked up from this many
+# seconds earlier in case the local clock is ahead. Environments created by
+# someone else within the margin before the run are waited for too.
+CLOCK_SKEW_MARGIN = 300
+
+
+def new_environments(since, provider=None, margin=CLOCK_SKEW_MARGIN):
+    """
+    Returns the environments created at or after the since Unix timestamp,
+    less margin seconds for clock skew.
+    """
+    return [env for env in fugue_client.list_environments(provider)
+            if env.get('created_at', 0) >= since - margin]
+
+
+def next_delay(delay, min_delay, max_delay, progressed):
+    """
+    Returns the base delay before the next poll: back to min_delay when scans
+    finished since the last poll, doubled (up to max_delay) otherwise.
+    """
+    if progressed:
+        return min_delay
+    return min(delay * 2, max_delay)
+
+
+def jittered(delay):
+    """
+    Returns a random delay between half and all of delay, so waiters started
+    together don't poll in lockstep.
+    """
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def wait_for_scans(env_ids, since, timeout=3600, min_delay=15, max_delay=300, margin=CLOCK_SKEW_MARGIN):
+    """
+    Generator that yields (environment id, scan) for every environment in
+    env_ids as soon as a scan created at or after since (less margin seconds
+    for clock skew) has finished. The scan may have failed; check its
+    status. Environments whose scan has not finished after timeout seconds
+    are yielded with None.
+    """
+    pending = set(env_ids)
+    deadline = time.time() + timeout
+    delay = min_delay
+    while pending:
+        finished = {}
+        for scan in fugue_client.list_scans(range_from=since - margin):
+            env_id = scan.get('environment_id')
+            # Scans are listed most recent first, keep the first finished scan per environment
+            if env_id in pending and env_id not in finished and scan['status'] in FINISHED_STATUSES:
+                finished[env_id] = scan
+        for env_id, scan in finished.items():
+            pending.discard(env_id)
+            yield env_id, scan
+        if not pending:
+            break
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            print('Gave up waiting for the scans of %d environments after %d seconds' % (len(pending), timeout))
+            for env_id in sorted(pending):
+                yield env_id, None
+            break
+        print('Waiting for %d scans to finish (%d finished in this poll)' % (len(pending), len(finished)))
+        delay = next_delay(delay, min_delay, max_delay, bool(finished))
+        time.sleep(min(jittered(delay), remaining))
+
+
+def wait_and_export(since, filename=None, timeout=3600, provider=None):
+    """
+    Waits for the first scans of the environments created since the since
+    Unix timestamp and exports the compliance results of each successful scan
+    as soon as it finishes.
+    """
+    envs = dict((env['id'], env) for env in new_environments(since, provider))
+    if not envs:
+        print('No new environments to wait for')
+        return
+    print('Waiting for the first scans of %d new environments' % len(envs))
+
+    def finished_scans():
+        for env_id, scan in wait_for_scans(envs, since, timeout):
+            # Environments without a successful scan are passed on without one so they are counted but not exported
+            if scan is not None and scan['status'] != 'SUCCESS':
+                print('Scan %s of %s finished with status %s, skipping export' % (scan['id'], envs[env_id]['name'], scan['status']))
+                scan = None
+            yield envs[env_id], scan
+
+    get_compliance_into_csv.export_scans(finished_scans(), filename, total=len(envs))
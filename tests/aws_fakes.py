@@ -0,0 +1,95 @@
+"""
+In-memory stand-ins of the AWS Organizations and STS clients, answering the
+calls the onboarding scripts make the way boto3 clients do.
+"""
+import threading
+import time
+
+
+class Paginator(object):
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **params):
+        return self.pages(**params)
+
+
+class Organizations(object):
+    """
+    An organization given as a map of parent id to its child OUs (id, name)
+    and a map of parent id to its accounts (id, name, status). Responses
+    are split in pages of page_size items.
+    """
+
+    def __init__(self, ous, accounts, root='r-root', page_size=2):
+        self.root = root
+        self.ous = ous
+        self.accounts = accounts
+        self.page_size = page_size
+        self.listed = []
+        self.lock = threading.Lock()
+
+    def list_roots(self):
+        return {'Roots': [{'Id': self.root, 'Name': 'Root'}]}
+
+    def pages(self, key, items):
+        for start in range(0, max(len(items), 1), self.page_size):
+            yield {key: items[start:start + self.page_size]}
+
+    def get_paginator(self, operation):
+        if operation == 'list_organizational_units_for_parent':
+            return Paginator(lambda ParentId: self.pages('OrganizationalUnits', [
+                {'Id': ou_id, 'Name': name} for ou_id, name in self.ous.get(ParentId, [])]))
+        if operation == 'list_accounts_for_parent':
+            def accounts(ParentId):
+                with self.lock:
+                    self.listed.append(ParentId)
+                return self.pages('Accounts', [{'Id': acct_id, 'Name': name, 'Status': status}
+                                               for acct_id, name, status in self.accounts.get(ParentId, [])])
+            return Paginator(accounts)
+        if operation == 'list_accounts':
+            return Paginator(lambda: self.pages('Accounts', [
+                {'Id': acct_id, 'Name': name, 'Status': status}
+                for parent in sorted(self.accounts) for acct_id, name, status in self.accounts[parent]]))
+        raise ValueError('Unsupported operation ' + operation)
+
+
+class ClientError(Exception):
+    """
+    Same constructor and response attribute as botocore's ClientError.
+    """
+
+    def __init__(self, error_response, operation_name):
+        Exception.__init__(self, error_response['Error']['Code'])
+        self.response = error_response
+        self.operation_name = operation_name
+
+
+class STS(object):
+    """
+    Answers AssumeRole with the error code denied[account id] if there is
+    one, and tracks the number of calls made at the same time.
+    """
+
+    def __init__(self, denied=None, error_class=ClientError, delay=0.01):
+        self.denied = denied or {}
+        self.error_class = error_class
+        self.delay = delay
+        self.calls = []
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def assume_role(self, **params):
+        with self.lock:
+            self.calls.append(params)
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        code = self.denied.get(params['RoleArn'].split(':')[4])
+        if code:
+            raise self.error_class({'Error': {'Code': code, 'Message': code + ' for ' + params['RoleArn']}}, 'AssumeRole')
+        return {'Credentials': {}}
@@ -0,0 +1,94 @@
+"""
+Local HTTP stand-ins of the APIs the scripts call. A stand-in answers every
+request with handle(method, path, query, body), which returns a (status,
+JSON value) pair, and can be pointed at with the scripts' URL parameters
+(fugue_client.api_url, azure_subscription_discovery.login_url, ...).
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+import json
+import threading
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandIn(object):
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8') if length else ''
+                query = dict((name, values[0]) for name, values in parse_qs(url.query).items())
+                stand_in.requests.append((self.command, url.path, query, body, dict(self.headers)))
+                status, value = stand_in.handle(self.command, url.path, query, body)
+                data = json.dumps(value).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PATCH = do_DELETE = respond
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FugueAPI(object):
+    """
+    handle() of a Fugue API stand-in with environments, scans (listed most
+    recent first) and the compliance_by_rules pages of each scan, paginated
+    with offset and max_items like the real API.
+    """
+
+    def __init__(self, environments, scans, rules=None):
+        self.environments = environments
+        self.scans = scans
+        self.rules = rules or {}
+
+    def page(self, items, query):
+        offset = int(query.get('offset', 0))
+        max_items = int(query.get('max_items', 100))
+        end = offset + max_items
+        return 200, {'items': items[offset:end], 'is_truncated': end < len(items), 'next_offset': min(end, len(items))}
+
+    def __call__(self, method, path, query, body):
+        parts = path.strip('/').split('/')[1:]
+        if parts == ['environments']:
+            return self.page(self.environments, query)
+        if parts == ['scans']:
+            scans = [scan for scan in self.scans
+                     if query.get('environment_id') in (None, scan['environment_id'])
+                     and query.get('status') in (None, scan['status'])
+                     and scan['created_at'] >= float(query.get('range_from', 0))]
+            return self.page(scans, query)
+        if len(parts) == 2 and parts[0] == 'scans':
+            for scan in self.scans:
+                if scan['id'] == parts[1]:
+                    return 200, scan
+        if len(parts) == 3 and parts[2] == 'compliance_by_rules':
+            return self.page(self.rules.get(parts[1], []), query)
+        return 404, {'message': 'Not found: ' + path}
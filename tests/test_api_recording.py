@@ -0,0 +1,53 @@
+import base64
+import gzip
+import json
+
+import pytest
+
+import api_recording
+import fugue_client
+from stand_ins import StandIn
+
+API_SECRET = 'api-secret-4f1c'
+CLIENT_SECRET = 'azure-secret-9d2e'
+
+
+def handle(method, path, query, body):
+    if method == 'POST':
+        env_def = json.loads(body)
+        return 201, dict(env_def, id='env-1')
+    return 200, {'items': [{'id': 'env-0', 'name': 'prod'}], 'is_truncated': False, 'next_offset': 1}
+
+
+def test_recorded_run_replays_without_credentials(monkeypatch, tmp_path):
+    archive = str(tmp_path / 'run.ndjson.gz')
+    env_def = {'name': 'sub', 'provider': 'azure', 'provider_options': {'azure': {'client_id': 'c', 'client_secret': CLIENT_SECRET}}}
+    monkeypatch.setattr(fugue_client, '_auth', ('api-id', API_SECRET))
+    monkeypatch.setattr(fugue_client, 'replayer', None)
+    with StandIn(handle) as stand_in:
+        monkeypatch.setattr(fugue_client, 'api_url', stand_in.url)
+        recorder = fugue_client.enable_recording(archive)
+        try:
+            listed = fugue_client.get('environments', params={'offset': 0})
+            created = fugue_client.post('environments', json=env_def)
+            assert created.status_code == 201
+        finally:
+            recorder.close()
+            fugue_client.recorder = None
+    # The requests were authenticated, but neither the API credentials nor secrets in the bodies are recorded
+    assert all(headers.get('Authorization', '').startswith('Basic ') for method, path, query, body, headers in stand_in.requests)
+    with gzip.open(archive, 'rt') as f:
+        recorded = f.read()
+    for secret in (API_SECRET, CLIENT_SECRET, base64.b64encode(('api-id:' + API_SECRET).encode('utf-8')).decode('ascii')):
+        assert secret not in recorded
+    assert api_recording.REDACTED in recorded
+
+    # The stand-in is gone, every answer comes from the archive
+    monkeypatch.setattr(fugue_client, '_auth', None)
+    fugue_client.enable_replay(archive, speed=0)
+    assert fugue_client.get('environments', params={'offset': 0}) == listed
+    replayed = fugue_client.post('environments', json=env_def)
+    assert replayed.status_code == 201
+    assert replayed.json()['provider_options']['azure']['client_secret'] == api_recording.REDACTED
+    with pytest.raises(api_recording.ReplayMissError):
+        fugue_client.get('environments', params={'offset': 100})
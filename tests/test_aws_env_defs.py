@@ -0,0 +1,58 @@
+import json
+
+import aws_env_defs
+import env_creation_AWS_accounts
+import env_creation_AWS_govcloud_accounts
+
+
+def lookup(calls):
+    def resource_types(region):
+        calls.append(region)
+        return ['AWS.EC2.Instance', 'AWS.S3.Bucket.' + region]
+    return resource_types
+
+
+def test_govcloud_uses_its_partition_and_default_region():
+    calls = []
+    defs = aws_env_defs.AwsEnvDefs('aws_govcloud', ['*'], 'Fugue', '86400', ['FBP'], lookup(calls))
+    (body,) = defs.desired_env_defs({'gov': '123456789012'})
+    assert body['provider_options']['aws_govcloud']['role_arn'] == 'arn:aws-us-gov:iam::123456789012:role/Fugue'
+    assert body['name'] == 'gov - 123456789012 - All Regions'
+    assert calls == ['us-gov-east-1']
+
+
+def test_partition_and_default_region_can_be_overridden():
+    calls = []
+    defs = aws_env_defs.AwsEnvDefs('aws', ['*'], 'Fugue', 0, ['FBP'], lookup(calls), partition='aws-cn', default_region='cn-north-1')
+    (body,) = defs.desired_env_defs({'cn': '123456789012'})
+    assert body['provider_options']['aws']['role_arn'].startswith('arn:aws-cn:iam::')
+    assert body['scan_schedule_enabled'] is False
+    assert calls == ['cn-north-1']
+
+
+def test_coalesced_regions_get_the_union_of_their_resource_types():
+    calls = []
+    defs = aws_env_defs.AwsEnvDefs('aws', ['us-east-1', 'EU-WEST-1'], 'Fugue', '86400', ['FBP'], lookup(calls),
+                                   coalesce=lambda acct_id: acct_id == '111111111111')
+    assert defs.env_targets('a', '111111111111') == [('a - 111111111111 - 2 Regions', ('us-east-1', 'eu-west-1'))]
+    assert defs.env_targets('b', '222222222222') == [('b - 222222222222 - us-east-1', 'us-east-1'), ('b - 222222222222 - EU-WEST-1', 'eu-west-1')]
+    assert defs.resource_types_for(('us-east-1', 'eu-west-1')) == ['AWS.EC2.Instance', 'AWS.S3.Bucket.us-east-1', 'AWS.S3.Bucket.eu-west-1']
+
+
+def test_encoded_bodies_match_the_definitions():
+    defs = aws_env_defs.AwsEnvDefs('aws', ['us-east-1', 'us-west-2'], 'Fugue', '86400', ['FBP'], lookup([]))
+    accounts = {'prod': '111111111111', 'dev': '222222222222'}
+    compiler = defs.compile_payloads()
+    encoded = [json.loads(payload.body.decode('utf-8')) for payload in defs.encoded_env_defs(accounts, compiler)]
+    assert encoded == list(defs.desired_env_defs(accounts))
+
+
+def test_scripts_keep_their_partitions(monkeypatch):
+    for module in (env_creation_AWS_accounts, env_creation_AWS_govcloud_accounts):
+        monkeypatch.setattr(module, 'regions', ['*'])
+        monkeypatch.setattr(module, 'resource_types', ['AWS.EC2.Instance'])
+    (aws,) = env_creation_AWS_accounts.desired_env_defs({'prod': '111111111111'})
+    (gov,) = env_creation_AWS_govcloud_accounts.desired_env_defs({'gov': '222222222222'})
+    assert aws['provider_options']['aws']['role_arn'] == 'arn:aws:iam::111111111111:role/FugueRiskManager'
+    assert gov['provider_options']['aws_govcloud']['role_arn'] == 'arn:aws-us-gov:iam::222222222222:role/FugueRiskManager'
+    assert aws['survey_resource_types'] == gov['survey_resource_types'] == ['AWS.EC2.Instance']
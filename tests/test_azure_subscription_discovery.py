@@ -0,0 +1,60 @@
+import pytest
+
+import azure_subscription_discovery as discovery
+from stand_ins import StandIn
+
+
+def arm(method, path, query, body):
+    """
+    Stand-in of the Azure AD token endpoint and of the ARM tenants and
+    subscriptions lists. The token names the application and tenant it was
+    issued for; application 'revoked' has bad credentials.
+    """
+    if path.endswith('/oauth2/v2.0/token'):
+        form = dict(pair.split('=', 1) for pair in body.split('&'))
+        if form['client_id'] == 'revoked':
+            return 401, {'error': 'invalid_client'}
+        return 200, {'access_token': form['client_id'] + '@' + path.split('/')[1]}
+    if path == '/tenants':
+        return 200, {'value': [{'tenantId': 'home'}, {'tenantId': 'guest'}]}
+    if path == '/subscriptions':
+        return 200, {'value': [{'subscriptionId': 'sub-1', 'displayName': 'One'}], 'nextLink': arm.url + '/subscriptions/page-2'}
+    if path == '/subscriptions/page-2':
+        assert 'api-version' not in query
+        return 200, {'value': [{'subscriptionId': 'sub-2', 'displayName': 'Two'},
+                               {'subscriptionId': 'sub-3', 'displayName': 'Three', 'state': 'Disabled'}]}
+    return 404, {}
+
+
+@pytest.fixture
+def arm_endpoint(monkeypatch):
+    with StandIn(arm) as stand_in:
+        arm.url = stand_in.url
+        monkeypatch.setattr(discovery, 'login_url', stand_in.url)
+        monkeypatch.setattr(discovery, 'arm_url', stand_in.url)
+        yield stand_in
+
+
+def principal(name, application_id, tenant_id='home'):
+    return {'name': name, 'tenant_id': tenant_id, 'application_id': application_id, 'client_secret': 'secret',
+            'resource_groups': ['*']}
+
+
+def test_subscriptions_are_listed_across_pages_and_tenants(arm_endpoint):
+    index = discovery.discover_subscriptions([principal('first', 'app-1'), principal('second', 'app-2')], all_tenants=True)
+    assert sorted(index) == ['sub-1', 'sub-2']
+    # The first principal wins, and its home tenant is listed before the guest tenant
+    assert index['sub-1']['principal']['name'] == 'first'
+    assert index['sub-1']['tenant_id'] == 'home'
+    tokens = set(headers.get('Authorization') for method, path, query, body, headers in arm_endpoint.requests
+                 if path == '/subscriptions')
+    assert tokens == set(['Bearer app-1@home', 'Bearer app-1@guest', 'Bearer app-2@home', 'Bearer app-2@guest'])
+
+
+def test_principal_with_bad_credentials_does_not_abort_discovery(arm_endpoint, capsys):
+    index = discovery.discover_subscriptions([principal('revoked', 'revoked'), principal('good', 'app-1')], all_tenants=True)
+    assert sorted(index) == ['sub-1', 'sub-2']
+    assert index['sub-1']['principal']['name'] == 'good'
+    output = capsys.readouterr().out
+    assert 'Tenant discovery failed for revoked' in output
+    assert 'Subscription discovery failed for revoked in tenant home' in output
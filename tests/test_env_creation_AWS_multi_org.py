@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+pytest.importorskip('boto3')
+
+import env_creation_AWS_multi_org as multi
+import fugue_client
+from aws_fakes import Organizations
+from stand_ins import StandIn
+
+
+ORGS = {
+    'commercial': Organizations({'r-root': [('ou-prod', 'Production')]}, {
+        'r-root': [('111111111111', 'existing', 'ACTIVE')],
+        'ou-prod': [('222222222222', 'prod', 'ACTIVE'), ('333333333333', 'broken', 'ACTIVE'), ('444444444444', 'closed', 'SUSPENDED')],
+    }),
+    'gov': Organizations({}, {'r-root': [('555555555555', 'gov', 'ACTIVE')]}),
+}
+
+
+class Session(object):
+
+    def __init__(self, profile_name=None):
+        self.profile_name = profile_name
+
+    def client(self, service, config=None):
+        return ORGS[self.profile_name]
+
+
+def test_orgs_are_discovered_and_created_together(monkeypatch):
+    created = []
+    reporters = []
+
+    def fugue(method, path, query, body):
+        if method == 'GET':
+            existing = [{'provider_options': {'aws': {'role_arn': 'arn:aws:iam::111111111111:role/FugueRiskManager'}}}]
+            return 200, {'items': existing if query['q.provider'] == 'aws' else [], 'is_truncated': False, 'next_offset': 1}
+        env_def = json.loads(body)
+        if '333333333333' in env_def['name']:
+            return 400, {'message': 'invalid role'}
+        created.append((env_def['provider'], env_def['name'], env_def['provider_options'][env_def['provider']]['role_arn']))
+        return 201, {'name': env_def['name'], 'id': 'env-%d' % len(created)}
+
+    Progress = multi.progress.Progress
+
+    def reporter(*args, **kwargs):
+        reporters.append(Progress(*args, **kwargs))
+        return reporters[-1]
+
+    monkeypatch.setattr(multi.env_creation_AWS_org.boto3, 'Session', Session, raising=False)
+    monkeypatch.setattr(multi.env_creation_AWS_org, 'org_cache_ttl', 0)
+    monkeypatch.setattr(multi.progress, 'Progress', reporter)
+    monkeypatch.setattr(multi, 'aws_sources', [{'profile': 'commercial', 'provider': 'aws'}, {'profile': 'gov', 'provider': 'aws_govcloud'}])
+    monkeypatch.setattr(multi, 'regions', {'aws': ['us-east-1', 'us-west-2'], 'aws_govcloud': ['*']})
+    monkeypatch.setattr(multi, 'resource_types', ['AWS.S3.Bucket'])
+    with StandIn(fugue) as stand_in:
+        monkeypatch.setattr(fugue_client, 'api_url', stand_in.url)
+        monkeypatch.setattr(fugue_client, '_auth', ('id', 'secret'))
+        multi.main()
+
+    assert sorted(created) == [
+        ('aws', 'prod - 222222222222 - us-east-1', 'arn:aws:iam::222222222222:role/FugueRiskManager'),
+        ('aws', 'prod - 222222222222 - us-west-2', 'arn:aws:iam::222222222222:role/FugueRiskManager'),
+        ('aws_govcloud', 'gov - 555555555555 - All Regions', 'arn:aws-us-gov:iam::555555555555:role/FugueRiskManager'),
+    ]
+    (onboard,) = reporters
+    # Failed creations are counted as done, so the run ends at 100%
+    assert onboard.total == onboard.done == 5
+    assert onboard.errors == 2
+    assert onboard.counters == {'skipped': 1}
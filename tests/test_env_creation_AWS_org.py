@@ -0,0 +1,60 @@
+import pytest
+
+pytest.importorskip('boto3')
+
+import env_creation_AWS_org as org
+from aws_fakes import Organizations
+
+
+def organization():
+    return Organizations(
+        ous={
+            'r-root': [('ou-prod', 'Production'), ('ou-dev', 'Development')],
+            'ou-prod': [('ou-prod-eu', 'Europe')],
+            'ou-dev': [('ou-sandbox', 'Sandbox')],
+        },
+        accounts={
+            'r-root': [('000000000001', 'management', 'ACTIVE')],
+            'ou-prod': [('111111111111', 'prod-us', 'ACTIVE'), ('111111111112', 'prod-old', 'SUSPENDED')],
+            'ou-prod-eu': [('222222222222', 'prod-eu', 'ACTIVE')],
+            'ou-dev': [('333333333333', 'dev', 'ACTIVE')],
+            'ou-sandbox': [('444444444444', 'sandbox', 'ACTIVE')],
+        })
+
+
+def test_discover_whole_org():
+    accounts = org.discover_accounts(organization())
+    assert sorted(account['Id'] for account in accounts) == [
+        '000000000001', '111111111111', '111111111112', '222222222222', '333333333333', '444444444444']
+    paths = dict((account['Id'], account['OuPath']) for account in accounts)
+    assert paths['222222222222'] == ['r-root', 'ou-prod', 'Production', 'ou-prod-eu', 'Europe']
+
+
+def test_discover_with_ou_filters():
+    client = organization()
+    accounts = org.discover_accounts(client, include=['Production', 'ou-dev'], exclude=['Sandbox'])
+    assert sorted(account['Id'] for account in accounts) == ['111111111111', '111111111112', '222222222222', '333333333333']
+    # Accounts are only listed inside included OUs and excluded OUs are not walked
+    assert 'r-root' not in client.listed and 'ou-sandbox' not in client.listed
+
+
+def test_get_accounts_from_org_keeps_active_accounts_and_caches(tmp_path, monkeypatch):
+    monkeypatch.setattr(org, 'org_cache_file', str(tmp_path / 'cache.json'))
+    monkeypatch.setattr(org, 'ou_include', ['ou-prod'])
+    assert org.get_accounts_from_org('profile', organization()) == {'prod-us': '111111111111', 'prod-eu': '222222222222'}
+    # The second run is answered from the cache
+    assert org.get_accounts_from_org('profile', Organizations({}, {})) == {'prod-us': '111111111111', 'prod-eu': '222222222222'}
+
+
+def test_reconcile_does_not_delete_outside_the_ou_filters(monkeypatch):
+    calls = []
+    monkeypatch.setattr(org, 'get_accounts_from_org', lambda profile: {'prod-us': '111111111111'})
+    monkeypatch.setattr(org.reconcile_environments, 'reconcile', lambda provider, desired, allow_deletes: calls.append(allow_deletes))
+    monkeypatch.setattr(org, 'resource_types', ['AWS.S3.Bucket'])
+    monkeypatch.setattr(org, 'reconcile', True)
+    monkeypatch.setattr(org, 'delete_orphans', True)
+    monkeypatch.setattr(org, 'ou_include', ['ou-prod'])
+    org.main()
+    monkeypatch.setattr(org, 'ou_include', [])
+    org.main()
+    assert calls == [False, True]
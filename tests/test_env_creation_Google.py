@@ -0,0 +1,52 @@
+import collections
+import json
+
+import pytest
+
+pytest.importorskip('google.cloud.resource_manager')
+
+import env_creation_Google as google
+import fugue_client
+from stand_ins import StandIn
+
+
+Project = collections.namedtuple('Project', 'name project_id')
+
+
+class ResourceManager(object):
+    """
+    Stand-in of the resource manager client: lists the given projects,
+    which may repeat, one at a time like the paged iterator of the client.
+    """
+
+    def __init__(self, projects):
+        self.projects = projects
+        self.filters = []
+
+    def list_projects(self, filter_params):
+        self.filters.append(filter_params)
+        for name, project_id in self.projects:
+            yield Project(name, project_id)
+
+
+def test_projects_are_created_while_the_org_is_listed(monkeypatch):
+    created = []
+
+    def fugue(method, path, query, body):
+        if method == 'GET':
+            return 200, {'items': [{'provider_options': {'google': {'project_id': 'p-1'}}}], 'is_truncated': False, 'next_offset': 0}
+        env_def = json.loads(body)
+        created.append(env_def['provider_options']['google']['project_id'])
+        return 201, {'name': env_def['name'], 'id': 'env-' + str(len(created))}
+
+    org = ResourceManager([('project %d' % (index % 300), 'p-%d' % (index % 300)) for index in range(500)])
+    with StandIn(fugue) as stand_in:
+        monkeypatch.setattr(fugue_client, 'api_url', stand_in.url)
+        monkeypatch.setattr(fugue_client, '_auth', ('id', 'secret'))
+        monkeypatch.setattr(google.resource_manager.Client, 'from_service_account_json', staticmethod(lambda keyfile: org), raising=False)
+        monkeypatch.setattr(google, 'queue_size', 5)
+        google.main()
+    assert org.filters == [{'lifecycleState': 'Active'}]
+    # Every project is created once, except the one already in Fugue
+    assert len(created) == len(set(created)) == 299
+    assert 'p-1' not in created
@@ -0,0 +1,83 @@
+import gzip
+import json
+import threading
+
+import env_payloads
+
+
+def build_template(region, name, env_id):
+    return {
+        'name': name,
+        'provider': 'aws',
+        'provider_options': {'aws': {'region': region, 'role_arn': 'arn:aws:iam::' + env_id + ':role/FugueRiskManager'}},
+        'survey_resource_types': ['AWS.EC2.Instance', 'AWS.S3.Bucket'],
+        'compliance_families': ['FBP'],
+    }
+
+
+def test_render_matches_a_fresh_body():
+    compiler = env_payloads.PayloadCompiler(build_template)
+    for region, name, env_id in [('us-east-1', 'prod-us-east-1', '012345678901'),
+                                 ('eu-west-1', 'quote " and \\ and é', '111111111111'),
+                                 ('us-east-1', '@@FUGUE_ENV_ID@@', '222222222222')]:
+        payload = compiler.render(region, name, env_id)
+        assert payload.name == name
+        assert payload.content_encoding is None
+        assert json.loads(payload.body.decode('utf-8')) == build_template(region, name, env_id)
+
+
+def test_templates_are_compiled_once_per_key():
+    keys = []
+
+    def counting(key, name, env_id):
+        keys.append(key)
+        return build_template(key, name, env_id)
+    compiler = env_payloads.PayloadCompiler(counting)
+    for index in range(10):
+        compiler.render('us-east-1', 'env-%d' % index, '%012d' % index)
+    compiler.render('us-west-2', 'env', '0' * 12)
+    assert keys == ['us-east-1', 'us-west-2']
+
+
+
+def test_different_keys_compile_in_parallel():
+    started = {'us-east-1': threading.Event(), 'us-west-2': threading.Event()}
+    keys = []
+
+    def waiting(key, name, env_id):
+        keys.append(key)
+        started[key].set()
+        other = 'us-west-2' if key == 'us-east-1' else 'us-east-1'
+        assert started[other].wait(5), 'templates were compiled one after the other'
+        return build_template(key, name, env_id)
+    compiler = env_payloads.PayloadCompiler(waiting)
+    errors = []
+
+    def render(key):
+        try:
+            for index in range(3):
+                compiler.render(key, 'env-%d' % index, '%012d' % index)
+        except AssertionError as error:
+            errors.append(error)
+    threads = [threading.Thread(target=render, args=(key,)) for key in sorted(started) * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert sorted(keys) == ['us-east-1', 'us-west-2']
+
+
+def test_gzip_payloads():
+    compiler = env_payloads.PayloadCompiler(build_template, gzip_payloads=True)
+    payload = compiler.render('us-east-1', 'prod', '012345678901')
+    assert payload.content_encoding == 'gzip'
+    assert json.loads(gzip.decompress(payload.body).decode('utf-8')) == build_template('us-east-1', 'prod', '012345678901')
+
+
+def test_gzip_payloads_are_deterministic(monkeypatch):
+    first = env_payloads.PayloadCompiler(build_template, gzip_payloads=True).render('us-east-1', 'prod', '012345678901')
+    monkeypatch.setattr(gzip.time, 'time', lambda: 2000000000.0)
+    second = env_payloads.PayloadCompiler(build_template, gzip_payloads=True).render('us-east-1', 'prod', '012345678901')
+    assert first.body == second.body
+    assert first.body[4:8] == b'\0\0\0\0'
@@ -0,0 +1,31 @@
+import pytest
+
+import fugue_cli
+
+
+@pytest.mark.parametrize('argv', [
+    ['export', 'compliance', '--tenants', 'tenants.json', '--partition-dir', 'out'],
+    ['export', 'compliance', '--tenants', 'tenants.json', '--star-dir', 'out'],
+    ['export', 'compliance', '--tenants', 'tenants.json', '--watch'],
+    ['export', 'compliance', '--tenants', 'tenants.json', '--environment', 'env-a'],
+    ['export', 'compliance', '--sorted', '--star-dir', 'out'],
+    ['export', 'compliance', '--star-dir', 'out', '--partition-dir', 'parts'],
+    ['export', 'compliance', '--star-dir', 'out', '--output', 'compliance.csv'],
+    ['export', 'compliance', '--star-dir', 'out', '--watch'],
+    ['export', 'compliance', '--watch', '--sorted'],
+    ['export', 'compliance', '--partition-dir', 'parts', '--output', 'compliance.csv'],
+    ['--record', 'a.gz', '--replay', 'b.gz', 'export', 'compliance'],
+])
+def test_conflicting_export_options_are_rejected(argv, capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        fugue_cli.main(argv)
+    assert exit_info.value.code == 2
+    assert 'cannot be combined' in capsys.readouterr().err
+
+
+def test_watch_keeps_the_output_format(monkeypatch):
+    import get_compliance_into_csv
+    calls = []
+    monkeypatch.setattr(get_compliance_into_csv, 'watch', lambda *args: calls.append(args))
+    fugue_cli.main(['export', 'compliance', '--watch', '--format', 'ndjson', '--output', 'out.ndjson'])
+    assert calls == [('out.ndjson', 'ndjson', 300, None, 'environment', None)]
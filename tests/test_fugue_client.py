@@ -0,0 +1,121 @@
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+import fugue_client
+import request_hedging
+from stand_ins import StandIn
+
+
+def chunked(text, size):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def test_iter_array_yields_items_and_fields():
+    page = {'items': [{'id': 1}, {'id': 2, 'name': 'b'}, [], 3.5], 'is_truncated': True, 'next_offset': 4}
+    fields = {}
+    items = list(fugue_client.iter_array(chunked(json.dumps(page), 3), 'items', fields))
+    assert items == page['items']
+    assert fields == {'is_truncated': True, 'next_offset': 4}
+
+
+def test_iter_array_fields_before_items():
+    text = '{"count": 12, "items": [1, 2, 12345], "next_offset": null}'
+    for size in (1, 2, 7, len(text)):
+        fields = {}
+        assert list(fugue_client.iter_array(chunked(text, size), 'items', fields)) == [1, 2, 12345]
+        assert fields == {'count': 12, 'next_offset': None}
+
+
+def test_iter_array_empty():
+    fields = {}
+    assert list(fugue_client.iter_array(['{"items": [], "is_truncated": false}'], 'items', fields)) == []
+    assert fields == {'is_truncated': False}
+    assert list(fugue_client.iter_array(['{}'], 'items', {})) == []
+
+
+def test_iter_array_truncated_response():
+    with pytest.raises(ValueError):
+        list(fugue_client.iter_array(chunked('{"items": [{"id": 1}, {"id": ', 4), 'items', {}))
+
+
+def test_iter_array_large_items():
+    # Items of several MB are read in many chunks; decoding must stay close
+    # to linear in their size
+    item = {'id': 'big', 'resources': [{'id': 'resource-%d' % i, 'tags': {'owner': 'team-%d' % (i % 50)}} for i in range(150000)]}
+    text = json.dumps({'items': [item, item], 'is_truncated': False})
+    assert len(text) > 8 * 1024 * 1024
+    started = time.time()
+    json.loads(text)
+    baseline = time.time() - started
+
+    started = time.time()
+    items = list(fugue_client.iter_array(chunked(text, fugue_client.STREAM_CHUNK_SIZE), 'items', {}))
+    elapsed = time.time() - started
+    assert items == [item, item]
+    assert elapsed < 10 * baseline + 1
+
+
+class Response(object):
+
+    def __init__(self, number):
+        self.number = number
+
+    def close(self):
+        pass
+
+
+def test_hedged_backup_is_throttled(monkeypatch):
+    acquired = []
+
+    class Limiter(object):
+        def acquire(self):
+            acquired.append(threading.current_thread().name)
+
+    tenant = fugue_client.Tenant('prod', 'id', 'secret')
+    tenant.limiter = Limiter()
+    sent = []
+
+    def transport(method, path, url, auth, params=None, stream=False, **kwargs):
+        sent.append(path)
+        number = len(sent)
+        time.sleep(0.2 if number == 1 else 0)
+        return Response(number)
+    monkeypatch.setattr(fugue_client, 'transport', transport)
+    monkeypatch.setattr(fugue_client, 'hedging', request_hedging.HedgePolicy(initial_delay=0.05))
+    with fugue_client.use_tenant(tenant):
+        assert fugue_client.send_get('scans').number == 2
+    assert sent == ['prod:scans', 'prod:scans']
+    assert len(acquired) == 2
+    assert acquired[0] == threading.current_thread().name
+
+
+def test_hedged_request_survives_a_stalled_connection(monkeypatch):
+    # Latency injecting stand-in of the API: the first request stalls longer than the read timeout
+    calls = []
+
+    def handle(method, path, query, body):
+        calls.append(path)
+        if len(calls) == 1:
+            time.sleep(2)
+        return 200, {'items': [{'id': 'scan-1'}], 'is_truncated': False, 'next_offset': 1}
+
+    with StandIn(handle) as stand_in:
+        monkeypatch.setattr(fugue_client, 'api_url', stand_in.url)
+        monkeypatch.setattr(fugue_client, '_auth', ('id', 'secret'))
+        monkeypatch.setattr(fugue_client, 'REQUEST_TIMEOUT', (1, 0.5))
+        monkeypatch.setattr(fugue_client, 'hedging', request_hedging.HedgePolicy(initial_delay=0.1))
+        started = time.time()
+        assert fugue_client.get('scans')['items'] == [{'id': 'scan-1'}]
+        assert time.time() - started < 1.5
+        assert calls == ['/v0/scans', '/v0/scans']
+        assert fugue_client.hedging.stats() == {'requests': 1, 'hedges': 1, 'hedge_wins': 1}
+
+        # Without hedging the stalled request times out
+        monkeypatch.setattr(fugue_client, 'hedging', None)
+        del calls[:]
+        with pytest.raises(requests.Timeout):
+            fugue_client.get('scans')
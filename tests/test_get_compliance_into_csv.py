@@ -0,0 +1,315 @@
+import contextlib
+import csv
+import json
+import os
+import time
+
+import pytest
+
+import fugue_client
+import get_compliance_into_csv as export
+from stand_ins import FugueAPI, StandIn
+
+
+def environment(env_id, account='123456789012'):
+    return {
+        'id': env_id,
+        'name': env_id,
+        'provider': 'aws',
+        'provider_options': {'aws': {'role_arn': 'arn:aws:iam::' + account + ':role/FugueRole', 'regions': ['*']}},
+    }
+
+
+def rules(scan_id, count):
+    """
+    Compliance results of a scan: count rules, with resource types, resources
+    and messages shared between rules and scans.
+    """
+    return [{
+        'family': 'FBP',
+        'rule': 'FG_R%05d' % index,
+        'failed_resource_types': [{'resource_type': 'AWS.IAM.Policy', 'messages': ['Policy allows *']}] if index % 3 == 0 else [],
+        'failed_resources': [{
+            'resource': {'resource_type': 'AWS.S3.Bucket', 'resource_id': 'bucket-%d' % (index % 4)},
+            'messages': ['Bucket is public', 'Finding %d of %s' % (index % 2, scan_id)],
+        }],
+        'unsurveyed_resource_types': ['AWS.EC2.Instance'] if index % 5 == 0 else [],
+    } for index in range(count)]
+
+
+def compliance_api(rule_counts):
+    """
+    Returns a Fugue API stand-in with one environment and scan per entry of
+    rule_counts, the scan having that many rules.
+    """
+    now = time.time()
+    environments, scans, by_scan = [], [], {}
+    for index, count in enumerate(rule_counts):
+        env = environment('env-%d' % index, account='%012d' % (index % 2))
+        scan = {'id': 'scan-%d' % index, 'environment_id': env['id'], 'status': 'SUCCESS',
+                'created_at': now - 60 * index, 'finished_at': 1622505600 + index}
+        environments.append(env)
+        scans.append(scan)
+        by_scan[scan['id']] = rules(scan['id'], count)
+    return FugueAPI(environments, scans, by_scan)
+
+
+@contextlib.contextmanager
+def serving(monkeypatch, api):
+    with StandIn(api) as stand_in:
+        monkeypatch.setattr(fugue_client, 'api_url', stand_in.url)
+        monkeypatch.setattr(fugue_client, '_auth', ('id', 'secret'))
+        yield stand_in
+
+
+def read_table(directory, name):
+    with open(os.path.join(directory, name + '.csv'), newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_star_schema_keys_are_unique_stable_and_referenced(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    api = compliance_api([7, 12, 3])
+    with serving(monkeypatch, api):
+        for run in ('first', 'second'):
+            environments = export.list_environments()
+            latest = export.get_latest_scans([env['id'] for env in environments])
+            export.export_star(((env, latest.get(env['id'])) for env in environments), run, total=len(environments))
+    records = sum(len(list(export.records_from_rule(rule))) for scan_rules in api.rules.values() for rule in scan_rules)
+
+    keys = {}
+    for name, columns in export.STAR_TABLES:
+        table = read_table('first', name)
+        # The same input gives the same keys
+        assert table == read_table('second', name)
+        if name == 'compliance_facts':
+            facts = table
+            continue
+        key = columns[0]
+        assert [row[key] for row in table] == [str(index) for index in range(1, len(table) + 1)]
+        # Every distinct value is written once
+        values = [tuple(row[col] for col in columns[1:]) for row in table]
+        assert len(set(values)) == len(values)
+        keys[key] = set(row[key] for row in table)
+
+    assert len(facts) == records
+    assert len(keys['environment_key']) == 3
+    assert len(keys['message_key']) == len(set(r['message'] for scan_rules in api.rules.values() for rule in scan_rules
+                                                for r in export.records_from_rule(rule)))
+    for row in facts:
+        for key, value in row.items():
+            if key == 'resource_key' and value == '':
+                continue
+            assert value in keys[key]
+    for row in read_table('first', 'scans') + read_table('first', 'resources'):
+        for key in ('environment_key', 'resource_type_key'):
+            if key in row:
+                assert row[key] in keys[key]
+
+
+def test_account_partition_keeps_other_environments(tmp_path, monkeypatch):
+    envs = dict((env_id, environment(env_id)) for env_id in ('env-a', 'env-b', 'env-c'))
+    scan = {'id': 'scan-b', 'finished_at': 1622505600, 'environment_id': 'env-b'}
+    key = export.partition_key(envs['env-a'], scan, 'account')
+    path = export.partition_path(key, 'account').replace('\\', '/')
+    export.write_manifest(str(tmp_path), [{
+        'path': path,
+        'environment_ids': ['env-a', 'env-b', 'env-c'],
+        'scan_ids': ['scan-a-old', 'scan-b-old', 'scan-c-old'],
+    }])
+    # env-c was deleted since the last export
+    monkeypatch.setattr(export, 'list_environments', lambda: [envs['env-a'], envs['env-b']])
+    monkeypatch.setattr(export, 'get', lambda path, params=None: {'id': path.split('/')[1], 'finished_at': 1622505600})
+
+    partitions = {key: [(envs['env-b'], scan)]}
+    assert export.add_retained_scans(str(tmp_path), partitions, 'account') == 1
+    assert [(env['id'], scan['id']) for env, scan in partitions[key]] == [('env-b', 'scan-b'), ('env-a', 'scan-a-old')]
+
+
+def test_new_partition_has_nothing_to_retain(tmp_path):
+    scan = {'id': 'scan-a', 'finished_at': 1622505600}
+    partitions = {export.partition_key(environment('env-a'), scan, 'account'): [(environment('env-a'), scan)]}
+    assert export.add_retained_scans(str(tmp_path), partitions, 'account') == 0
+
+
+def test_watcher_lists_from_the_last_exported_scan(monkeypatch):
+    started = 1622505600
+    listings = []
+    scans = [
+        {'id': 'scan-2', 'environment_id': 'env-a', 'finished_at': started + 200, 'created_at': started + 100},
+        {'id': 'scan-1', 'environment_id': 'env-a', 'finished_at': started + 100, 'created_at': started + 50},
+        {'id': 'scan-0', 'environment_id': 'env-b', 'finished_at': started - 10, 'created_at': started - 100},
+    ]
+
+    def list_scans(status, range_from):
+        listings.append(range_from)
+        return iter(scans)
+    monkeypatch.setattr(export.fugue_client, 'list_scans', list_scans)
+    monkeypatch.setattr(export, 'list_environments', lambda: [environment('env-a'), environment('env-b')])
+    monkeypatch.setattr(export.time, 'time', lambda: started + 300)
+
+    watcher = export.ScanWatcher(since=started)
+    watcher.refresh_catalog()
+    found = watcher.new_scans()
+    assert [(env['id'], scan['id']) for env, scan in found] == [('env-a', 'scan-2')]
+    assert listings == [started - export.WATCH_MARGIN]
+
+    # Until they are marked exported, the same scans are found again
+    assert [scan['id'] for env, scan in watcher.new_scans()] == ['scan-2']
+    watcher.mark_exported(found)
+    assert watcher.new_scans() == []
+    assert listings[-1] == started + 200 - export.WATCH_MARGIN
+
+
+def test_watch_retries_failed_polls(monkeypatch, tmp_path):
+    polls = []
+
+    class Watcher(object):
+        catalog = {}
+
+        def __init__(self, environment_ids=None):
+            pass
+
+        def refresh_catalog(self):
+            pass
+
+        def new_scans(self):
+            polls.append(len(polls))
+            if len(polls) < 3:
+                raise export.requests.ConnectionError('connection reset')
+            return []
+
+        def mark_exported(self, env_scans):
+            polls.append('exported')
+
+    sleeps = []
+    monkeypatch.setattr(export, 'ScanWatcher', Watcher)
+    monkeypatch.setattr(export.time, 'sleep', sleeps.append)
+    export.watch(str(tmp_path / 'out.csv'), interval=10, max_polls=4)
+    assert sleeps == [10, 20, 10]
+    assert polls == [0, 1, 2, 'exported', 4, 'exported']
+
+
+def test_watch_appends_ndjson(monkeypatch, tmp_path):
+    api = compliance_api([2, 1])
+    for scan in api.scans:
+        scan['finished_at'] = time.time() + 60
+    output = str(tmp_path / 'out.ndjson')
+    with serving(monkeypatch, api):
+        export.watch(output, fmt='ndjson', max_polls=1)
+    with open(output) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == sum(len(list(export.records_from_rule(rule))) for scan_rules in api.rules.values() for rule in scan_rules)
+    assert list(lines[0]) == export.COLUMNS
+
+
+def test_failed_tenant_fails_the_export(monkeypatch, tmp_path):
+    def tenant_records(tenant, reporter):
+        if tenant.name == 'broken':
+            raise export.requests.HTTPError('401 Client Error: Unauthorized')
+        record = dict((col, 'x') for col in export.COLUMNS)
+        record['tenant'] = tenant.name
+        yield record
+    monkeypatch.setattr(export, 'tenant_records', tenant_records)
+    tenants = [export.fugue_client.Tenant(name, 'id', 'secret') for name in ('prod', 'broken')]
+    filename = str(tmp_path / 'out.csv')
+
+    with pytest.raises(SystemExit) as exit_info:
+        export.export_tenants(tenants, filename)
+    assert exit_info.value.code == 1
+    assert not (tmp_path / 'out.csv').exists()
+    assert (tmp_path / 'out.csv.partial').exists()
+
+    export.export_tenants(tenants[:1], filename)
+    assert len((tmp_path / 'out.csv').read_text().splitlines()) == 2
+
+
+def sort_record(account, family, control, resource_id):
+    return {'account': account, 'family': family, 'control': control, 'environment_name': 'env',
+            'resource_type': 'AWS.S3.Bucket', 'resource_id': resource_id}
+
+
+def test_external_sort_spills_and_merges_runs():
+    records = [sort_record('%03d' % (index * 7 % 101), 'FBP', 'FG_R%05d' % (index % 13), None if index % 5 else 'r-%d' % index)
+               for index in range(1000)]
+    expected = sorted(records, key=export.sort_key)
+    # 100 runs of 10 records merged 4 at a time need several merge passes
+    assert list(export.external_sort(iter(records), run_size=10, fan_in=4)) == expected
+    assert list(export.external_sort(iter(records))) == expected
+    assert list(export.external_sort(iter([]), run_size=10)) == []
+
+
+def test_external_sort_is_stable_for_equal_keys():
+    records = [dict(sort_record('1', 'FBP', 'C1', 'r'), message=str(index)) for index in range(30)]
+    assert [record['message'] for record in export.external_sort(iter(records), run_size=7, fan_in=2)] == [str(index) for index in range(30)]
+
+
+def test_messages_are_only_rewritten_in_csv():
+    failure = {'resource': {'resource_type': 'AWS.S3.Bucket', 'resource_id': 'logs'}, 'messages': ['"acl" allows read, write']}
+    (record,) = export.records_from_failed_resource('FBP', 'FG_R00100', failure)
+    record.update((col, 'x') for col in export.COLUMNS if col not in record)
+    assert record['message'] == '"acl" allows read, write'
+    assert export.format(record).split(',')[export.COLUMNS.index('message')] == 'acl allows read write'
+    assert json.loads(export.format(record, fmt='ndjson'))['message'] == '"acl" allows read, write'
+
+
+def test_partitions_are_scheduled_longest_first():
+    partitions = dict((key, [(environment(env_id), None) for env_id in env_ids]) for key, env_ids in [
+        ('small', ['env-a']),
+        ('large', ['env-b', 'env-c']),
+        ('new', ['env-new']),
+        ('medium', ['env-d']),
+    ])
+    stats = {'env-a': {'seconds': 1.0}, 'env-b': {'seconds': 4.0}, 'env-c': {'seconds': 5.0}, 'env-d': {'seconds': 3.0}}
+    # env-new was not exported before and is assumed to take the median of the others
+    assert export.estimated_seconds(stats, ['env-a', 'env-b', 'env-c', 'env-d', 'env-new'])['env-new'] == 4.0
+    assert export.schedule_partitions(partitions, stats) == ['large', 'new', 'medium', 'small']
+    # Without stats every partition costs the same and they keep a stable order
+    assert export.schedule_partitions(partitions, {}) == ['large', 'medium', 'new', 'small']
+
+
+@pytest.mark.parametrize('expected_pages', [2, 4, 5, 9])
+def test_split_pages_give_the_same_records(monkeypatch, expected_pages):
+    monkeypatch.setattr(export, 'COMPLIANCE_PAGE_SIZE', 5)
+    api = compliance_api([23])
+    env, scan = environment('env-0', account='%012d' % 0), api.scans[0]
+    with serving(monkeypatch, api) as stand_in:
+        unsplit = list(export.records_from_scans([(env, scan)]))
+        unsplit_pages = len(stand_in.requests)
+        del stand_in.requests[:]
+        stats = {'env-0': {'pages': expected_pages}}
+        with export.ThreadPoolExecutor(max_workers=4) as pool:
+            split = list(export.records_from_scans([(env, scan)], stats=stats, pool=pool))
+    assert split == unsplit
+    assert unsplit_pages == stats['env-0']['pages'] == 5
+    # Pages that were requested ahead but are past the end are the only extra requests
+    offsets = sorted(int(query['offset']) for method, path, query, body, headers in stand_in.requests)
+    assert offsets == sorted(set(range(0, 25, 5)) | set(range(0, 5 * expected_pages, 5)))
+
+
+def test_stats_are_kept_beside_the_output_and_pruned(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('out')
+    output = os.path.join('out', 'compliance.csv')
+    export.save_export_stats({'env-0': {'seconds': 1.0}, 'deleted': {'seconds': 9.0}}, export.export_stats_path(output))
+    with serving(monkeypatch, compliance_api([2])):
+        export.main(output)
+    assert not os.path.exists(export.EXPORT_STATS_FILE)
+    stats = export.load_export_stats(os.path.join('out', export.EXPORT_STATS_FILE))
+    assert sorted(stats) == ['env-0']
+    assert stats['env-0']['records'] == 6
+
+
+def test_latest_scans_only_look_up_missing_environments(monkeypatch):
+    monkeypatch.setattr(export, 'SCAN_PAGE_SIZE', 10)
+    now = time.time()
+    # 50 recent scans of other environments, then one of env-a; env-b has no scan at all
+    scans = [{'id': 'other-%d' % index, 'environment_id': 'other-%d' % (index % 7), 'status': 'SUCCESS', 'created_at': now - index}
+             for index in range(50)]
+    scans.insert(3, {'id': 'scan-a', 'environment_id': 'env-a', 'status': 'SUCCESS', 'created_at': now - 3})
+    with serving(monkeypatch, FugueAPI([], scans)) as stand_in:
+        latest = export.get_latest_scans(['env-a', 'env-b'])
+    assert dict((env_id, scan['id']) for env_id, scan in latest.items()) == {'env-a': 'scan-a'}
+    # One page of the listing, then a single lookup for env-b instead of the other four pages
+    assert [(query.get('environment_id'), query.get('offset')) for method, path, query, body, headers in stand_in.requests] == [
+        (None, '0'), ('env-b', None)]
@@ -0,0 +1,84 @@
+import pytest
+
+import inventory_ingest
+
+
+def aws_inventory(path):
+    return inventory_ingest.Inventory(str(path), ['name', 'account_id'], lambda row: str(row['account_id']).strip(),
+                                      inventory_ingest.validate_aws_account)
+
+
+def test_csv_rows_are_validated(tmp_path):
+    path = tmp_path / 'accounts.csv'
+    path.write_text('name,account_id\nprod,012345678901\nbad,12ab\nshort,1234\n,111111111111\ndev, 222222222222 \n')
+    inventory = aws_inventory(path)
+    assert list(inventory.items()) == [('prod', '012345678901'), ('dev', '222222222222')]
+    assert (inventory.valid, inventory.invalid) == (2, 3)
+
+
+def test_ndjson_numeric_account_ids_are_rejected(tmp_path):
+    path = tmp_path / 'accounts.ndjson'
+    path.write_text('{"name": "a", "account_id": "012345678901"}\n'
+                    '{"name": "b", "account_id": 12345678901}\n'
+                    'not json\n'
+                    '\n'
+                    '["not", "a", "mapping"]\n')
+    inventory = aws_inventory(path)
+    assert list(inventory.items()) == [('a', '012345678901')]
+    assert inventory.invalid == 3
+
+
+def test_yaml_unquoted_account_ids_are_rejected(tmp_path):
+    pytest.importorskip('yaml')
+    path = tmp_path / 'accounts.yaml'
+    # 012345670123 is an octal number in YAML 1.1
+    path.write_text('name: a\naccount_id: "012345678901"\n---\n- name: b\n  account_id: 012345670123\n'
+                    '- name: c\n  account_id: 333333333333\n')
+    inventory = aws_inventory(path)
+    assert list(inventory.items()) == [('a', '012345678901')]
+    assert inventory.invalid == 2
+
+
+def test_chunks_keep_rows_with_the_same_name(tmp_path):
+    path = tmp_path / 'accounts.csv'
+    path.write_text('name,account_id\nprod,111111111111\nprod,222222222222\ndev,333333333333\nqa,444444444444\n')
+    chunks = list(aws_inventory(path).chunks(2))
+    assert chunks == [{'prod': '111111111111'}, {'prod': '222222222222', 'dev': '333333333333'}, {'qa': '444444444444'}]
+
+
+def test_unsupported_format():
+    with pytest.raises(inventory_ingest.InventoryError):
+        inventory_ingest.read_rows('accounts.txt')
+
+
+def test_progress_counts_rows_and_environments_separately(tmp_path, monkeypatch):
+    path = tmp_path / 'accounts.csv'
+    path.write_text('name,account_id\n' + ''.join('acct-%d,%012d\n' % (index, index) for index in range(7)) + 'bad,12ab\n')
+    reporters = []
+    Progress = inventory_ingest.progress.Progress
+
+    def reporter(*args, **kwargs):
+        reporters.append(Progress(*args, **kwargs))
+        return reporters[-1]
+
+    def create_environment(env_def):
+        return (env_def['id'] != '000000000003', 'created ' + env_def['name'])
+    monkeypatch.setattr(inventory_ingest.progress, 'Progress', reporter)
+    monkeypatch.setattr(inventory_ingest.reconcile_environments, 'create_environment', create_environment)
+
+    def env_defs(chunk):
+        # Two environments (regions) per account
+        for name, acct_id in chunk.items():
+            for region in ('us-east-1', 'us-west-2'):
+                yield {'name': name + ' - ' + region, 'id': acct_id}
+
+    failures = inventory_ingest.create_from_inventory(aws_inventory(path), env_defs, {'000000000000'}, lambda acct_id: acct_id, chunk_size=3, workers=2)
+    (inventory,) = reporters
+    assert failures == 2
+    assert (inventory.total, inventory.done, inventory.unit) == (8, 8, 'rows')
+    assert inventory.counters == {'skipped': 1, 'environments': 12}
+    assert inventory.errors == 2
+
+
+def test_yaml_inventories_are_not_counted_up_front(tmp_path):
+    assert aws_inventory(tmp_path / 'accounts.yaml').count() is None
@@ -0,0 +1,53 @@
+import orphan_cleanup
+
+
+def environment(env_id, provider, acct_id):
+    return {
+        'id': env_id,
+        'name': env_id,
+        'provider': provider,
+        'provider_options': {provider: {'role_arn': 'arn:aws:iam::' + acct_id + ':role/Fugue'}},
+    }
+
+
+ENVIRONMENTS = [
+    environment('active', 'aws', '111111111111'),
+    environment('suspended', 'aws', '222222222222'),
+    environment('missing', 'aws', '333333333333'),
+    environment('unchecked', 'aws_govcloud', '444444444444'),
+]
+INVENTORY = {'aws': {'111111111111': 'ACTIVE', '222222222222': 'SUSPENDED'}}
+
+
+def names(orphans):
+    return dict((provider, [env['name'] for env in envs]) for provider, envs in orphans.items())
+
+
+def test_only_accounts_listed_as_not_active_are_orphans():
+    assert names(orphan_cleanup.find_orphans(ENVIRONMENTS, INVENTORY)) == {'aws': ['suspended']}
+
+
+def test_missing_accounts_are_orphans_on_opt_in():
+    orphans = orphan_cleanup.find_orphans(ENVIRONMENTS, INVENTORY, delete_missing_accounts=True)
+    assert names(orphans) == {'aws': ['suspended', 'missing']}
+
+
+def test_orphan_fraction_counts_disabled_environments(monkeypatch, capsys):
+    # 10 environments, 5 of them with scans already disabled, and 2 orphans: 20% of the environments,
+    # but 40% of the enabled ones
+    environments = []
+    for index in range(10):
+        env = environment('env-%d' % index, 'aws', '%012d' % index)
+        env['scan_schedule_enabled'] = index < 5
+        environments.append(env)
+    inventory = {'aws': dict(('%012d' % index, 'SUSPENDED' if index in (0, 6) else 'ACTIVE') for index in range(10))}
+    monkeypatch.setattr(orphan_cleanup, 'get_inventory', lambda: inventory)
+    monkeypatch.setattr(orphan_cleanup.fugue_client, 'list_environments', lambda provider: environments)
+    monkeypatch.setattr(orphan_cleanup, 'max_orphan_fraction', 0.2)
+    monkeypatch.setattr(orphan_cleanup, 'dry_run', True)
+    orphan_cleanup.main()
+    out = capsys.readouterr().out
+    assert 'aws: 2 of 10 environments' in out
+    assert 'skipping aws' not in out
+    # env-6 is an orphan but its scans are already disabled
+    assert [line for line in out.splitlines() if line.startswith('Would disable')] == ['Would disable: env-0 (env-0)']
@@ -0,0 +1,64 @@
+import reconcile_environments
+
+
+def aws_environment(account, regions=('*',), env_id=None, **settings):
+    env = {
+        'name': 'aws-' + account,
+        'provider': 'aws',
+        'provider_options': {'aws': {'regions': list(regions), 'role_arn': 'arn:aws:iam::' + account + ':role/FugueRiskManager'}},
+        'compliance_families': ['FBP', 'CIS-AWS_v1.3.0'],
+        'survey_resource_types': ['AWS.EC2.Instance', 'AWS.S3.Bucket'],
+        'scan_interval': 86400,
+    }
+    env.update(settings)
+    if env_id:
+        env['id'] = env_id
+    return env
+
+
+def test_diff_environments():
+    desired = [
+        aws_environment('111111111111'),
+        aws_environment('222222222222', compliance_families=['CIS-AWS_v1.3.0', 'FBP']),
+        aws_environment('333333333333', scan_interval=3600),
+        aws_environment('444444444444'),
+        aws_environment('444444444444'),
+        aws_environment('555555555555', regions=('us-east-1',)),
+    ]
+    existing = [
+        aws_environment('222222222222', env_id='env-2'),
+        aws_environment('333333333333', env_id='env-3'),
+        aws_environment('555555555555', env_id='env-5'),
+        aws_environment('666666666666', env_id='env-6'),
+        aws_environment('333333333333', env_id='env-3-dup'),
+    ]
+    plan = reconcile_environments.diff_environments(desired, existing)
+    # Compliance families are compared in any order, and duplicate desired environments are created once
+    assert [env['name'] for env in plan['create']] == ['aws-111111111111', 'aws-444444444444', 'aws-555555555555']
+    assert plan['update'] == [('env-3', {'scan_interval': 3600})]
+    assert [env['id'] for env in plan['unchanged']] == ['env-2']
+    assert sorted(env['id'] for env in plan['delete']) == ['env-3-dup', 'env-5', 'env-6']
+
+
+def test_environment_key_ignores_region_order():
+    first = aws_environment('111111111111', regions=('us-east-1', 'eu-west-1'))
+    second = aws_environment('111111111111', regions=('eu-west-1', 'us-east-1'))
+    assert reconcile_environments.environment_key(first) == reconcile_environments.environment_key(second)
+
+
+def test_apply_plan_only_deletes_when_allowed(monkeypatch):
+    deleted = []
+    monkeypatch.setattr(reconcile_environments, 'delete_environment', lambda env: deleted.append(env['id']) or (True, 'deleted'))
+    plan = {'create': [], 'update': [], 'unchanged': [], 'delete': [aws_environment('666666666666', env_id='env-6')]}
+    assert reconcile_environments.apply_plan(plan) == 0
+    assert deleted == []
+    assert reconcile_environments.apply_plan(plan, allow_deletes=True) == 0
+    assert deleted == ['env-6']
+
+
+def test_failed_items_are_counted_as_done():
+    reporter = reconcile_environments.progress.Progress('test', total=4)
+    failures = reconcile_environments.apply_in_batches(lambda item: (item % 2 == 0, str(item)), [1, 2, 3, 4], 2, 2, reporter)
+    assert failures == 2
+    assert reporter.done == 4
+    assert reporter.errors == 2
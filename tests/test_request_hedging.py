@@ -0,0 +1,119 @@
+import threading
+import time
+
+import pytest
+
+import request_hedging
+
+
+class Response(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def sender(delays, sent):
+    """
+    Returns a send function whose nth call takes delays[n] seconds, raising
+    if the delay is an exception instead.
+    """
+    lock = threading.Lock()
+
+    def send():
+        with lock:
+            index = len(sent)
+            sent.append(threading.current_thread().name)
+        delay = delays[index]
+        if isinstance(delay, Exception):
+            time.sleep(0.05)
+            raise delay
+        time.sleep(delay)
+        return Response('attempt-%d' % index)
+    return send
+
+
+def test_fast_request_is_not_hedged():
+    policy = request_hedging.HedgePolicy(initial_delay=0.2)
+    sent = []
+    resp = policy.run('scans', sender([0.01], sent))
+    assert resp.name == 'attempt-0'
+    assert sent == [threading.current_thread().name]
+    time.sleep(0.3)
+    assert len(sent) == 1
+    assert policy.stats() == {'requests': 1, 'hedges': 0, 'hedge_wins': 0}
+
+
+def test_primary_is_sent_from_the_calling_thread_and_backup_from_the_pool():
+    policy = request_hedging.HedgePolicy(initial_delay=0.05)
+    sent = []
+    resp = policy.run('scans', sender([0.3, 0.01], sent))
+    assert sent[0] == threading.current_thread().name
+    assert sent[1] != threading.current_thread().name
+    # The duplicate answered before the original returned
+    assert resp.name == 'attempt-1'
+    assert policy.stats() == {'requests': 1, 'hedges': 1, 'hedge_wins': 1}
+
+
+def test_slower_backup_is_closed():
+    policy = request_hedging.HedgePolicy(initial_delay=0.05)
+    sent = []
+    send = sender([0.1, 0.3], sent)
+    backups = []
+
+    def send_backup():
+        resp = send()
+        backups.append(resp)
+        return resp
+    resp = policy.run('scans', send, send_backup)
+    assert resp.name == 'attempt-0'
+    time.sleep(0.4)
+    assert backups[0].closed
+    assert policy.stats()['hedge_wins'] == 0
+
+
+def test_failed_primary_uses_backup():
+    policy = request_hedging.HedgePolicy(initial_delay=0.01)
+    sent = []
+    resp = policy.run('scans', sender([IOError('connection reset'), 0.01], sent))
+    assert resp.name == 'attempt-1'
+
+
+def test_failure_without_backup_is_raised():
+    policy = request_hedging.HedgePolicy(initial_delay=1.0)
+    with pytest.raises(IOError):
+        policy.run('scans', sender([IOError('connection reset')], []))
+
+
+def test_backup_uses_its_own_send_function():
+    policy = request_hedging.HedgePolicy(initial_delay=0.05)
+    calls = []
+
+    def send_backup():
+        calls.append('throttled')
+        return Response('backup')
+    sent = []
+    resp = policy.run('scans', sender([0.2], sent), send_backup)
+    assert resp.name == 'backup'
+    assert calls == ['throttled']
+
+
+def test_budget_limits_hedges():
+    policy = request_hedging.HedgePolicy(initial_delay=0.01, budget=0, burst=1)
+    sent = []
+    for _ in range(3):
+        policy.run('scans', sender([0.05, 0.2, 0.05, 0.05], sent))
+        del sent[:]
+    assert policy.stats() == {'requests': 3, 'hedges': 1, 'hedge_wins': 0}
+
+
+def test_deadline_follows_recent_latencies():
+    policy = request_hedging.HedgePolicy(percentile=90, min_samples=10, min_delay=0.01)
+    assert policy.deadline('scans') == policy.initial_delay
+    for latency in range(1, 11):
+        policy.latencies.record('scans', latency / 100.0)
+    assert policy.deadline('scans') == 0.1
+    assert policy.deadline('environments') == policy.initial_delay
@@ -0,0 +1,42 @@
+import pytest
+
+botocore_exceptions = pytest.importorskip('botocore.exceptions')
+
+import role_preflight
+from aws_fakes import STS
+
+
+@pytest.fixture(autouse=True)
+def cache_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(role_preflight, 'PREFLIGHT_CACHE_FILE', str(tmp_path / 'preflight.json'))
+
+
+def test_role_arn():
+    assert role_preflight.role_arn('aws', '012345678901', 'Fugue') == 'arn:aws:iam::012345678901:role/Fugue'
+    assert role_preflight.role_arn('aws_govcloud', '012345678901', 'Fugue') == 'arn:aws-us-gov:iam::012345678901:role/Fugue'
+
+
+def test_filter_checks_roles_concurrently():
+    accounts = dict(('account-%d' % index, '1000000000%02d' % index) for index in range(40))
+    sts = STS(denied={'100000000003': 'AccessDenied', '100000000007': 'Throttling'}, error_class=botocore_exceptions.ClientError,
+              delay=0.05)
+    checker = role_preflight.RoleChecker(external_id='external', sts_client=sts)
+    valid = checker.filter(accounts, 'aws', 'FugueRiskManager')
+    assert sorted(valid) == sorted(name for name in accounts if name not in ('account-3', 'account-7'))
+    assert sts.peak == role_preflight.PREFLIGHT_WORKERS
+    assert sts.calls[0]['ExternalId'] == 'external'
+
+
+def test_only_roles_that_could_be_assumed_are_cached():
+    accounts = {'ok': '111111111111', 'denied': '222222222222', 'throttled': '333333333333'}
+    denied = {'222222222222': 'AccessDenied', '333333333333': 'Throttling'}
+    sts = STS(denied=denied, error_class=botocore_exceptions.ClientError)
+    assert role_preflight.RoleChecker(sts_client=sts).filter(accounts, 'aws', 'Fugue') == {'ok': '111111111111'}
+    assert len(sts.calls) == 3
+
+    # The role of the denied account was fixed: it is checked again and picked up
+    del denied['222222222222']
+    sts = STS(denied=denied, error_class=botocore_exceptions.ClientError)
+    valid = role_preflight.RoleChecker(sts_client=sts).filter(accounts, 'aws', 'Fugue')
+    assert valid == {'ok': '111111111111', 'denied': '222222222222'}
+    assert sorted(call['RoleArn'].split(':')[4] for call in sts.calls) == ['222222222222', '333333333333']
@@ -0,0 +1,90 @@
+import pytest
+
+import scan_scheduler
+
+
+def environments(count):
+    return [{'id': 'env-%d' % index, 'name': 'env-%d' % index} for index in range(count)]
+
+
+def test_plan_waves_balances_costs():
+    envs = environments(8)
+    costs = dict(('env-%d' % index, cost) for index, cost in enumerate([100, 90, 50, 40, 30, 20, 10, 10]))
+    waves = scan_scheduler.plan_waves(envs, costs, window=1200, wave_seconds=300, max_per_wave=10)
+    assert len(waves) == 4
+    assert sorted(env['id'] for wave in waves for env, cost in wave) == sorted(env['id'] for env in envs)
+    totals = sorted(sum(cost for env, cost in wave) for wave in waves)
+    assert totals == [80, 80, 90, 100]
+
+
+def test_plan_waves_respects_the_cap():
+    waves = scan_scheduler.plan_waves(environments(25), {}, window=1500, wave_seconds=300, max_per_wave=5)
+    assert len(waves) == 5
+    assert [len(wave) for wave in waves] == [5] * 5
+
+
+def test_cap_is_raised_to_fit_the_window(capsys):
+    waves = scan_scheduler.plan_waves(environments(1000), {}, window=3600, wave_seconds=300, max_per_wave=50)
+    assert len(waves) == 12
+    assert max(len(wave) for wave in waves) == 84
+    assert sum(len(wave) for wave in waves) == 1000
+    assert 'raising the cap to 84' in capsys.readouterr().out
+
+
+def test_environments_without_history_cost_the_median():
+    envs = environments(3)
+    waves = scan_scheduler.plan_waves(envs, {'env-0': 10, 'env-1': 30}, window=900, wave_seconds=300, max_per_wave=5)
+    costs = dict((env['id'], cost) for wave in waves for env, cost in wave)
+    assert costs == {'env-0': 10, 'env-1': 30, 'env-2': 20}
+
+
+def test_few_environments_are_spread_over_the_window():
+    waves = scan_scheduler.plan_waves(environments(3), {}, window=3600, wave_seconds=300, max_per_wave=5)
+    assert len(waves) == 12
+    assert [index for index, wave in enumerate(waves) if wave] == [0, 4, 8]
+
+
+class Response(object):
+
+    def __init__(self, status_code, value):
+        self.status_code = status_code
+        self.value = value
+        self.text = str(value)
+
+    def json(self):
+        return self.value
+
+
+def test_apply_waves_counts_failed_scans(monkeypatch, capsys):
+    sleeps = []
+    now = [1000.0]
+
+    def sleep(seconds):
+        sleeps.append(round(seconds))
+        now[0] += seconds
+
+    def post(path, params=None):
+        if params['environment_id'] == 'env-2':
+            return Response(409, {'message': 'scan already running'})
+        return Response(201, {'id': 'scan-' + params['environment_id']})
+    monkeypatch.setattr(scan_scheduler.time, 'sleep', sleep)
+    monkeypatch.setattr(scan_scheduler.time, 'time', lambda: now[0])
+    monkeypatch.setattr(scan_scheduler.fugue_client, 'post', post)
+    envs = environments(4)
+    waves = [[(envs[0], 1), (envs[1], 1)], [], [(envs[2], 1), (envs[3], 1)]]
+    assert scan_scheduler.apply_waves(waves, 300) == 1
+    # The empty wave is skipped and the third one starts 600 seconds after the first
+    assert sleeps == [600]
+    out = capsys.readouterr().out
+    assert 'Scan request failed for env-2' in out
+    assert '3 scans started, 1 failed' in out
+
+
+def test_failed_scans_fail_the_run(monkeypatch):
+    monkeypatch.setattr(scan_scheduler, 'get_scheduled_environments', lambda: [dict(env, scan_interval=3600) for env in environments(2)])
+    monkeypatch.setattr(scan_scheduler, 'get_scan_costs', lambda env_ids: {})
+    monkeypatch.setattr(scan_scheduler, 'dry_run', False)
+    monkeypatch.setattr(scan_scheduler, 'apply_waves', lambda waves, wave_seconds: 1)
+    with pytest.raises(SystemExit) as exit_info:
+        scan_scheduler.main()
+    assert exit_info.value.code == 1
@@ -0,0 +1,23 @@
+import scan_waiter
+
+
+def test_new_environments_allow_for_clock_skew(monkeypatch):
+    envs = [
+        {'id': 'old', 'created_at': 1000},
+        {'id': 'skewed', 'created_at': 1900},
+        {'id': 'new', 'created_at': 2100},
+    ]
+    monkeypatch.setattr(scan_waiter.fugue_client, 'list_environments', lambda provider=None: envs)
+    assert [env['id'] for env in scan_waiter.new_environments(2000)] == ['skewed', 'new']
+    assert [env['id'] for env in scan_waiter.new_environments(2000, margin=0)] == ['new']
+
+
+def test_scans_are_listed_from_before_since(monkeypatch):
+    listed = []
+
+    def list_scans(range_from=None):
+        listed.append(range_from)
+        return [{'id': 'scan-1', 'environment_id': 'env-1', 'status': 'SUCCESS'}]
+    monkeypatch.setattr(scan_waiter.fugue_client, 'list_scans', list_scans)
+    assert list(scan_waiter.wait_for_scans(['env-1'], 2000)) == [('env-1', {'id': 'scan-1', 'environment_id': 'env-1', 'status': 'SUCCESS'})]
+    assert listed == [2000 - scan_waiter.CLOCK_SKEW_MARGIN]